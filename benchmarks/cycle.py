@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+"""Benchmark of BlockManager's resolve-and-apply cycle.
+
+Every scenario runs in a child process against a stub DNS server serving a synthetic zone, with a fake ipset
+binary (cli backend) or a netlink socket double (netlink backend), so no root, network or kernel ipset support is
+needed. Three cycles are measured: cold (every domain resolved for the first time and the set loaded), warm (every
+domain due again, with the answers of a fraction of them changed) and idle (nothing due).
+
+Results are written as JSON, by default to benchmarks/results/<git revision>.json; --compare prints them next to
+an earlier result file:
+
+    python -m benchmarks.cycle --domains 1000,10000
+    python -m benchmarks.cycle --compare benchmarks/results/1c29abc.json
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+from blocky import blocky
+from blocky.blocky import BlockManager, BlockProfile, DetectIPAddresses, IPSetCLIBackend, IPSetHandler, IPSetNetlinkBackend
+from tests.dnsstub import StubDNSServer
+from tests.fakebin import FakeCommand
+
+TOPDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PHASES = ['cold', 'warm', 'idle']
+
+# (result key, label) of the per-cycle numbers printed by --compare
+METRICS = [('seconds', 'cycle time (s)'), ('resolve_seconds', 'resolution (s)'),
+           ('ipset_update_seconds', 'set update (s)'), ('process_spawns', 'processes'),
+           ('netlink_requests', 'netlink requests'), ('changed', 'changed domains'), ('entries', 'set entries')]
+
+
+class CountingNetlinkSocket(object):
+    """Stands in for blocky.netlink.NetlinkSocket, acknowledges every message."""
+
+    def __init__(self):
+        self.requests = 0
+        self.messages = 0
+
+    def request(self, messages, seqs):
+        self.requests += 1
+        self.messages += len(messages)
+        return [(seq, 0) for seq in seqs]
+
+
+def parse_range(value):
+    """'300' or '60-3600' -> (low, high)"""
+    low, _, high = value.partition('-')
+    return float(low), float(high or low)
+
+
+def make_zone(count, addresses_per_domain, ttl_range, rng):
+    zone = {}
+    ttl = {}
+    for i in range(count):
+        name = 'd{}.bench.example'.format(i)
+        zone[name] = random_addresses(addresses_per_domain, rng)
+        ttl[name] = int(rng.uniform(*ttl_range))
+    return zone, ttl
+
+
+def random_addresses(count, rng):
+    return ['10.{}.{}.{}'.format(rng.randint(0, 255), rng.randint(0, 255), rng.randint(1, 254)) for i in range(count)]
+
+
+class Scenario(object):
+    def __init__(self, domains, backend, args):
+        self.domains = domains
+        self.backend = backend
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.zone, self.ttl = make_zone(domains, args.addresses, parse_range(args.ttl), self.rng)
+        self.stub = None
+        self.ipset = None
+        self.sock = None
+
+    def setup(self):
+        latency = parse_range(self.args.latency)
+        self.stub = StubDNSServer(zone=self.zone, ttl=self.ttl, default_latency=latency[1]).start()
+        fqdns = sorted(self.zone)
+        if latency[0] != latency[1]:
+            self.stub.latency = dict((fqdn, self.rng.uniform(*latency)) for fqdn in fqdns)
+        if self.backend == 'cli':
+            self.ipset = FakeCommand('ipset', stdin_words=['restore'])
+            backend = IPSetCLIBackend(path=self.ipset.bindir)
+        else:
+            self.sock = CountingNetlinkSocket()
+            backend = IPSetNetlinkBackend(sock=self.sock)
+        max_ttl = max(self.ttl.values())
+        mgr = BlockManager({'domains': fqdns, 'check_every': max_ttl})
+        mgr.detect = DetectIPAddresses(fqdns=list(fqdns), concurrency=self.args.concurrency, query_timeout=5,
+                                       min_refresh=0, max_refresh=max_ttl)
+        self.stub.configure(mgr.detect._rslv)
+        mgr.profiles = [BlockProfile('main', fqdns, IPSetHandler(ipset_name='blocky_bench', backend=backend))]
+        return mgr
+
+    def teardown(self):
+        self.stub.stop()
+        if self.ipset:
+            self.ipset.cleanup()
+
+    def churn(self):
+        for fqdn in self.rng.sample(sorted(self.zone), int(self.domains * self.args.churn)):
+            self.zone[fqdn] = random_addresses(self.args.addresses, self.rng)
+
+    def measure(self, mgr, now):
+        spawns = blocky.ipset_commands.value()
+        updates, update_seconds = blocky.ipset_update_seconds.value(set='blocky_bench')
+        requests = self.sock.requests if self.sock else 0
+        mgr.detect.last_cycle_time = None
+        started = time.time()
+        changed = mgr.resolve_and_apply(now)
+        elapsed = time.time() - started
+        updates_after, update_seconds_after = blocky.ipset_update_seconds.value(set='blocky_bench')
+        return {'seconds': elapsed,
+                'resolve_seconds': mgr.detect.last_cycle_time or 0.0,
+                'ipset_update_seconds': update_seconds_after - update_seconds,
+                'ipset_updates': updates_after - updates,
+                'process_spawns': blocky.ipset_commands.value() - spawns,
+                'netlink_requests': (self.sock.requests if self.sock else 0) - requests,
+                'changed': len(changed),
+                'entries': len(mgr.profiles[0].ipset_handler.iplist_prev)}
+
+    def run(self):
+        mgr = self.setup()
+        try:
+            now = time.time()
+            result = {'domains': self.domains, 'backend': self.backend}
+            result['cold'] = self.measure(mgr, now)
+            self.churn()
+            # past the longest TTL every domain is due again
+            now += max(self.ttl.values()) + 1
+            result['warm'] = self.measure(mgr, now)
+            result['idle'] = self.measure(mgr, now + 1)
+        finally:
+            self.teardown()
+        # kilobytes on Linux
+        result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return result
+
+
+def _run_child(domains, backend, args, queue):
+    try:
+        queue.put(Scenario(domains, backend, args).run())
+    except Exception as e:
+        queue.put({'domains': domains, 'backend': backend, 'error': '{}: {}'.format(e.__class__.__name__, e)})
+
+
+def run_scenario(domains, backend, args):
+    """Run a scenario in a child process, so that its peak memory is not mixed up with the other scenarios'."""
+    queue = multiprocessing.Queue()
+    child = multiprocessing.Process(target=_run_child, args=(domains, backend, args, queue))
+    child.start()
+    result = queue.get()
+    child.join()
+    return result
+
+
+def git_revision():
+    try:
+        rev = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=TOPDIR).strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD', '--', 'blocky'], cwd=TOPDIR) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+    return rev, dirty
+
+
+def print_results(results):
+    for result in results:
+        print '{} domains, {} backend:'.format(result['domains'], result['backend'])
+        if 'error' in result:
+            print '  failed: {}'.format(result['error'])
+            continue
+        for phase in PHASES:
+            stats = result[phase]
+            print '  {:5} {:8.3f}s  resolve {:8.3f}s  set update {:7.3f}s ({} updates)  processes {}  ' \
+                  'netlink requests {}  changed {}  entries {}'.format(
+                      phase, stats['seconds'], stats['resolve_seconds'], stats['ipset_update_seconds'],
+                      stats['ipset_updates'], stats['process_spawns'], stats['netlink_requests'], stats['changed'],
+                      stats['entries'])
+        print '  peak RSS {} kB'.format(result['peak_rss_kb'])
+
+
+def compare(old, new):
+    """Print every metric of the scenarios in both result sets, old next to new."""
+    old_results = dict(((r['domains'], r['backend']), r) for r in old['results'] if 'error' not in r)
+    print 'Comparing {} with {}'.format(old['revision'], new['revision'])
+    for result in new['results']:
+        key = (result['domains'], result['backend'])
+        if key not in old_results or 'error' in result:
+            continue
+        before = old_results[key]
+        print '{} domains, {} backend:'.format(*key)
+        for phase in PHASES:
+            for metric, label in METRICS:
+                a, b = before[phase][metric], result[phase][metric]
+                ratio = '{:7.2f}x'.format(float(b) / a) if a else '       -'
+                print '  {:5} {:18} {:12.4g} {:12.4g} {}'.format(phase, label, a, b, ratio)
+        print '  {:24} {:12} {:12}'.format('peak RSS (kB)', before['peak_rss_kb'], result['peak_rss_kb'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark BlockManager's resolve-and-apply cycle")
+    parser.add_argument('--domains', default='1000,10000,100000',
+                        help='comma-separated zone sizes (default: 1000,10000,100000)')
+    parser.add_argument('--backend', default='cli,netlink', help='comma-separated ipset backends')
+    parser.add_argument('--addresses', type=int, default=2, help='A records per domain')
+    parser.add_argument('--latency', default='0', help='stub DNS latency in seconds, a value or a low-high range')
+    parser.add_argument('--ttl', default='300', help='TTL of the answers, a value or a low-high range')
+    parser.add_argument('--churn', type=float, default=0.05,
+                        help='fraction of the domains whose addresses change before the warm cycle')
+    parser.add_argument('--concurrency', type=int, default=16, help='resolve_concurrency')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log-level', default='info',
+                        help='blocky log level; log records are formatted and written to /dev/null')
+    parser.add_argument('--output', help='result file (default: benchmarks/results/<git revision>.json)')
+    parser.add_argument('--compare', help='earlier result file to compare with')
+    args = parser.parse_args(argv)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.FileHandler(os.devnull))
+    blocky.LogConfig().set_log_level(args.log_level)
+
+    revision, dirty = git_revision()
+    results = []
+    for domains in [int(x) for x in args.domains.split(',')]:
+        for backend in args.backend.split(','):
+            results.append(run_scenario(domains, backend, args))
+            print_results(results[-1:])
+    data = {'revision': revision, 'dirty': dirty, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0], 'params': vars(args), 'results': results}
+    output = args.output or os.path.join(TOPDIR, 'benchmarks', 'results',
+                                         '{}{}.json'.format(revision, '-dirty' if dirty else ''))
+    if not os.path.isdir(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, 'wb') as fo:
+        json.dump(data, fo, indent=1, sort_keys=True)
+    print 'Results written to {}'.format(output)
+    if args.compare:
+        with open(args.compare, 'rb') as fo:
+            compare(json.load(fo), data)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""Sets of ipset entries with the IPv4 addresses packed into a sorted array of 32-bit integers."""
+
+import bisect
+import heapq
+from array import array
+
+from aggregate import format_network, parse_network
+
+
+def _packed(numbers):
+    """Sorted array of the unique integers in numbers."""
+    return array('I', sorted(set(numbers)))
+
+
+class AddressSet(object):
+    """Immutable sorted set of ipset entries.
+
+    Plain addresses, the bulk of every set, take 4 bytes each in one sorted array; networks (a.b.c.d/len) are kept
+    as sorted (network, prefix length) pairs and anything else ipset may take (e.g. a range) verbatim. Entries are
+    only formatted as strings when the set is iterated, which is when they are handed to ipset or logged.
+    Iteration yields the addresses and networks in numeric order, then the other entries.
+    """
+    __slots__ = ('addresses', 'networks', 'other')
+
+    def __init__(self, entries=()):
+        numbers = []
+        networks = set()
+        other = set()
+        for entry in entries:
+            try:
+                net, plen = parse_network(entry)
+            except ValueError:
+                other.add(entry)
+                continue
+            if plen == 32:
+                numbers.append(net)
+            else:
+                networks.add((net, plen))
+        self.addresses = _packed(numbers)
+        self.networks = tuple(sorted(networks))
+        self.other = tuple(sorted(other))
+
+    @classmethod
+    def _make(cls, addresses, networks=(), other=()):
+        result = cls.__new__(cls)
+        result.addresses = addresses
+        result.networks = networks
+        result.other = other
+        return result
+
+    @classmethod
+    def from_ints(cls, numbers):
+        return cls._make(_packed(numbers))
+
+    @classmethod
+    def from_networks(cls, networks):
+        """From (network, prefix length) pairs as returned by Aggregator.aggregate_ints."""
+        networks = set(networks)
+        addresses = [net for net, plen in networks if plen == 32]
+        return cls._make(_packed(addresses), tuple(sorted(n for n in networks if n[1] != 32)))
+
+    def __len__(self):
+        return len(self.addresses) + len(self.networks) + len(self.other)
+
+    def __iter__(self):
+        if self.networks:
+            pairs = heapq.merge(((number, 32) for number in self.addresses), self.networks)
+            for net, plen in pairs:
+                yield format_network(net, plen)
+        else:
+            for number in self.addresses:
+                yield format_network(number, 32)
+        for entry in self.other:
+            yield entry
+
+    def __contains__(self, entry):
+        try:
+            net, plen = parse_network(entry)
+        except ValueError:
+            return entry in self.other
+        if plen != 32:
+            return (net, plen) in self.networks
+        i = bisect.bisect_left(self.addresses, net)
+        return i < len(self.addresses) and self.addresses[i] == net
+
+    def covers(self, entry):
+        """Whether entry is in the set or inside one of its networks, as ipset matches a hash:net set."""
+        if entry in self:
+            return True
+        try:
+            number, length = parse_network(entry)
+        except ValueError:
+            return False
+        for net, plen in self.networks:
+            mask = (0xffffffff << (32 - plen)) & 0xffffffff
+            if plen <= length and number & mask == net:
+                return True
+        return False
+
+    def __eq__(self, other):
+        if not isinstance(other, AddressSet):
+            return NotImplemented
+        return self.addresses == other.addresses and self.networks == other.networks and self.other == other.other
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'AddressSet({!r})'.format(list(self))
+
+    def union(self, other):
+        if not other:
+            return self
+        if not self:
+            return other
+        return self._make(_packed(self.addresses + other.addresses),
+                          tuple(sorted(set(self.networks).union(other.networks))),
+                          tuple(sorted(set(self.other).union(other.other))))
+
+    def difference(self, other):
+        if not other or not self:
+            return self
+        if self.addresses == other.addresses:
+            addresses = array('I')
+        else:
+            removed = set(other.addresses)
+            addresses = array('I', [number for number in self.addresses if number not in removed])
+        networks = set(other.networks)
+        entries = set(other.other)
+        return self._make(addresses, tuple(n for n in self.networks if n not in networks),
+                          tuple(e for e in self.other if e not in entries))
+
+
+class AddressIndex(object):
+    """The answers of the domains (fqdn -> AddressSet) and, the other way round, the domains each address was
+    seen for.
+
+    Addresses are reference counted: an address stays owned as long as the answer of one domain holds it, so a
+    domain dropping an address it shares with another domain does not release it. Updating the answer of a domain
+    only touches the entries of its old and new addresses.
+    """
+
+    def __init__(self):
+        # fqdn -> AddressSet
+        self.answers = {}
+        # address (as int) -> {fqdn: time the address was last seen in its answer}
+        self._owners = {}
+
+    def __len__(self):
+        return len(self._owners)
+
+    def __contains__(self, address):
+        return bool(self.owners(address))
+
+    def update(self, fqdn, addresses, seen):
+        """Make addresses the answer of fqdn, received at seen; return (new, released): the addresses no domain
+        owned before and the ones no domain owns any more."""
+        old = self.answers.get(fqdn)
+        self.answers[fqdn] = addresses
+        new = []
+        for number in addresses.addresses:
+            owners = self._owners.get(number)
+            if owners is None:
+                owners = self._owners[number] = {}
+                new.append(number)
+            owners[fqdn] = seen
+        released = self._release(fqdn, old.difference(addresses)) if old else AddressSet()
+        return AddressSet.from_ints(new), released
+
+    def discard(self, fqdn):
+        """Forget the answer of fqdn, return the addresses no domain owns any more."""
+        old = self.answers.pop(fqdn, None)
+        return self._release(fqdn, old) if old else AddressSet()
+
+    def _release(self, fqdn, addresses):
+        released = []
+        for number in addresses.addresses:
+            owners = self._owners.get(number)
+            if owners is None:
+                continue
+            owners.pop(fqdn, None)
+            if not owners:
+                del self._owners[number]
+                released.append(number)
+        return AddressSet.from_ints(released)
+
+    def owners(self, address):
+        """{fqdn: time last seen} of the domains whose answers hold address, a string."""
+        try:
+            net, plen = parse_network(address)
+        except ValueError:
+            return {}
+        if plen != 32:
+            return {}
+        return dict(self._owners.get(net, {}))
+
+    def addresses(self):
+        """AddressSet of the addresses in all answers."""
+        return AddressSet.from_ints(self._owners)
@@ -0,0 +1,105 @@
+"""Collapse sets of IPv4 addresses into network prefixes for hash:net ipsets."""
+
+import bisect
+import socket
+import struct
+
+
+def ip_to_int(address):
+    return struct.unpack('!I', socket.inet_aton(address))[0]
+
+
+def int_to_ip(number):
+    return socket.inet_ntoa(struct.pack('!I', number))
+
+
+def parse_network(value):
+    """Parse 'a.b.c.d' or 'a.b.c.d/len' into (network as int, prefix length); host bits must be zero."""
+    value = value.strip()
+    address, _, plen = value.partition('/')
+    if address.count('.') != 3:
+        raise ValueError(value)
+    try:
+        net = ip_to_int(address)
+    except socket.error:
+        raise ValueError(value)
+    plen = int(plen) if plen else 32
+    if not 1 <= plen <= 32:
+        raise ValueError(value)
+    if net & ((1 << (32 - plen)) - 1):
+        raise ValueError(value)
+    return net, plen
+
+
+def format_network(net, plen):
+    if plen == 32:
+        return int_to_ip(net)
+    return '{}/{}'.format(int_to_ip(net), plen)
+
+
+class Aggregator(object):
+    """Turns observed addresses into a list of ipset hash:net entries.
+
+    A prefix replaces the addresses inside it when it is not wider than /min_prefix_len and at least density
+    of its addresses were observed; a single address is never widened. Addresses inside one of the static
+    networks are dropped in favour of the network.
+
+    The addresses are kept as a sorted array of integers, which is walked as an implicit binary radix tree:
+    the two children of a prefix are found by bisecting its range of the array at the middle address, so a
+    prefix is only visited when it holds at least two observed addresses.
+    """
+
+    def __init__(self, min_prefix_len=24, density=0.5, networks=()):
+        self.min_prefix_len = min_prefix_len
+        self.density = density
+        self.networks = self._collapse([parse_network(n) for n in networks])
+        self._starts = [net for net, plen in self.networks]
+        self._ends = [net + (1 << (32 - plen)) - 1 for net, plen in self.networks]
+
+    @staticmethod
+    def _collapse(networks):
+        networks.sort()
+        collapsed = []
+        end = -1
+        for net, plen in networks:
+            if net <= end:
+                # inside the previous network, which starts at or before net and is at least as wide
+                continue
+            collapsed.append((net, plen))
+            end = net + (1 << (32 - plen)) - 1
+        return collapsed
+
+    def _covered(self, number):
+        i = bisect.bisect_right(self._starts, number) - 1
+        return i >= 0 and number <= self._ends[i]
+
+    def _walk(self, numbers, lo, hi, net, plen, out):
+        count = hi - lo
+        if count == 1:
+            out.append((numbers[lo], 32))
+            return
+        if plen >= self.min_prefix_len and count >= self.density * (1 << (32 - plen)):
+            out.append((net, plen))
+            return
+        half = 1 << (31 - plen)
+        mid = bisect.bisect_left(numbers, net + half, lo, hi)
+        if mid > lo:
+            self._walk(numbers, lo, mid, net, plen + 1, out)
+        if hi > mid:
+            self._walk(numbers, mid, hi, net + half, plen + 1, out)
+
+    def aggregate_ints(self, numbers):
+        """Aggregate a sorted list of unique addresses as integers into sorted (network, prefix length) pairs."""
+        if self.networks:
+            numbers = [n for n in numbers if not self._covered(n)]
+        out = []
+        if numbers:
+            self._walk(numbers, 0, len(numbers), 0, 0, out)
+        if self.networks:
+            out.extend(self.networks)
+            out.sort()
+        return out
+
+    def aggregate(self, addresses):
+        numbers = sorted(set([ip_to_int(address) for address in addresses]))
+        return [format_network(net, plen) for net, plen in self.aggregate_ints(numbers)]
@@ -2,10 +2,20 @@
 
 import commands
 import contextlib
+import errno
+import fcntl
+import heapq
+import itertools
+import json
+import Queue
+import random
+import select
 import sys
 import subprocess
 import time
 import signal
+import socket
+import threading
 from functools import partial
 import daemon
 import os
@@ -13,11 +23,23 @@ import logging
 import logging.handlers
 import psutil
 from ConfigParser import ConfigParser
+from multiprocessing.pool import ThreadPool
+import dns.rdatatype
 from dns import resolver
-from dns.resolver import NXDOMAIN
-from iptc import Rule, Table
+from dns.resolver import NXDOMAIN, NoNameservers, Timeout
+from iptc import Chain, Rule, Table
 from setproctitle import setproctitle
 
+import netlink
+import nftables
+from addrset import AddressIndex, AddressSet
+from aggregate import Aggregator, parse_network
+from control import ControlError, ControlServer, ctl_main
+from dnsproxy import DNSProxy, SuffixIndex, parse_host_port
+from domainlist import compile_main, load_compiled, normalize_domains, read_text
+from metrics import MetricsServer, Registry, write_textfile
+from publish import AnswerFollower, AnswerPublisher, format_endpoint, parse_endpoint
+
 ips = []
 
 logging.basicConfig()
@@ -28,8 +50,45 @@ proc_title = 'blocky.py'
 
 whitelist_ipset_name = 'blocky_local_ip_whitelist'
 
+# config sections [profile:NAME] add block profiles to the one of the [main] section
+profile_section_prefix = 'profile:'
+
+# addresses or domains named in one log record at info level, the rest are only counted
+log_list_limit = 20
+# log records waiting for the background writer, more are dropped
+log_queue_size = 10000
+
 run_foreground = False
 
+# Metrics
+
+registry = Registry()
+resolve_cycle_seconds = registry.histogram('blocky_resolve_cycle_seconds',
+                                           'Time to resolve one batch of due FQDNs')
+resolve_seconds = registry.histogram('blocky_resolve_seconds', 'Latency of a DNS query for one FQDN')
+domain_resolve_seconds = registry.gauge('blocky_domain_resolve_seconds',
+                                        'Latency of the last DNS query for an FQDN', ['domain'])
+domain_resolve_errors = registry.counter('blocky_domain_resolve_errors_total',
+                                         'Failed DNS queries for an FQDN by reason', ['domain', 'reason'])
+ipset_update_seconds = registry.histogram('blocky_ipset_update_seconds',
+                                          'Time to apply one batch of operations to an ipset', ['set'])
+ipset_commands = registry.counter('blocky_ipset_commands_total', 'ipset processes spawned')
+nft_commands = registry.counter('blocky_nft_commands_total', 'nft processes spawned')
+ipset_entries = registry.gauge('blocky_ipset_entries', 'Entries in an ipset', ['set'])
+ipset_added = registry.counter('blocky_ipset_added_total', 'Entries added to an ipset', ['set'])
+ipset_resizes = registry.counter('blocky_ipset_resizes_total', 'ipsets replaced by a larger set', ['set'])
+ipset_removed = registry.counter('blocky_ipset_removed_total', 'Entries removed from or expired in an ipset',
+                                 ['set'])
+failing_domains = registry.gauge('blocky_failing_domains', 'FQDNs that failed to resolve several times in a row')
+nameserver_query_seconds = registry.histogram('blocky_nameserver_query_seconds',
+                                              'Latency of DNS queries sent to a nameserver', ['nameserver'])
+nameserver_errors = registry.counter('blocky_nameserver_errors_total',
+                                     'Timed out or failed DNS queries sent to a nameserver', ['nameserver', 'reason'])
+nameserver_benched = registry.gauge('blocky_nameserver_benched',
+                                    '1 while a nameserver is not queried after failed or slow queries', ['nameserver'])
+answers_version = registry.gauge('blocky_answers_version', 'Version of the answers published or followed')
+startup_seconds = registry.gauge('blocky_startup_seconds', 'Time from start to entering the main loop')
+
 # Exceptions
 
 class BlockIPError(Exception):
@@ -48,30 +107,125 @@ class IPSetError(BlockIPError):
     pass
 
 
-class ConfigFileNotFound(Exception):
+class IPSetNetlinkError(IPSetError):
+    def __init__(self, code, msg):
+        super(IPSetNetlinkError, self).__init__(msg)
+        self.code = code
+
+
+class NFTablesError(IPSetError):
+    # an IPSetError, as set updates through nft have to be handled like ipset ones
+    pass
+
+
+class SettingsError(Exception):
+    pass
+
+
+class ConfigFileNotFound(SettingsError):
+    pass
+
+
+class MissingMandatoryOption(SettingsError):
     pass
 
 
-class IncorrectCheckEvery(Exception):
+class IncorrectCheckEvery(SettingsError):
+    pass
+
+
+class IncorrectRulePosition(SettingsError):
+    pass
+
+class IncorrectMinCheckEvery(SettingsError):
     pass
 
 
-class IncorrectRulePosition(Exception):
+class IncorrectResolveConcurrency(SettingsError):
     pass
 
-class IncorrectLogType(Exception):
+
+class IncorrectResolveTimeout(SettingsError):
+    pass
+
+
+class IncorrectResolveRate(SettingsError):
+    pass
+
+
+class IncorrectResolveNameservers(SettingsError):
+    pass
+
+
+class IncorrectResolveBackoff(SettingsError):
+    pass
+
+
+class IncorrectRebuildThreshold(SettingsError):
+    pass
+
+
+class IncorrectIPSetBackend(SettingsError):
+    pass
+
+
+class IncorrectFirewallSetting(SettingsError):
     pass
 
 
-class IncorrectLogLevel(Exception):
+class IncorrectIPSetType(SettingsError):
     pass
 
 
-class IncorrectLogFacility(Exception):
+class IncorrectDNSProxySetting(SettingsError):
     pass
 
 
-class LogPathUnset(Exception):
+class IncorrectEntryTimeout(SettingsError):
+    pass
+
+
+class IncorrectAggregationSetting(SettingsError):
+    pass
+
+
+class IncorrectWatchConfig(SettingsError):
+    pass
+
+
+class IncorrectStateSetting(SettingsError):
+    pass
+
+
+class IncorrectMetricsSetting(SettingsError):
+    pass
+
+
+class IncorrectProfileSetting(SettingsError):
+    pass
+
+
+class IncorrectControlSocket(SettingsError):
+    pass
+
+
+class IncorrectPublishSetting(SettingsError):
+    pass
+
+
+class IncorrectLogType(SettingsError):
+    pass
+
+
+class IncorrectLogLevel(SettingsError):
+    pass
+
+
+class IncorrectLogFacility(SettingsError):
+    pass
+
+
+class LogPathUnset(SettingsError):
     pass
 
 
@@ -87,8 +241,29 @@ def flatten(lst):
     return flat
 
 
+def parse_bool(s):
+    if isinstance(s, bool):
+        return s
+    val = s.strip().lower()
+    if val in ('1', 'yes', 'true', 'on'):
+        return True
+    if val in ('0', 'no', 'false', 'off', ''):
+        return False
+    raise ValueError(s)
+
+
 def parse_comma_separated(s):
-    return [x.strip() for x in s.split(',')]
+    return [x.strip() for x in s.split(',') if x.strip()]
+
+
+def is_ip_address(value):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, value)
+            return True
+        except socket.error:
+            pass
+    return False
 
 
 @contextlib.contextmanager
@@ -104,12 +279,60 @@ def pidfile_ctxmgr(pidfile_path):
 
 
 def sigterm_handler_partial(mgr, signum, frame):
-    mgr.iptables_handler.delete_rule()
-    mgr.ipset_handler.destroy_ipset()
+    if mgr.settings.get('keep_on_shutdown'):
+        log.info('Leaving the iptables rules and ipsets %s in place',
+                 ', '.join([profile.ipset_handler.ipset_name for profile in mgr.profiles]))
+    else:
+        # the rules were indexed at startup, other programs may have changed the chains since
+        for snapshot in mgr.snapshots.values():
+            snapshot.refresh()
+        for profile in mgr.profiles:
+            profile.iptables_handler.delete_rule()
+            profile.ipset_handler.destroy_ipset()
     log.info('Shutdown.')
     sys.exit(0)
 
 
+def sighup_handler_partial(mgr, signum, frame):
+    # picked up by the main loop
+    mgr.reload_requested = True
+    if mgr.wakeup:
+        mgr.wakeup.set()
+
+
+def format_items(items, limit=None):
+    """Comma-separated items, cut after limit (default: log_list_limit) items with the number left out.
+
+    Only the items shown are formatted, items may be any sized iterable (e.g. an AddressSet).
+    """
+    if limit is None:
+        limit = log_list_limit
+    shown = ', '.join(map(str, itertools.islice(items, limit)))
+    if len(items) <= limit:
+        return shown
+    return '{} ... ({} more)'.format(shown, len(items) - limit)
+
+
+def block_profiles(settings):
+    """(name, settings) of every block profile, the one of the [main] section (named main) first."""
+    main = {'table': settings['table'], 'chain': settings['chain'], 'ipset': settings['ipset'], 'target': 'DROP',
+            'rule_pos': settings.get('rule_pos', 0), 'domains': settings['domains']}
+    profiles = settings.get('profiles', {})
+    return [('main', main)] + [(name, profiles[name]) for name in sorted(profiles)]
+
+
+def all_domains(settings):
+    """Domains of all block profiles, each once."""
+    domains = []
+    seen = set()
+    for name, profile in block_profiles(settings):
+        for domain in profile['domains']:
+            if domain not in seen:
+                seen.add(domain)
+                domains.append(domain)
+    return domains
+
+
 def setup_exception_logger(chain=True, log=None):
     import sys
     import traceback
@@ -151,7 +374,7 @@ class LogConfig(object):
             self.set_log_level(log_level)
             fh = logging.FileHandler(log_path)
             self._set_formatter(fh)
-            log.addHandler(fh)
+            log.addHandler(QueueLogHandler(fh))
             return
         if ltype == 'syslog':
             # we're on Linux anyway
@@ -164,13 +387,13 @@ class LogConfig(object):
             log.debug('Logging to syslog handler facility: %s', log_facility)
             self._reset_handlers(log)
             self.set_log_level(log_level)
-            log.addHandler(sh)
             self._set_formatter(sh)
+            log.addHandler(QueueLogHandler(sh))
             return
         raise IncorrectLogType(log_type)
 
     def _reset_handlers(self, log):
-        for hd in log.handlers:
+        for hd in list(log.handlers):
             log.removeHandler(hd)
 
     def _set_formatter(self, handler):
@@ -178,32 +401,629 @@ class LogConfig(object):
         handler.setFormatter(fmt)
 
 
+class QueueLogHandler(logging.Handler):
+    """Hands log records to a background thread that writes them with the target handler.
+
+    The caller never waits for a slow /dev/log or disk: when maxsize records are waiting, further records are
+    dropped and counted, and the number dropped is logged once the writer catches up.
+    """
+
+    def __init__(self, target, maxsize=None):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.maxsize = log_queue_size if maxsize is None else maxsize
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+
+    def _start(self):
+        # started by the process that logs: the thread of the parent does not survive daemonizing
+        self._pid = os.getpid()
+        self._queue = Queue.Queue(self.maxsize)
+        self._thread = threading.Thread(target=self._write, name='blocky-log')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def prepare(self, record):
+        # the message is formatted now, its arguments may change before the writer gets to it
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _write(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                return
+            with self._dropped_lock:
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                self.target.handle(logging.makeLogRecord({
+                    'msg': '{} log records dropped, the log writer fell behind'.format(dropped),
+                    'levelno': logging.WARNING, 'levelname': 'WARNING'}))
+            self.target.handle(record)
+
+    def close(self):
+        """Write the records still waiting (for up to a few seconds) and close the target."""
+        if self._pid == os.getpid() and self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=1)
+                self._thread.join(5)
+            except Queue.Full:
+                pass
+        self.target.close()
+        logging.Handler.close(self)
+
+
+class TokenBucket(object):
+    """Rate limiter: allows rate operations per second on average and bursts of up to capacity operations."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self.tokens = self.capacity
+        self.stamp = None
+
+    def _fill(self, now):
+        if self.stamp is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, count, now=None):
+        """Take up to count tokens, return how many were granted."""
+        self._fill(time.time() if now is None else now)
+        granted = min(count, int(self.tokens))
+        self.tokens -= granted
+        return granted
+
+    def available_at(self, now=None):
+        """Time at which the next token is available."""
+        if now is None:
+            now = time.time()
+        self._fill(now)
+        if self.tokens >= 1:
+            return now
+        return now + (1 - self.tokens) / self.rate
+
+
+class Nameserver(object):
+    """An upstream resolver of DetectIPAddresses and its record of query latency and failures.
+
+    A nameserver whose last bench_after queries in a row timed out, failed or took more than half of the deadline
+    is benched: it is not queried for bench_seconds, doubled with every further strike up to max_bench seconds,
+    and then tried again.
+    """
+    bench_after = 3
+    bench_seconds = 30
+    # weight of the latest query in the moving average latency
+    smoothing = 0.2
+
+    def __init__(self, name, rslv, max_bench=3600):
+        self.name = name
+        self.rslv = rslv
+        self.max_bench = max_bench
+        self.latency = None
+        self.strikes = 0
+        self.benched_until = 0
+        self._lock = threading.Lock()
+
+    def benched(self, now):
+        return self.benched_until > now
+
+    def record(self, elapsed, failed, now=None):
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if not failed:
+                self.latency = elapsed if self.latency is None else \
+                    self.smoothing * elapsed + (1 - self.smoothing) * self.latency
+            if failed or elapsed > self.rslv.lifetime / 2.0:
+                self.strikes += 1
+                if self.strikes >= self.bench_after and not self.benched(now):
+                    period = min(self.bench_seconds * 2 ** (self.strikes - self.bench_after), self.max_bench)
+                    self.benched_until = now + period
+                    log.warn('Nameserver %s not queried for %ds after %d failed or slow queries', self.name,
+                             period, self.strikes)
+                    nameserver_benched.set(1, nameserver=self.name)
+            elif self.strikes:
+                if self.strikes >= self.bench_after:
+                    log.info('Nameserver %s answers again', self.name)
+                    nameserver_benched.set(0, nameserver=self.name)
+                self.strikes = 0
+
+    def status(self):
+        return {'latency': self.latency, 'strikes': self.strikes, 'benched_until': self.benched_until or None}
+
+
+def make_resolver(nameserver, query_timeout=None):
+    """dnspython resolver for 'system' (configured from /etc/resolv.conf) or a host / host:port nameserver."""
+    if nameserver == 'system':
+        rslv = resolver.Resolver()
+    else:
+        rslv = resolver.Resolver(configure=False)
+        host, rslv.port = parse_host_port(nameserver)
+        rslv.nameservers = [host]
+    if query_timeout:
+        # dnspython's lifetime is the deadline for the whole query, retries included
+        rslv.lifetime = float(query_timeout)
+    return rslv
+
+
+# reasons of failed queries: a negative answer is final, the others are retried with backoff
+negative_reasons = ('nxdomain', 'noanswer')
+resolve_error_reasons = negative_reasons + ('timeout', 'servfail')
+
+
+def negative_ttl(response):
+    """How long a negative answer may be cached: the lower of the SOA record's TTL and its minimum (RFC 2308)."""
+    for rrset in response.authority:
+        if rrset.rdtype == dns.rdatatype.SOA:
+            return min(rrset.ttl, rrset[0].minimum)
+    return None
+
+
+class DomainHealth(object):
+    """Failure record of the domains of DetectIPAddresses.
+
+    A domain whose queries timed out or failed is retried after base seconds, doubled with every further failure
+    up to max_backoff, each interval cut by a random fraction of up to jitter so that domains that failed together
+    are not retried together. Meanwhile its last good answer is used for grace seconds. A domain is listed as
+    failing after persistent_after failed or negative results in a row.
+    """
+    jitter = 0.5
+    persistent_after = 3
+
+    def __init__(self, base=10, max_backoff=3600, grace=3600, rng=None):
+        self.base = base
+        self.max_backoff = max_backoff
+        self.grace = grace
+        self._random = rng or random.Random()
+        # fqdn -> time of the last good answer
+        self.last_good = {}
+        # fqdn -> {'reason', 'attempts', 'since', 'retry_at'} of the current run of failures
+        self._failures = {}
+
+    def succeeded(self, fqdn, now):
+        self.last_good[fqdn] = now
+        self._failures.pop(fqdn, None)
+
+    def _record(self, fqdn, reason, now, interval):
+        record = self._failures.setdefault(fqdn, {'attempts': 0, 'since': now})
+        record['attempts'] += 1
+        record['reason'] = reason
+        record['retry_at'] = now + interval
+
+    def negative(self, fqdn, reason, now, interval):
+        """The domain has no addresses, it is queried again after interval seconds like a good answer."""
+        self._record(fqdn, reason, now, interval)
+
+    def failed(self, fqdn, reason, now):
+        """Record a failure, return the seconds until the domain is tried again."""
+        attempts = self._failures[fqdn]['attempts'] if fqdn in self._failures else 0
+        interval = min(self.base * 2 ** attempts, self.max_backoff)
+        interval *= 1 - self.jitter * self._random.random()
+        self._record(fqdn, reason, now, interval)
+        return interval
+
+    def in_grace(self, fqdn, now):
+        """Whether the last good answer of the failing domain is still used."""
+        return now - self.last_good.get(fqdn, float('-inf')) <= self.grace
+
+    def failing(self):
+        """{fqdn: failure record} of the domains that failed persistent_after or more times in a row."""
+        return dict((fqdn, dict(record)) for fqdn, record in self._failures.items()
+                    if record['attempts'] >= self.persistent_after)
+
+    def forget(self, fqdns):
+        for fqdn in fqdns:
+            self.last_good.pop(fqdn, None)
+            self._failures.pop(fqdn, None)
+
+
 class DetectIPAddresses(object):
-    def __init__(self, fqdns=None):
+    def __init__(self, fqdns=None, concurrency=1, query_timeout=None, min_refresh=0, max_refresh=3600, rate=None,
+                 nameservers=None, max_backoff=3600, grace=3600, per_domain_metrics=False):
         if fqdns is None:
             fqdns = []
         self.fqdns = fqdns
-        self._rslv = resolver.Resolver()
-
-    def _resolve_catch_err(self, fqdn):
+        # the domain labelled metrics take a series per domain, too many for long lists unless asked for
+        self.per_domain_metrics = per_domain_metrics
+        self.concurrency = max(1, int(concurrency))
+        self.min_refresh = min_refresh
+        self.max_refresh = max_refresh
+        # queries per second limit, names that are due but over the limit wait in the queue
+        self.bucket = TokenBucket(rate) if rate else None
+        self.query_timeout = query_timeout
+        # the system resolver, also used when no nameservers are configured
+        self._rslv = make_resolver('system', query_timeout)
+        self.nameservers = []
+        self.set_nameservers(nameservers)
+        self.health = DomainHealth(base=max(min_refresh, 1), max_backoff=max_backoff, grace=grace)
+        self.last_cycle_time = None
+        # fqdn -> AddressSet of the last answer, and the time it was received; the answers are kept by the
+        # index, which also knows the domains of every address
+        self.index = AddressIndex()
+        self.answers = self.index.answers
+        self.resolved_at = {}
+        # fqdns whose answers changed or were forgotten since they were last published, None while not tracked
+        self.unpublished = None
+        # refresh queue: heap of (due time, fqdn); _due holds the current due time of each fqdn, so entries
+        # pushed again by an early refresh leave stale heap items behind that are skipped when popped
+        self._queue = []
+        self._due = {}
+        for fqdn in self.fqdns:
+            self._schedule(fqdn, 0)
+        # sweep: the period in which every fqdn gets resolved once
+        self._swept = set()
+        self.sweep_started = None
+        self.last_sweep_time = None
+
+    def set_nameservers(self, names):
+        """Query every one of names ('system' or host[:port]) for each fqdn, by default the system resolver alone.
+
+        Nameservers that stay configured keep their latency and failure record.
+        """
+        known = dict((ns.name, ns) for ns in self.nameservers)
+        nameservers = []
+        for name in names or ['system']:
+            if name in known:
+                nameservers.append(known.pop(name))
+            else:
+                rslv = self._rslv if name == 'system' else make_resolver(name, self.query_timeout)
+                nameservers.append(Nameserver(name, rslv, max_bench=self.max_refresh))
+        for name in known:
+            nameserver_benched.remove(nameserver=name)
+        self.nameservers = nameservers
+
+    def set_query_timeout(self, query_timeout):
+        """Deadline of every query, dnspython's default lifetime for None."""
+        self.query_timeout = query_timeout
+        lifetime = float(query_timeout) if query_timeout else resolver.Resolver(configure=False).lifetime
+        for rslv in set([self._rslv] + [ns.rslv for ns in self.nameservers]):
+            rslv.lifetime = lifetime
+
+    def active_nameservers(self, now=None):
+        """Nameservers to query, fastest first; when all of them are benched the one back soonest."""
+        if now is None:
+            now = time.time()
+        active = [ns for ns in self.nameservers if not ns.benched(now)]
+        if not active:
+            return [min(self.nameservers, key=lambda ns: ns.benched_until)]
+        return sorted(active, key=lambda ns: ns.latency or 0)
+
+    def _resolve_catch_err(self, task):
+        """(None, answer) or (reason, negative TTL or None) of one query, the reasons are resolve_error_reasons."""
+        fqdn, ns = task
+        started = time.time()
+        result = None
         try:
-            return self._rslv.query(fqdn, 'A')
+            answer = ns.rslv.query(fqdn, 'A', raise_on_no_answer=False)
+            if answer.rrset is None:
+                result = ('noanswer', negative_ttl(answer.response))
+            else:
+                result = (None, answer)
         except NXDOMAIN:
-            pass
-        return []
+            # dnspython does not pass on the response, so the SOA record of an NXDOMAIN is not known
+            result = ('nxdomain', None)
+        except Timeout:
+            log.warn('Timeout resolving %s at nameserver %s', fqdn, ns.name)
+            result = ('timeout', None)
+        except NoNameservers:
+            log.warn('Nameserver %s failed to resolve %s', ns.name, fqdn)
+            result = ('servfail', None)
+        finally:
+            elapsed = time.time() - started
+            resolve_seconds.observe(elapsed)
+            nameserver_query_seconds.observe(elapsed, nameserver=ns.name)
+            reason = result[0] if result else None
+            if self.per_domain_metrics:
+                domain_resolve_seconds.set(elapsed, domain=fqdn)
+                if reason:
+                    domain_resolve_errors.inc(domain=fqdn, reason=reason)
+            # a negative answer is not the nameserver's fault
+            failed = reason in ('timeout', 'servfail')
+            if failed:
+                nameserver_errors.inc(nameserver=ns.name, reason=reason)
+            ns.record(elapsed, failed)
+        return result
+
+    def _resolve_all(self, fqdns):
+        """Answers of every queried nameserver for each of fqdns.
+
+        The queries of one fqdn are queued next to each other, so they run in parallel and the fqdn is done
+        within one query deadline as long as there are as many workers as nameservers.
+        """
+        nameservers = self.active_nameservers()
+        tasks = [(fqdn, ns) for fqdn in fqdns for ns in nameservers]
+        workers = min(self.concurrency, len(tasks))
+        if workers < 2:
+            results = [self._resolve_catch_err(task) for task in tasks]
+        else:
+            pool = ThreadPool(workers)
+            try:
+                results = pool.map(self._resolve_catch_err, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        count = len(nameservers)
+        return [results[i:i + count] for i in range(0, len(results), count)]
+
+    def _schedule(self, fqdn, due):
+        self._due[fqdn] = due
+        heapq.heappush(self._queue, (due, fqdn))
+
+    def add_fqdns(self, fqdns):
+        """Start resolving fqdns, they are due right away."""
+        for fqdn in fqdns:
+            if fqdn not in self._due:
+                self.fqdns.append(fqdn)
+                self._schedule(fqdn, 0)
+
+    def remove_fqdns(self, fqdns):
+        """Stop resolving fqdns and forget their answers, return the AddressSet of the addresses no other fqdn
+        resolves to."""
+        drop = set(fqdns)
+        self.fqdns = [fqdn for fqdn in self.fqdns if fqdn not in drop]
+        released = AddressSet()
+        for fqdn in drop:
+            # their queue entries are skipped as stale once _due no longer has them
+            self._due.pop(fqdn, None)
+            released = released.union(self.index.discard(fqdn))
+            self.resolved_at.pop(fqdn, None)
+            domain_resolve_seconds.remove(domain=fqdn)
+            for reason in resolve_error_reasons:
+                domain_resolve_errors.remove(domain=fqdn, reason=reason)
+        self.health.forget(drop)
+        self._swept -= drop
+        self._changed(drop)
+        return released
+
+    def _changed(self, fqdns):
+        if self.unpublished is not None:
+            self.unpublished.update(fqdns)
+
+    def seed(self, answers, resolved_at):
+        """Use earlier answers of the fqdns (e.g. from a state file) until they are resolved again."""
+        for fqdn, addresses in answers.items():
+            if fqdn in self._due and fqdn not in self.answers:
+                self.index.update(fqdn, AddressSet(addresses), resolved_at.get(fqdn))
+                self._changed([fqdn])
+                self.resolved_at[fqdn] = resolved_at.get(fqdn)
+                if resolved_at.get(fqdn) is not None:
+                    self.health.succeeded(fqdn, resolved_at[fqdn])
+
+    def spread(self, start, interval):
+        """Schedule the fqdns evenly over interval seconds from start, instead of all at once."""
+        if not self.fqdns:
+            return
+        step = float(interval) / len(self.fqdns)
+        for i, fqdn in enumerate(self.fqdns):
+            self._schedule(fqdn, start + i * step)
+
+    def progress(self, now=None):
+        """(fqdns resolved in the current sweep, number of fqdns, seconds since the sweep started)"""
+        if now is None:
+            now = time.time()
+        elapsed = now - self.sweep_started if self.sweep_started is not None else 0
+        return len(self._swept), len(self.fqdns), elapsed
+
+    def _track_sweep(self, fqdns, now):
+        if self.sweep_started is None:
+            self.sweep_started = now
+        self._swept.update(fqdns)
+        done, total, elapsed = self.progress(now)
+        log.debug('Sweep progress: %d of %d FQDNs resolved in %.1fs', done, total, elapsed)
+        if done < total:
+            return
+        self.last_sweep_time = elapsed
+        if elapsed > self.max_refresh:
+            log.warn('Sweep of %d FQDNs took %.1fs, longer than the %ss interval', total, elapsed, self.max_refresh)
+        else:
+            log.info('Sweep of %d FQDNs completed in %.1fs', total, elapsed)
+        self._swept = set()
+        self.sweep_started = None
+
+    def _refresh_interval(self, ttl):
+        if ttl is None:
+            # nothing to go by, retry at the longest interval
+            return self.max_refresh
+        return min(max(ttl, self.min_refresh), self.max_refresh)
+
+    def _outcome(self, fqdn, results, now):
+        """(addresses, seconds until fqdn is resolved again) from the results of its queries.
+
+        The addresses are the union of the good answers; with only negative answers there are none. When every
+        query failed, the fqdn is retried with backoff and keeps its last good answer for the grace period.
+        """
+        good = [answer for reason, answer in results if reason is None]
+        if good:
+            self.health.succeeded(fqdn, now)
+            return (AddressSet([x.address for answer in good for x in answer]),
+                    min(self._refresh_interval(answer.rrset.ttl) for answer in good))
+        negative = [(reason, ttl) for reason, ttl in results if reason in negative_reasons]
+        if negative:
+            ttls = [ttl for reason, ttl in negative if ttl is not None]
+            interval = self._refresh_interval(min(ttls) if ttls else None)
+            self.health.negative(fqdn, negative[0][0], now, interval)
+            return AddressSet(), interval
+        interval = self.health.failed(fqdn, results[0][0], now)
+        if fqdn in self.answers and self.health.in_grace(fqdn, now):
+            return self.answers[fqdn], interval
+        return AddressSet(), interval
+
+    def refresh(self, fqdns, now=None):
+        """Resolve fqdns, reschedule each by its answer's TTL and return the set of fqdns whose addresses changed."""
+        if now is None:
+            now = time.time()
+        started = time.time()
+        answers = self._resolve_all(fqdns)
+        changed = set()
+        new = released = 0
+        for fqdn, results in zip(fqdns, answers):
+            addresses, interval = self._outcome(fqdn, results, now)
+            # unless the last good answer was kept
+            if addresses is not self.answers.get(fqdn):
+                if self.answers.get(fqdn) != addresses:
+                    changed.add(fqdn)
+                added, dropped = self.index.update(fqdn, addresses, now)
+                new += len(added)
+                released += len(dropped)
+                self.resolved_at[fqdn] = now
+            self._schedule(fqdn, now + interval)
+        failing_domains.set(len(self.health.failing()))
+        self.last_cycle_time = time.time() - started
+        resolve_cycle_seconds.observe(self.last_cycle_time)
+        log.debug('Resolved %d FQDNs in %.3fs (concurrency: %d), answers changed for %d, %d new addresses, '
+                  '%d addresses no longer resolved by any FQDN', len(fqdns), self.last_cycle_time, self.concurrency,
+                  len(changed), new, released)
+        self._track_sweep(fqdns, now)
+        self._changed(changed)
+        return changed
+
+    def resolve_due(self, now=None):
+        """Re-resolve only the fqdns whose refresh time has come, see refresh()."""
+        if now is None:
+            now = time.time()
+        limit = self.bucket.take(len(self._due), now) if self.bucket else None
+        due = []
+        while self._queue and self._queue[0][0] <= now and (limit is None or len(due) < limit):
+            when, fqdn = heapq.heappop(self._queue)
+            if self._due.get(fqdn) == when:
+                due.append(fqdn)
+        if limit is not None and limit > len(due):
+            # return the tokens that were not used
+            self.bucket.tokens += limit - len(due)
+        if not due:
+            return set()
+        return self.refresh(due, now)
+
+    def next_due(self):
+        while self._queue and self._due.get(self._queue[0][1]) != self._queue[0][0]:
+            heapq.heappop(self._queue)
+        if not self._queue:
+            return None
+        due = self._queue[0][0]
+        if self.bucket:
+            return max(due, self.bucket.available_at())
+        return due
+
+    def addresses(self, fqdns=None):
+        """AddressSet of the last answers of fqdns, all of them by default."""
+        if fqdns is None:
+            return self.index.addresses()
+        numbers = set()
+        for fqdn in fqdns:
+            answer = self.answers.get(fqdn)
+            if answer:
+                numbers.update(answer.addresses)
+        return AddressSet.from_ints(numbers)
+
+    def set_answers(self, answers, removed=(), now=None):
+        """Take answers (fqdn -> addresses) instead of resolving, e.g. from a leader, and forget the answers of
+        the removed fqdns; return the set of fqdns whose addresses changed."""
+        if now is None:
+            now = time.time()
+        changed = set()
+        for fqdn, addresses in answers.items():
+            addresses = AddressSet(addresses)
+            if self.answers.get(fqdn) != addresses:
+                changed.add(fqdn)
+            self.index.update(fqdn, addresses, now)
+            self.resolved_at[fqdn] = now
+        for fqdn in removed:
+            if fqdn in self.answers:
+                self.index.discard(fqdn)
+                self.resolved_at.pop(fqdn, None)
+                changed.add(fqdn)
+        self._changed(changed)
+        return changed
 
     def iplist(self):
         log.debug('FQDNs: %s', self.fqdns)
-        resolver = self._resolve_catch_err
-        addresses = filter(None, flatten([list(resolver(fqdn)) for fqdn in self.fqdns]))
-        addresses = list(set([x.address for x in addresses]))
-        addresses.sort()
-        return addresses
+        self.refresh(list(self.fqdns))
+        return self.addresses()
+
+
+class IPTablesSnapshot(object):
+    """One handle to an iptables table, shared by StartupChecks and the IPTablesHandlers.
+
+    Chains are probed by name instead of building every chain of the table, and the rules of a chain are read
+    once and indexed by comment; the handlers keep the index up to date when they insert or delete rules.
+    """
+
+    def __init__(self, table_name='FILTER'):
+        self.table_name = table_name
+        try:
+            self.table = Table(getattr(Table, table_name))
+        except AttributeError:
+            raise TableNotFound(table_name)
+        self._chains = {}
+        self._by_comment = {}
+        self._counts = {}
+
+    def chain(self, chain_name):
+        if chain_name not in self._chains:
+            if not self.table.is_chain(chain_name):
+                raise ChainNotFound(chain_name)
+            self._chains[chain_name] = Chain(self.table, chain_name)
+        return self._chains[chain_name]
+
+    def _index(self, chain_name):
+        if chain_name not in self._by_comment:
+            index = {}
+            rules = self.chain(chain_name).rules
+            for rule in rules:
+                for match in rule.matches:
+                    if match.name == 'comment' and match.comment:
+                        index.setdefault(match.comment, []).append(rule)
+            self._by_comment[chain_name] = index
+            self._counts[chain_name] = len(rules)
+        return self._by_comment[chain_name]
+
+    def rules_with_comment(self, chain_name, comment):
+        return list(self._index(chain_name).get(comment, []))
+
+    def rule_count(self, chain_name):
+        self._index(chain_name)
+        return self._counts[chain_name]
+
+    def refresh(self):
+        """Read the table again, as other programs may have changed its chains since they were indexed."""
+        self.table.refresh()
+        self._chains = {}
+        self._by_comment = {}
+        self._counts = {}
+
+    def rule_inserted(self, chain_name, comment, rule):
+        self._index(chain_name).setdefault(comment, []).append(rule)
+        self._counts[chain_name] += 1
+
+    def rule_deleted(self, chain_name, comment, rule):
+        rules = self._index(chain_name).get(comment, [])
+        if rule in rules:
+            rules.remove(rule)
+            self._counts[chain_name] -= 1
 
 
 class IPTablesHandler(object):
     def __init__(self, table_name='FILTER', chain_name='FORWARD', ipset_name='blocky', match_set_flag='src', rule_pos=0,
-                 comment='Blocky IPTables Rule', target='DROP'):
+                 comment='Blocky IPTables Rule', target='DROP', snapshot=None):
         self.chain_name = chain_name
         self.table_name = table_name
         self.ipset_name = ipset_name
@@ -214,27 +1034,21 @@ class IPTablesHandler(object):
         self.rule_pos = rule_pos
         self._comment = comment
         self.match_set_flag = match_set_flag
+        self.snapshot = snapshot
         self._table_find()
         self._chain_find()
         self._rule_find()
 
     def _table_find(self):
-        try:
-            self.table = Table(getattr(Table, self.table_name))
-        except AttributeError as e:
-            raise TableNotFound(self.table_name)
+        if self.snapshot is None:
+            self.snapshot = IPTablesSnapshot(self.table_name)
+        self.table = self.snapshot.table
 
     def _chain_find(self):
-        chains = filter(lambda c: c.name == self.chain_name, self.table.chains)
-        try:
-            self.chain = chains[0]
-        except IndexError:
-            raise ChainNotFound(self.chain_name)
+        self.chain = self.snapshot.chain(self.chain_name)
 
-    def rules(self):
-        if not self.chain:
-            self._chain_find()
-        return self.chain.rules
+    def rule_count(self):
+        return self.snapshot.rule_count(self.chain_name)
 
     def insert_rule(self):
         if not self.rule:
@@ -251,66 +1065,598 @@ class IPTablesHandler(object):
                 '''Inserting a rule with target %s into chain %s (table %s) for ipset "%s" (with comment "%s", rule position: %s)''',
                 self.target, self.chain_name, self.table_name, self.ipset_name, self._comment, self.rule_pos)
             self.chain.insert_rule(rule, position=self.rule_pos)
+            self.snapshot.rule_inserted(self.chain_name, self._comment, rule)
 
     def delete_rule(self):
-        for rule in self.chain.rules:
-            for match in rule.matches:
-                if match.comment == self._comment:
-                    log.info('Deleting blocky IPTables rule (chain %s)', self.chain.name)
-                    self.chain.delete_rule(rule)
+        # the chain object of a refreshed snapshot
+        self._chain_find()
+        for rule in self.snapshot.rules_with_comment(self.chain_name, self._comment):
+            log.info('Deleting blocky IPTables rule (chain %s)', self.chain.name)
+            self.chain.delete_rule(rule)
+            self.snapshot.rule_deleted(self.chain_name, self._comment, rule)
+        self.rule = None
 
     def _rule_find(self):
-        for rule in self.rules():
-            match_with_comment = filter(lambda m: m.comment == self._comment, rule.matches)
-            if match_with_comment:
-                self.rule = rule
-                return rule
+        rules = self.snapshot.rules_with_comment(self.chain_name, self._comment)
+        if rules:
+            self.rule = rules[0]
+            return self.rule
 
 
-class IPSetHandler(object):
-    def __init__(self, ipset_name='blocky_blacklist'):
-        self.ipset_name = ipset_name
-        self.create_ipset_args = 'create {} hash:ip hashsize 4096'.format(self.ipset_name)
-        self.path = os.environ.get('PATH', '/sbin:/bin:/usr/sbin:/usr/bin')
-        self.iplist_prev = []
+def ipset_op_args(op):
+    """ipset command line arguments (without the binary) of an operation tuple.
+
+    Operations are ('create', name, set_type, options), ('add', name, entry[, options]), ('del', name, entry),
+    ('flush', name), ('swap', name, name2) and ('destroy', name); options is a sequence of (option, value) pairs.
+    """
+    if op[0] in ('create', 'add'):
+        options = op[3] if len(op) > 3 else ()
+        return list(op[:3]) + [str(x) for pair in options for x in pair]
+    return list(op)
+
+
+class IPSetCLIBackend(object):
+    """Runs ipset operations through the ipset binary, a whole batch in a single 'ipset restore' process."""
+
+    def __init__(self, path=None):
+        self.path = path or os.environ.get('PATH', '/sbin:/bin:/usr/sbin:/usr/bin')
 
     def _env(self):
         return {'PATH': self.path, 'LC_ALL': 'C'}
 
-    def run_ipset_cmd(self, cmds, msg_on_existing_ipset='', msg_on_creating_ipset=''):
-        p = subprocess.Popen(cmds, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self._env())
-        so, se = p.communicate()
+    def run_ipset_cmd(self, cmds, stdin_data=None):
+        stdin = subprocess.PIPE if stdin_data is not None else None
+        ipset_commands.inc()
+        p = subprocess.Popen(cmds, stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self._env())
+        so, se = p.communicate(stdin_data)
         if p.returncode:
-            if not so and se.find('set with the same name already exists') > -1:
-                log.info(msg_on_existing_ipset)
-                return
             raise IPSetError(se)
-        if msg_on_creating_ipset:
-            log.info(msg_on_creating_ipset)
+        return so
+
+    def restore_script(self, ops):
+        return '\n'.join([' '.join(ipset_op_args(op)) for op in ops]) + '\n'
+
+    def create(self, name, set_type, options):
+        """Create a set, return False if a set with that name already exists."""
+        try:
+            self.run_ipset_cmd(['ipset'] + ipset_op_args(('create', name, set_type, options)))
+        except IPSetError as e:
+            if str(e).find('set with the same name already exists') > -1:
+                return False
+            raise
+        return True
+
+    def set_type(self, name):
+        """Type of the existing set name, None if there is no such set."""
+        try:
+            so = self.run_ipset_cmd(['ipset', 'list', '-t', name])
+        except IPSetError as e:
+            if str(e).find('does not exist') > -1:
+                return None
+            raise
+        for line in so.splitlines():
+            if line.startswith('Type:'):
+                return line.split(':', 1)[1].strip()
+        return None
+
+    def run(self, ops, exist=True):
+        cmds = ['ipset', '-exist', 'restore'] if exist else ['ipset', 'restore']
+        log.debug(cmds)
+        self.run_ipset_cmd(cmds, stdin_data=self.restore_script(ops))
+
+
+class IPSetNetlinkBackend(object):
+    """Runs ipset operations by talking nfnetlink to the kernel directly, without forking the ipset binary.
+
+    Errors are reported by the kernel as error codes (see blocky.netlink) instead of ipset's English messages.
+    """
+    batch_size = 256
+    # revision 0 of each set type is understood by every kernel that has ipset protocol 6
+    revisions = {'hash:ip': 0, 'hash:net': 0}
+
+    def __init__(self, sock=None):
+        self._sock = sock
+        self._seq = int(time.time())
+
+    def _socket(self):
+        if self._sock is None:
+            self._sock = netlink.NetlinkSocket()
+        return self._sock
+
+    def _next_seq(self):
+        self._seq = (self._seq + 1) & 0xffffffff
+        return self._seq
+
+    def encode(self, op, seq, exist=True):
+        cmd = op[0]
+        if cmd == 'create':
+            options = dict(op[3])
+            return netlink.create(op[1], op[2], seq, revision=self.revisions.get(op[2], 0),
+                                  hashsize=options.get('hashsize'), maxelem=options.get('maxelem'),
+                                  timeout=options.get('timeout'), exist=exist)
+        if cmd == 'add':
+            options = dict(op[3]) if len(op) > 3 else {}
+            return netlink.add(op[1], op[2], seq, timeout=options.get('timeout'), exist=exist)
+        if cmd == 'del':
+            return netlink.delete(op[1], op[2], seq, exist=exist)
+        if cmd == 'flush':
+            return netlink.flush(op[1], seq)
+        if cmd == 'swap':
+            return netlink.swap(op[1], op[2], seq)
+        if cmd == 'destroy':
+            return netlink.destroy(op[1], seq)
+        raise IPSetError('Unsupported ipset operation: {}'.format(op))
+
+    def _batches(self, ops):
+        batch = []
+        for op in ops:
+            # the kernel carries on with the rest of a batch after a failed message, so a swap is only sent
+            # once everything before it succeeded
+            if len(batch) >= self.batch_size or (op[0] == 'swap' and batch):
+                yield batch
+                batch = []
+            batch.append(op)
+        if batch:
+            yield batch
+
+    def _send(self, ops, exist):
+        seqs = [self._next_seq() for op in ops]
+        messages = [self.encode(op, seq, exist) for op, seq in zip(ops, seqs)]
+        errors = [(seq, code) for seq, code in self._socket().request(messages, seqs) if code]
+        if errors:
+            seq, code = min(errors)
+            op = ops[seqs.index(seq)]
+            raise IPSetNetlinkError(code, '{}: {}'.format(' '.join(ipset_op_args(op)), netlink.error_message(code)))
+
+    def create(self, name, set_type, options):
+        """Create a set, return False if a set with that name already exists."""
+        try:
+            self._send([('create', name, set_type, options)], exist=False)
+        except IPSetNetlinkError as e:
+            if e.code == errno.EEXIST:
+                return False
+            raise
+        return True
+
+    def set_type(self, name):
+        """Type of the existing set name, None if there is no such set."""
+        seq = self._next_seq()
+        data, code = self._socket().query(netlink.header(name, seq), seq)
+        if code == errno.ENOENT:
+            return None
+        if code:
+            raise IPSetNetlinkError(code, 'header {}: {}'.format(name, netlink.error_message(code)))
+        return netlink.parse_typename(data, seq)
+
+    def run(self, ops, exist=True):
+        for batch in self._batches(ops):
+            self._send(batch, exist)
+
+
+ipset_backends = {'cli': IPSetCLIBackend, 'netlink': IPSetNetlinkBackend}
+
+
+class NFTables(object):
+    """Applies nft scripts to blocky's nftables table through 'nft -f', each script as one transaction.
+
+    Between begin() and commit() the statements are collected and applied together, e.g. the creation of the
+    chains, sets and rules at startup. The rules blocky added are kept per chain, as rules are removed by
+    rewriting their chain.
+    """
+
+    def __init__(self, table='blocky', path=None):
+        self.table = table
+        self.path = path or os.environ.get('PATH', '/sbin:/bin:/usr/sbin:/usr/bin')
+        # chain -> [(comment, rule statement)]
+        self.rules = {}
+        self._pending = None
+
+    def run(self, statements):
+        if self._pending is not None:
+            self._pending.extend(statements)
+            return
+        script = '\n'.join(statements) + '\n'
+        log.debug('nft script: %s', script)
+        nft_commands.inc()
+        p = subprocess.Popen(['nft', '-f', '-'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, env={'PATH': self.path, 'LC_ALL': 'C'})
+        so, se = p.communicate(script)
+        if p.returncode:
+            raise NFTablesError(se)
+
+    def begin(self):
+        self._pending = [nftables.add_table(self.table)]
+
+    def commit(self):
+        statements, self._pending = self._pending, None
+        self.run(statements)
+
+    def chain(self, table_name, chain_name):
+        """Name of the base chain standing in for chain_name of table_name, created (empty) on first use."""
+        chain = nftables.HOOKS[chain_name]
+        if chain not in self.rules:
+            self.rules[chain] = []
+            self.run([nftables.add_table(self.table),
+                      nftables.add_chain(self.table, chain, nftables.HOOKS[chain_name],
+                                         nftables.PRIORITIES[table_name.upper()]),
+                      # rules left behind by an earlier run
+                      nftables.flush_chain(self.table, chain)])
+        return chain
+
+    def add_rule(self, chain, comment, statement):
+        self.rules[chain].append((comment, statement))
+        self.run([statement])
+
+    def delete_rules(self, chain, comment):
+        self.rules[chain] = [rule for rule in self.rules[chain] if rule[0] != comment]
+        self.run([nftables.flush_chain(self.table, chain)] + [statement for c, statement in self.rules[chain]])
+
+
+class NFTablesSetBackend(object):
+    """Runs ipset operations on sets of blocky's nftables table.
+
+    A list of operations is one transaction, so a rebuild is a flush and a refill of the live set instead of a
+    swap with a temporary set.
+    """
+    transactional = True
+
+    def __init__(self, nft):
+        self.nft = nft
+
+    def create(self, name, set_type, options):
+        # 'add set' leaves an existing set alone
+        self.nft.run([nftables.add_table(self.nft.table), nftables.add_set(self.nft.table, name, set_type, options)])
+        return True
+
+    def statements(self, ops):
+        table = self.nft.table
+        statements = []
+        # consecutive adds or deletes of one set with the same options go into one statement
+        for key, group in itertools.groupby(ops, key=lambda op: (op[0], op[1], tuple(op[3]) if len(op) > 3 else ())):
+            cmd, name, options = key
+            if cmd == 'del':
+                statements.extend(nftables.elements('delete', table, name, [op[2] for op in group]))
+            elif cmd == 'add':
+                entries = [op[2] for op in group]
+                timeout = dict(options).get('timeout')
+                statements.extend(nftables.elements('add', table, name, entries, timeout))
+                if timeout:
+                    # adding an element does not refresh its timeout like ipset's -exist does; once added, all
+                    # of them can be deleted and added again with the new timeout in the same transaction
+                    statements.extend(nftables.elements('delete', table, name, entries))
+                    statements.extend(nftables.elements('add', table, name, entries, timeout))
+            elif cmd == 'flush':
+                statements.append(nftables.flush_set(table, name))
+            elif cmd == 'destroy':
+                statements.append(nftables.delete_set(table, name))
+            elif cmd == 'create':
+                statements.extend([nftables.add_set(table, op[1], op[2], op[3]) for op in group])
+            else:
+                raise NFTablesError('Unsupported set operation: {}'.format(ipset_op_args(list(group)[0])))
+        return statements
+
+    def run(self, ops, exist=True):
+        self.nft.run(self.statements(ops))
+
+
+class NFTablesRuleHandler(object):
+    """Counterpart of IPTablesHandler for the nftables firewall: the rule goes into blocky's own base chain for
+    chain_name, where the rules keep the order they were inserted in (rule_pos does not apply)."""
+
+    def __init__(self, nft, table_name='FILTER', chain_name='FORWARD', ipset_name='blocky', match_set_flag='src',
+                 rule_pos=0, comment='Blocky IPTables Rule', target='DROP'):
+        self.nft = nft
+        self.table_name = table_name
+        self.chain_name = chain_name
+        self.ipset_name = ipset_name
+        self.match_set_flag = match_set_flag
+        self.target = target
+        self._comment = comment
+        self.chain = nft.chain(table_name, chain_name)
+        self.rule = None
+
+    def insert_rule(self):
+        if self.rule:
+            return
+        for comment, statement in self.nft.rules[self.chain]:
+            if comment == self._comment:
+                # profiles sharing a chain share its whitelist rule
+                self.rule = statement
+                return
+        self.rule = nftables.add_rule(self.nft.table, self.chain, self.ipset_name, self.match_set_flag, self.target,
+                                      self._comment)
+        log.info('Inserting a rule with target %s into nftables chain %s %s for set "%s" (with comment "%s")',
+                 self.target, self.nft.table, self.chain, self.ipset_name, self._comment)
+        self.nft.add_rule(self.chain, self._comment, self.rule)
+
+    def delete_rule(self):
+        log.info('Deleting blocky nftables rule (chain %s)', self.chain)
+        self.nft.delete_rules(self.chain, self._comment)
+        self.rule = None
+
+
+# ipset's default maxelem, and the hashsize blocky creates sets with at that size
+default_maxelem = 65536
+default_hashsize = 4096
+
+# addresses a domain is expected to resolve to, to size new sets by the number of domains; sets grow further as
+# addresses are observed
+expected_addresses_per_domain = 8
+
+# a set is replaced by a larger one when an update would fill it beyond this fraction of its maxelem
+ipset_fill_limit = 0.75
+
+
+def ipset_size(count):
+    """(hashsize, maxelem) of a set expected to hold count entries: maxelem leaves room to grow to four times
+    count, hashsize keeps the ratio of the defaults. Both are powers of two and at least the defaults."""
+    maxelem = default_maxelem
+    while maxelem < 4 * count:
+        maxelem *= 2
+    return default_hashsize * maxelem // default_maxelem, maxelem
+
+
+class IPSetHandler(object):
+    def __init__(self, ipset_name='blocky_blacklist', rebuild_threshold=0.5, backend=None, entry_timeout=None,
+                 set_type='hash:ip', expected=0):
+        self.ipset_name = ipset_name
+        # hash:net takes both plain addresses and a.b.c.d/len prefixes
+        self.set_type = set_type
+        self.hashsize, self.maxelem = ipset_size(expected)
+        # with an entry timeout the set accumulates addresses: every observed address is added (or its timeout
+        # refreshed) and the kernel expires the ones that stop being observed, nothing is deleted or rebuilt
+        self.entry_timeout = entry_timeout
+        # address -> time it was last added with entry_timeout
+        self._refreshed = {}
+        self.backend = backend if backend is not None else IPSetCLIBackend()
+        # AddressSet of the entries in the live set
+        self.iplist_prev = AddressSet()
+        # changes larger than this fraction of the current set are applied by a full rebuild instead of add/del
+        self.rebuild_threshold = rebuild_threshold
+        # False until the live set is known to hold exactly iplist_prev (it may keep entries from a previous run)
+        self._in_sync = False
+        # addresses added by add_addresses (DNS proxy) -> time until which update_ipset keeps them in the set
+        self._pinned = {}
+        # add_addresses is called from DNS proxy threads
+        self._lock = threading.Lock()
+
+    @property
+    def set_options(self):
+        options = [('hashsize', self.hashsize)]
+        if self.maxelem != default_maxelem:
+            options.append(('maxelem', self.maxelem))
+        if self.entry_timeout:
+            options.append(('timeout', self.entry_timeout))
+        return options
+
+    def _grow(self, count):
+        """Size the set up for count entries if that fills it beyond ipset_fill_limit, return whether it was.
+
+        The set only takes the new size when it is rebuilt, the temporary set is created with it and swapped in.
+        Sets of a transactional backend (nftables) are refilled in place and have no size limit.
+        """
+        if count <= ipset_fill_limit * self.maxelem or getattr(self.backend, 'transactional', False):
+            return False
+        hashsize, maxelem = ipset_size(count)
+        log.warn('Resizing ipset %s for %d entries: maxelem %d -> %d, hashsize %d -> %d', self.ipset_name, count,
+                 self.maxelem, maxelem, self.hashsize, hashsize)
+        self.hashsize, self.maxelem = hashsize, maxelem
+        ipset_resizes.inc(set=self.ipset_name)
+        return True
+
+    def _tmp_ipset_name(self):
+        # ipset names are limited to 31 characters
+        return '{}_tmp'.format(self.ipset_name[:27])
 
     def create_ipset(self):
-        cmds = flatten(['ipset', self.create_ipset_args.split()])
-        log.debug('Creating ipset: %s', cmds)
-        self.run_ipset_cmd(cmds, msg_on_existing_ipset='ipset {} exists'.format(self.ipset_name),
-                           msg_on_creating_ipset='Creating ipset {}'.format(self.ipset_name))
+        log.debug('Creating ipset: %s', ipset_op_args(('create', self.ipset_name, self.set_type, self.set_options)))
+        if self.backend.create(self.ipset_name, self.set_type, self.set_options):
+            log.info('Creating ipset %s', self.ipset_name)
+        else:
+            log.info('ipset %s exists', self.ipset_name)
 
     def destroy_ipset(self):
-        cmds = ['ipset', 'destroy', self.ipset_name]
         log.info('Destroying ipset: %s', self.ipset_name)
-        self.run_ipset_cmd(cmds)
+        self.backend.run([('destroy', self.ipset_name)], exist=False)
+        ipset_entries.remove(set=self.ipset_name)
+
+    def _run(self, ops):
+        with ipset_update_seconds.time(set=self.ipset_name):
+            self.backend.run(ops)
+
+    def _count_changes(self, added, removed):
+        ipset_added.inc(added, set=self.ipset_name)
+        ipset_removed.inc(removed, set=self.ipset_name)
+        ipset_entries.set(len(self.iplist_prev), set=self.ipset_name)
+
+    def rebuild_ops(self, iplist):
+        """Operations that fill a temporary set with iplist and swap it with the live set, or flush and refill the
+        live set with a transactional backend."""
+        if getattr(self.backend, 'transactional', False):
+            # applied as a whole, the live set is never seen empty
+            ops = [('flush', self.ipset_name)]
+            ops.extend([('add', self.ipset_name, ip, self._entry_options()) for ip in iplist])
+            return ops
+        tmp_name = self._tmp_ipset_name()
+        ops = [('create', tmp_name, self.set_type, self.set_options), ('flush', tmp_name)]
+        ops.extend([('add', tmp_name, ip, self._entry_options()) for ip in iplist])
+        ops.append(('swap', tmp_name, self.ipset_name))
+        ops.append(('destroy', tmp_name))
+        return ops
+
+    def _entry_options(self, lifetime=None):
+        if not self.entry_timeout:
+            return ()
+        return (('timeout', max(int(lifetime or 0), self.entry_timeout)),)
+
+    def delta_ops(self, added, removed):
+        """Operations that delete removed and add added addresses in the live set."""
+        ops = [('del', self.ipset_name, ip) for ip in removed]
+        ops.extend([('add', self.ipset_name, ip) for ip in added])
+        return ops
+
+    def _needs_rebuild(self, added, removed):
+        if not self._in_sync:
+            return True
+        if self.set_type == 'hash:net' and getattr(self.backend, 'transactional', False):
+            # nftables merges adjacent and overlapping entries of interval sets into ranges, from which the
+            # entries cannot be deleted one by one
+            return True
+        return len(added) + len(removed) > self.rebuild_threshold * max(len(self.iplist_prev), 1)
+
+    def add_addresses(self, addresses, lifetime):
+        """Add addresses to the live set right away and keep them there for at least lifetime seconds."""
+        with self._lock:
+            if self.entry_timeout and self._in_sync:
+                self._refresh_entries(addresses, lifetime)
+                return
+            expiry = time.time() + lifetime
+            for ip in addresses:
+                self._pinned[ip] = max(self._pinned.get(ip, 0), expiry)
+            if self.entry_timeout:
+                # the live set keeps the entries of the previous run until the first update loads it with the
+                # pinned addresses; until then they are added with the set's own timeout, if it has one
+                log.info('Adding %d IP addresses to ipset %s: %s', len(addresses), self.ipset_name,
+                         format_items(addresses))
+                self._run([('add', self.ipset_name, ip) for ip in addresses])
+                return
+            new = AddressSet(addresses).difference(self.iplist_prev)
+            if not new:
+                return
+            if self._grow(len(self.iplist_prev) + len(new)):
+                self._apply(self.iplist_prev.union(new), rebuild=True)
+                return
+            log.info('Adding %d IP addresses to ipset %s: %s', len(new), self.ipset_name, format_items(new))
+            in_sync, self._in_sync = self._in_sync, False
+            self._run([('add', self.ipset_name, ip) for ip in new])
+            self._in_sync = in_sync
+            self.iplist_prev = self.iplist_prev.union(new)
+            self._count_changes(len(new), 0)
+
+    def _refresh_entries(self, iplist, lifetime=None):
+        now = time.time()
+        prev = self.iplist_prev
+        if not self._in_sync:
+            # the live set may be left over from a run without timeouts, so the first update loads a set created
+            # with timeout support and swaps it in, with the addresses the DNS proxy added meanwhile
+            iplist = self._merge_pinned(iplist)
+            self._pinned.clear()
+            log.info('Loading ipset %s with %d IP addresses (timeout %ss): %s', self.ipset_name, len(iplist),
+                     self.entry_timeout, format_items(iplist))
+            self._run(self.rebuild_ops(iplist))
+            self._refreshed = dict.fromkeys(iplist, now)
+            self._in_sync = True
+        else:
+            # an address is re-added once half of its timeout has passed, which keeps it in the set as long as
+            # updates come more often than every entry_timeout / 2 seconds
+            stale_before = now - self.entry_timeout / 2.0
+            stale = sorted(set([ip for ip in iplist if self._refreshed.get(ip, 0) <= stale_before]))
+            if self._grow(len(self._refreshed) + len([ip for ip in stale if ip not in self._refreshed])):
+                # the entries not expired yet move to the larger set with a fresh timeout
+                entries = AddressSet(self._refreshed).union(iplist)
+                self._run(self.rebuild_ops(entries))
+                self._refreshed = dict.fromkeys(entries, now)
+            elif stale:
+                added = [ip for ip in stale if ip not in self._refreshed]
+                if added:
+                    log.info('Adding %d IP addresses to ipset %s: %s', len(added), self.ipset_name,
+                             format_items(added))
+                log.debug('Refreshing %d entries of ipset %s', len(stale), self.ipset_name)
+                self._run([('add', self.ipset_name, ip, self._entry_options(lifetime)) for ip in stale])
+                for ip in stale:
+                    self._refreshed[ip] = now
+        # forget what the kernel has expired by now
+        expired_before = now - self.entry_timeout
+        for ip, refreshed in self._refreshed.items():
+            if refreshed <= expired_before:
+                del self._refreshed[ip]
+        self.iplist_prev = AddressSet(self._refreshed)
+        self._count_changes(len(self.iplist_prev.difference(prev)), len(prev.difference(self.iplist_prev)))
+
+    def _merge_pinned(self, iplist):
+        if not self._pinned:
+            return iplist
+        now = time.time()
+        for ip, expiry in self._pinned.items():
+            if expiry <= now:
+                del self._pinned[ip]
+        return iplist.union(AddressSet(self._pinned))
 
     def update_ipset(self, iplist):
-        iplist.sort()
-        if iplist != self.iplist_prev:
-            log.info('Updating ipset %s with IP addresses: %s', self.ipset_name, ', '.join(map(str, iplist)))
-            cmds = flatten(['ipset', 'flush', self.ipset_name])
-            self.run_ipset_cmd(cmds)
-            log.debug(cmds)
-            for ip in iplist:
-                cmds = flatten(['ipset', 'add', self.ipset_name, str(ip)])
-                log.debug(cmds)
-                self.run_ipset_cmd(cmds)
-            self.iplist_prev = iplist
+        """Make the live set hold the entries of iplist, an AddressSet or a list of strings."""
+        if not isinstance(iplist, AddressSet):
+            iplist = AddressSet(iplist)
+        with self._lock:
+            if self.entry_timeout:
+                self._refresh_entries(iplist)
+                return
+            iplist = self._merge_pinned(iplist)
+            if iplist != self.iplist_prev:
+                self._apply(iplist)
+
+    def _apply(self, iplist, rebuild=False):
+        prev = self.iplist_prev
+        added = iplist.difference(prev)
+        removed = prev.difference(iplist)
+        rebuild = self._grow(len(iplist)) or rebuild or self._needs_rebuild(added, removed)
+        # if the update fails the live set is in an unknown state and the next update rebuilds it
+        self._in_sync = False
+        # the backend applies either list of operations in one go; a rebuild replaces the live set by an
+        # atomic swap, so it never goes empty while the new contents are loaded
+        log.info('Updating ipset %s (%s): %d entries, %d added: %s, %d removed: %s', self.ipset_name,
+                 'rebuild' if rebuild else 'in place', len(iplist), len(added), format_items(added), len(removed),
+                 format_items(removed))
+        if rebuild:
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('Loading ipset %s with IP addresses: %s', self.ipset_name, ', '.join(iplist))
+            self._run(self.rebuild_ops(iplist))
+        else:
+            self._run(self.delta_ops(added, removed))
+        self.iplist_prev = iplist
+        self._in_sync = True
+        self._count_changes(len(added), len(removed))
+
+
+class StateFile(object):
+    """Last applied answers of every domain, saved so that a restart can fill the ipset before resolving.
+
+    The file is JSON: {"version": 1, "saved": time, "domains": {fqdn: [resolved time, [address, ...]]}}.
+    """
+    version = 1
+
+    def __init__(self, path):
+        self.path = path
+
+    def save(self, answers, resolved_at):
+        domains = dict((fqdn, [resolved_at.get(fqdn), list(addresses)]) for fqdn, addresses in answers.items())
+        data = json.dumps({'version': self.version, 'saved': time.time(), 'domains': domains},
+                          separators=(',', ':'), sort_keys=True)
+        # write to a temporary file and rename it over the old one, so the state file is never half written
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'wb') as fo:
+            fo.write(data)
+            fo.flush()
+            os.fsync(fo.fileno())
+        os.rename(tmp_path, self.path)
+
+    def load(self):
+        """Return (answers, resolved_at, saved time); empty when the file is missing or unreadable."""
+        try:
+            with open(self.path, 'rb') as fo:
+                data = json.load(fo)
+            if data.get('version') != self.version:
+                raise ValueError('unknown state file version {}'.format(data.get('version')))
+            answers = {}
+            resolved_at = {}
+            for fqdn, (resolved, addresses) in data['domains'].items():
+                answers[str(fqdn)] = [str(address) for address in addresses]
+                resolved_at[str(fqdn)] = resolved
+            return answers, resolved_at, data['saved']
+        except IOError:
+            return {}, {}, None
+        except (ValueError, KeyError, TypeError) as e:
+            log.warn('Ignoring state file %s: %s', self.path, e)
+            return {}, {}, None
 
 
 class Settings(dict):
@@ -319,7 +1665,9 @@ class Settings(dict):
                                    'pidfile'], **kwargs):
         super(Settings, self).__init__(**kwargs)
         self._config_file = config_file
-        self._list_keys = ['domains']
+        # config file and @files the values were read from
+        self.source_files = [config_file]
+        self._list_keys = ['domains', 'networks']
         self._mandatory_fields = mandatory_fields
         self._parse_config()
 
@@ -329,21 +1677,30 @@ class Settings(dict):
         if not 'main' in cp.sections():
             raise ConfigFileNotFound(self._config_file)
         visited = set()
-        for opt in cp.options('main'):
-            val = cp.get('main', opt).strip()
-            if val.startswith('@'):
-                val = self.check_opt_path(val)
-            elif opt in self._list_keys:
-                val = [x.strip() for x in val.split(',')]
+        for opt, val in self._parse_section(cp, 'main'):
             # setattr(self, opt, val)
-            val = self.check_opt_path(val)
             self[opt] = val
             visited.add(opt)
         diff = set(self._mandatory_fields) - visited
         if diff:
-            log.error('Following mandatory option(s) are not set in config file %s: %s. Abort.', self._config_file,
-                      ', '.join(map(str, list(diff))))
-            sys.exit(1)
+            raise MissingMandatoryOption(', '.join(map(str, sorted(diff))))
+        profiles = {}
+        for section in cp.sections():
+            if section.startswith(profile_section_prefix):
+                profiles[section[len(profile_section_prefix):].strip()] = dict(self._parse_section(cp, section))
+        if profiles:
+            self['profiles'] = profiles
+
+    def _parse_section(self, cp, section):
+        options = []
+        for opt in cp.options(section):
+            val = cp.get(section, opt).strip()
+            if val.startswith('@'):
+                val = self.check_opt_path(val)
+            elif opt in self._list_keys:
+                val = [x.strip() for x in val.split(',')]
+            options.append((opt, self.check_opt_path(val)))
+        return options
 
     def check_opt_path(self, val):
         if isinstance(val, basestring):
@@ -352,11 +1709,15 @@ class Settings(dict):
             if val:
                 fpath = val[1:].strip()
             if val.startswith('@') and fpath and os.path.isfile(fpath):
-                log.info('Reading values from file %s', fpath)
-                with open(fpath, 'rb') as fo:
-                    values = [x.strip() for x in fo.readlines()]
-                    values = [x for x in values if x and (not x.startswith('#'))]
+                self.source_files.append(fpath)
+                # a domain list compiled by 'blocky.py compile' is mapped instead of parsed
+                values = load_compiled(fpath)
+                if values is not None:
+                    log.info('Reading values from compiled file of %s', fpath)
                     return values
+                log.info('Reading values from file %s', fpath)
+                # as compiled, so names match whether or not the list was compiled
+                return normalize_domains(read_text(fpath))
         return val
 
 
@@ -365,34 +1726,195 @@ class StartupChecks(object):
         self.table_name = settings['table']
         self.chain_name = settings['chain']
         self.settings = settings
-        self.th = None
+        self.snapshot = None
+        # table name -> IPTablesSnapshot, for the tables of all block profiles
+        self.snapshots = {}
         self.rule_pos = None
 
     def test_prereqs(self):
-        self.check_int_check_every()
+        self.check_settings()
         self.check_root()
         self.check_command_availability()
+        self.check_ipset_types()
         self.check_table_and_chain()
         self.check_pidfile_process()
-        self.check_rule_pos_setting()
         self.check_rule_pos()
 
+    def check_settings(self):
+        """Checks of the setting values alone, also run when the configuration is reloaded."""
+        self.check_int_check_every()
+        self.check_int_min_check_every()
+        self.check_resolve_settings()
+        self.check_resolve_rate()
+        self.check_resolve_nameservers()
+        self.check_resolve_backoff()
+        self.check_rebuild_threshold()
+        self.check_entry_timeout()
+        self.check_aggregation_settings()
+        self.check_dns_proxy_settings()
+        self.check_ipset_backend()
+        self.check_watch_config()
+        self.check_state_settings()
+        self.check_metrics_settings()
+        self.check_control_socket()
+        self.check_publish_settings()
+        self.check_rule_pos_setting()
+        self.check_profiles()
+        self.check_firewall()
+
+    def check_watch_config(self):
+        try:
+            self.settings['watch_config'] = parse_bool(self.settings.get('watch_config', 'no'))
+        except ValueError:
+            raise IncorrectWatchConfig(self.settings.get('watch_config'))
+
+    def check_state_settings(self):
+        try:
+            self.settings['keep_on_shutdown'] = parse_bool(self.settings.get('keep_on_shutdown', 'no'))
+        except ValueError:
+            raise IncorrectStateSetting('keep_on_shutdown: {}'.format(self.settings.get('keep_on_shutdown')))
+        state_file = self.settings.get('state_file')
+        if state_file and not os.path.isdir(os.path.dirname(os.path.abspath(state_file))):
+            raise IncorrectStateSetting('state_file: directory of {} does not exist'.format(state_file))
+
+    def check_profiles(self):
+        """Check the [profile:NAME] sections; table, chain and rule_pos default to the ones of [main]."""
+        profiles = self.settings.get('profiles', {})
+        ipsets = set([self.settings['ipset'], whitelist_ipset_name])
+        for name in sorted(profiles):
+            profile = profiles[name]
+            if not name or name == 'main':
+                raise IncorrectProfileSetting('profile name "{}"'.format(name))
+            for key in ('ipset', 'domains'):
+                if not profile.get(key):
+                    raise IncorrectProfileSetting('{}: {} is not set'.format(name, key))
+            if isinstance(profile['domains'], basestring):
+                profile['domains'] = [profile['domains']]
+            if profile['ipset'] in ipsets:
+                raise IncorrectProfileSetting('{}: ipset {} is used by another profile'.format(name, profile['ipset']))
+            ipsets.add(profile['ipset'])
+            profile.setdefault('table', self.settings['table'])
+            profile.setdefault('chain', self.settings['chain'])
+            profile['target'] = profile.get('target', 'DROP').strip().upper()
+            if profile['target'] not in ('DROP', 'REJECT'):
+                raise IncorrectProfileSetting('{}: target {}'.format(name, profile['target']))
+            rpos = profile.get('rule_pos', self.settings.get('rule_pos', 0))
+            try:
+                profile['rule_pos'] = int(rpos)
+            except ValueError:
+                raise IncorrectProfileSetting('{}: rule_pos {}'.format(name, rpos))
+            if profile['rule_pos'] < 0:
+                raise IncorrectProfileSetting('{}: rule_pos {}'.format(name, rpos))
+
+    def check_control_socket(self):
+        path = self.settings.get('control_socket')
+        if path and not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+            raise IncorrectControlSocket('directory of {} does not exist'.format(path))
+
+    def check_publish_settings(self):
+        for key in ('publish', 'follow'):
+            if self.settings.get(key):
+                try:
+                    self.settings[key] = parse_endpoint(self.settings[key])
+                except ValueError:
+                    raise IncorrectPublishSetting('{}: {}'.format(key, self.settings[key]))
+                if self.settings[key][0] == 'unix' and not os.path.isdir(os.path.dirname(self.settings[key][1])):
+                    raise IncorrectPublishSetting('{}: directory of {} does not exist'.format(
+                        key, self.settings[key][1]))
+        if self.settings.get('publish') and self.settings.get('follow'):
+            raise IncorrectPublishSetting('a follower cannot publish')
+
+    def check_metrics_settings(self):
+        port = self.settings.get('metrics_port', 0) or 0
+        try:
+            port = int(port)
+        except ValueError:
+            raise IncorrectMetricsSetting('metrics_port: {}'.format(port))
+        if not 0 <= port <= 65535:
+            raise IncorrectMetricsSetting('metrics_port: {}'.format(port))
+        self.settings['metrics_port'] = port
+        try:
+            self.settings['metrics_per_domain'] = parse_bool(self.settings.get('metrics_per_domain', 'no'))
+        except ValueError:
+            raise IncorrectMetricsSetting('metrics_per_domain: {}'.format(self.settings.get('metrics_per_domain')))
+        textfile = self.settings.get('metrics_textfile')
+        if textfile and not os.path.isdir(os.path.dirname(os.path.abspath(textfile))):
+            raise IncorrectMetricsSetting('metrics_textfile: directory of {} does not exist'.format(textfile))
+
+    def check_ipset_backend(self):
+        backend = self.settings.get('ipset_backend', 'cli').strip().lower()
+        if backend not in ipset_backends:
+            raise IncorrectIPSetBackend(backend)
+        self.settings['ipset_backend'] = backend
+
+    def check_firewall(self):
+        firewall = self.settings.get('firewall', 'iptables').strip().lower()
+        if firewall not in ('iptables', 'nftables'):
+            raise IncorrectFirewallSetting(firewall)
+        self.settings['firewall'] = firewall
+        if firewall != 'nftables':
+            return
+        table = self.settings.get('nft_table', 'blocky').strip()
+        if not table or not table.replace('_', '').isalnum():
+            raise IncorrectFirewallSetting('nft_table: {}'.format(table))
+        self.settings['nft_table'] = table
+        if self.settings.get('ipset_entry_timeout') and (self.settings.get('aggregate_min_prefix') or
+                                                         self.settings.get('networks')):
+            # interval sets with timeouts are not merged, an aggregated prefix covering an entry of the set
+            # would fail the whole transaction
+            raise IncorrectFirewallSetting('ipset_entry_timeout cannot be combined with networks or '
+                                           'aggregate_min_prefix')
+        for name, profile in block_profiles(self.settings):
+            if profile['table'].upper() not in nftables.PRIORITIES:
+                raise IncorrectFirewallSetting('table {} has no nftables counterpart'.format(profile['table']))
+            if profile['chain'] not in nftables.HOOKS:
+                raise IncorrectFirewallSetting('chain {} is not a built-in chain'.format(profile['chain']))
+
     def check_command_availability(self):
-        for cmd, args in [('iptables', '-L -n'), ('ipset', '-L -n')]:
+        # version probes only: listing the rules or sets costs seconds on hosts with large rulesets, and the
+        # table and chain are checked through libiptc anyway
+        if self.settings.get('firewall') == 'nftables':
+            commands_needed = [('nft', '--version')]
+        else:
+            commands_needed = [('iptables', '--version')]
+        if self.settings.get('ipset_backend', 'cli') == 'cli' and self.settings.get('firewall') != 'nftables':
+            commands_needed.append(('ipset', 'version'))
+        for cmd, args in commands_needed:
             status, err = commands.getstatusoutput('{} {}'.format(cmd, args))
             if status:
                 print >> sys.stderr, 'ERROR command {} is missing or otherwise unavailable, exit status: {}, error: {}'.format(
                     cmd, status, err)
                 sys.exit(status)
 
+    def check_ipset_types(self, backend=None):
+        """Sets left behind by an earlier run (e.g. with keep_on_shutdown) are reused, but one of another type
+        than the configuration needs cannot be swapped with the sets rebuilt for it."""
+        if self.settings.get('firewall') == 'nftables':
+            return
+        set_type = 'hash:net' if self.settings.get('aggregate_min_prefix') or self.settings.get('networks') \
+            else 'hash:ip'
+        backend = backend or ipset_backends[self.settings.get('ipset_backend', 'cli')]()
+        for name, profile in block_profiles(self.settings):
+            existing = backend.set_type(profile['ipset'])
+            if existing and existing != set_type:
+                raise IncorrectIPSetType('ipset {} is a {} set, the configuration needs a {} one; destroy it with '
+                                         "'ipset destroy {}' or change networks/aggregate_min_prefix".format(
+                                             profile['ipset'], existing, set_type, profile['ipset']))
+
     def check_root(self):
         if os.geteuid():
             print >> sys.stderr, 'This program has to be ran by root. Abort.'
             sys.exit(1)
 
     def check_table_and_chain(self):
-        self.th = IPTablesHandler(table_name=self.table_name, chain_name=self.chain_name)
-        self.th._chain_find()
+        if self.settings.get('firewall') == 'nftables':
+            # blocky creates its own nftables chains
+            return
+        for name, profile in block_profiles(self.settings):
+            if profile['table'] not in self.snapshots:
+                self.snapshots[profile['table']] = IPTablesSnapshot(profile['table'])
+            self.snapshots[profile['table']].chain(profile['chain'])
+        self.snapshot = self.snapshots[self.table_name]
 
     def check_int_check_every(self):
         cev = self.settings.get('check_every')
@@ -404,6 +1926,157 @@ class StartupChecks(object):
             raise IncorrectCheckEvery(cev)
         self.settings['check_every'] = cev
 
+    def check_int_min_check_every(self):
+        cev = self.settings['check_every']
+        mcev = self.settings.get('min_check_every', min(10, cev))
+        try:
+            mcev = int(mcev)
+        except ValueError:
+            raise IncorrectMinCheckEvery(mcev)
+        if mcev <= 0 or mcev > cev:
+            raise IncorrectMinCheckEvery(mcev)
+        self.settings['min_check_every'] = mcev
+
+    def check_resolve_settings(self):
+        conc = self.settings.get('resolve_concurrency', 1)
+        try:
+            conc = int(conc)
+        except ValueError:
+            raise IncorrectResolveConcurrency(conc)
+        if conc <= 0:
+            raise IncorrectResolveConcurrency(conc)
+        self.settings['resolve_concurrency'] = conc
+        tmout = self.settings.get('resolve_timeout')
+        if tmout is None:
+            return
+        try:
+            tmout = float(tmout)
+        except ValueError:
+            raise IncorrectResolveTimeout(tmout)
+        if tmout <= 0:
+            raise IncorrectResolveTimeout(tmout)
+        self.settings['resolve_timeout'] = tmout
+
+    def check_resolve_rate(self):
+        rate = self.settings.get('resolve_rate')
+        if rate is not None:
+            try:
+                rate = float(rate)
+            except ValueError:
+                raise IncorrectResolveRate(rate)
+            if rate <= 0:
+                raise IncorrectResolveRate(rate)
+            self.settings['resolve_rate'] = rate
+        try:
+            self.settings['resolve_smear'] = parse_bool(self.settings.get('resolve_smear', 'no'))
+        except ValueError:
+            raise IncorrectResolveRate('resolve_smear: {}'.format(self.settings.get('resolve_smear')))
+
+    def check_resolve_nameservers(self):
+        value = self.settings.get('resolve_nameservers')
+        if value is None:
+            return
+        names = parse_comma_separated(value) if isinstance(value, basestring) else value
+        for name in names:
+            if name == 'system':
+                continue
+            try:
+                host, port = parse_host_port(name)
+            except ValueError:
+                raise IncorrectResolveNameservers(name)
+            if not 0 < port < 65536 or not is_ip_address(host):
+                raise IncorrectResolveNameservers(name)
+        if len(set(names)) != len(names):
+            raise IncorrectResolveNameservers('duplicate nameserver in {}'.format(', '.join(names)))
+        self.settings['resolve_nameservers'] = names
+
+    def check_resolve_backoff(self):
+        for key in ('resolve_max_backoff', 'resolve_grace'):
+            value = self.settings.get(key, 3600)
+            try:
+                value = int(value)
+            except ValueError:
+                raise IncorrectResolveBackoff('{}: {}'.format(key, value))
+            if value < 0:
+                raise IncorrectResolveBackoff('{}: {}'.format(key, value))
+            self.settings[key] = value
+
+    def check_rebuild_threshold(self):
+        thr = self.settings.get('ipset_rebuild_threshold', 0.5)
+        try:
+            thr = float(thr)
+        except ValueError:
+            raise IncorrectRebuildThreshold(thr)
+        if thr < 0:
+            raise IncorrectRebuildThreshold(thr)
+        self.settings['ipset_rebuild_threshold'] = thr
+
+    def check_entry_timeout(self):
+        tmout = self.settings.get('ipset_entry_timeout')
+        if tmout is None:
+            return
+        try:
+            tmout = int(tmout)
+        except ValueError:
+            raise IncorrectEntryTimeout(tmout)
+        if tmout == 0:
+            self.settings['ipset_entry_timeout'] = None
+            return
+        # entries are refreshed after half their timeout, on a loop that may sleep up to check_every seconds
+        if tmout <= 2 * self.settings['check_every']:
+            raise IncorrectEntryTimeout(tmout)
+        self.settings['ipset_entry_timeout'] = tmout
+
+    def check_aggregation_settings(self):
+        networks = self.settings.get('networks', [])
+        if isinstance(networks, basestring):
+            networks = parse_comma_separated(networks)
+        for network in networks:
+            try:
+                parse_network(network)
+            except ValueError:
+                raise IncorrectAggregationSetting('networks: {}'.format(network))
+        self.settings['networks'] = networks
+        min_prefix = self.settings.get('aggregate_min_prefix')
+        if min_prefix is not None:
+            try:
+                min_prefix = int(min_prefix)
+            except ValueError:
+                raise IncorrectAggregationSetting('aggregate_min_prefix: {}'.format(min_prefix))
+            if not 1 <= min_prefix <= 32:
+                raise IncorrectAggregationSetting('aggregate_min_prefix: {}'.format(min_prefix))
+            self.settings['aggregate_min_prefix'] = min_prefix
+        density = self.settings.get('aggregate_density', 0.5)
+        try:
+            density = float(density)
+        except ValueError:
+            raise IncorrectAggregationSetting('aggregate_density: {}'.format(density))
+        if not 0 < density <= 1:
+            raise IncorrectAggregationSetting('aggregate_density: {}'.format(density))
+        self.settings['aggregate_density'] = density
+
+    def check_dns_proxy_settings(self):
+        try:
+            enabled = parse_bool(self.settings.get('dns_proxy', 'no'))
+        except ValueError:
+            raise IncorrectDNSProxySetting('dns_proxy: {}'.format(self.settings.get('dns_proxy')))
+        self.settings['dns_proxy'] = enabled
+        if not enabled:
+            return
+        port = self.settings.get('dns_proxy_port', 53)
+        try:
+            port = int(port)
+        except ValueError:
+            raise IncorrectDNSProxySetting('dns_proxy_port: {}'.format(port))
+        if not 0 < port < 65536:
+            raise IncorrectDNSProxySetting('dns_proxy_port: {}'.format(port))
+        self.settings['dns_proxy_port'] = port
+        upstream = self.settings.get('dns_proxy_upstream') or resolver.Resolver().nameservers[0]
+        try:
+            self.settings['dns_proxy_upstream'] = parse_host_port(upstream)
+        except ValueError:
+            raise IncorrectDNSProxySetting('dns_proxy_upstream: {}'.format(upstream))
+
     def check_rule_pos_setting(self):
         rpos = self.settings.get('rule_pos', 0)
         msg = 'Incorrect rule position (rule_pos setting, set currently to: {}). Abort.'.format(rpos)
@@ -443,56 +2116,584 @@ class StartupChecks(object):
                 return
 
     def check_rule_pos(self):
-        rules = self.th.rules()
-        if self.rule_pos > len(rules):
-            raise IncorrectRulePosition('Rule position ({}) is too high in IPTables chain (no of rules: {}). Abort.'.format(self.rule_pos, len(rules)))
+        if self.settings.get('firewall') == 'nftables':
+            return
+        count = self.snapshot.rule_count(self.chain_name)
+        if self.rule_pos > count:
+            raise IncorrectRulePosition('Rule position ({}) is too high in IPTables chain (no of rules: {}). Abort.'.format(self.rule_pos, count))
+        for name, profile in block_profiles(self.settings)[1:]:
+            count = self.snapshots[profile['table']].rule_count(profile['chain'])
+            if profile['rule_pos'] > count:
+                raise IncorrectRulePosition('Rule position ({}) of profile {} is too high in IPTables chain {} (no of rules: {}). Abort.'.format(
+                    profile['rule_pos'], name, profile['chain'], count))
+
+
+
+class Wakeup(object):
+    """Self-pipe the main loop sleeps on, so that control requests and signals end the sleep right away.
+
+    set() is safe to call from other threads and from signal handlers.
+    """
+
+    def __init__(self):
+        self._r, self._w = os.pipe()
+        for fd in (self._r, self._w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def set(self):
+        try:
+            os.write(self._w, 'x')
+        except OSError as e:
+            # a full pipe has wakeups pending already
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def wait(self, timeout):
+        """Sleep up to timeout seconds, return True if woken up early."""
+        try:
+            ready = select.select([self._r], [], [], max(0, timeout))[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return True
+        if not ready:
+            return False
+        try:
+            while os.read(self._r, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        return True
+
 
+class BlockProfile(object):
+    """Domains blocked through one ipset and the iptables rule matching it."""
+
+    def __init__(self, name, domains, ipset_handler, iptables_handler=None, whitelist_handler=None):
+        self.name = name
+        self.ipset_handler = ipset_handler
+        self.iptables_handler = iptables_handler
+        self.whitelist_handler = whitelist_handler
+        self.set_domains(domains)
+
+    def set_domains(self, domains):
+        self.domains = list(domains)
+        self._domain_set = set(domains)
+        # matches the (normalized) domains reported by the DNS proxy
+        self.index = SuffixIndex(domains)
+
+    def affected_by(self, fqdns):
+        return not self._domain_set.isdisjoint(fqdns)
 
 
 class BlockManager(object):
-    def __init__(self, settings):
+    # settings applied to a running BlockManager by reload(), changes to the others need a restart
+    reloadable_settings = ['domains', 'whitelist_local_ips', 'networks', 'aggregate_min_prefix', 'aggregate_density',
+                           'check_every', 'min_check_every', 'resolve_concurrency', 'resolve_timeout', 'resolve_rate',
+                           'resolve_nameservers', 'resolve_max_backoff', 'resolve_grace', 'log_level', 'watch_config',
+                           'profiles']
+
+    def __init__(self, settings, snapshots=None, started=None):
         self.settings = settings
-        self.iptables_handler = None
-        self.ipset_handler = None
+        # table name -> IPTablesSnapshot
+        self.snapshots = snapshots if snapshots is not None else {}
+        # NFTables of blocky's table, when nftables is the firewall
+        self.nft = NFTables(settings.get('nft_table', 'blocky')) if settings.get('firewall') == 'nftables' else None
+        self.started = time.time() if started is None else started
+        self.startup_time = None
+        self.profiles = []
+        self.wakeup = None
+        self.next_wakeup = None
+        self.control_server = None
+        # (request, reply) of control requests that change state, run by the main loop between cycles
+        self._commands = Queue.Queue()
+        self.dns_proxy = None
+        # AnswerPublisher of a leader, AnswerFollower of a follower
+        self.publisher = None
+        self.follower = None
+        # (answers, removed, snapshot) received by the follower, applied by the main loop
+        self._followed = Queue.Queue()
+        self.metrics_server = None
+        self.aggregator = None
+        self.detect = None
+        self.state = None
+        self.reload_requested = False
+        self._source_mtimes = {}
 
     def run(self):
-        init_rule_pos = int(self.settings.get('rule_pos', 0))
-        # Local IP Whitelist ipset
-        self.local_whitelist_ipset_handler = IPSetHandler(ipset_name=whitelist_ipset_name)
+        # created here rather than in __init__, daemonizing closes the open files
+        self.wakeup = Wakeup()
+        if self.nft:
+            # the table, chains, sets and rules are created in one transaction
+            self.nft.begin()
+        # Local IP Whitelist ipset, matched by a rule in the chain of every profile
+        self.local_whitelist_ipset_handler = IPSetHandler(ipset_name=whitelist_ipset_name,
+                                                          backend=self.ipset_backend())
         self.local_whitelist_ipset_handler.create_ipset()
-        # Local IP Whitelist iptables rule
-        self.local_whitelist_iptables_handler = IPTablesHandler(table_name=self.settings['table'],
-                                                chain_name=self.settings['chain'],
-                                                ipset_name=whitelist_ipset_name,
-                                                match_set_flag='dst',
-                                                rule_pos=init_rule_pos,
-                                                comment='Blocky Whitelist IPTables Rule',
-                                                target='ACCEPT')
-        self.local_whitelist_iptables_handler.insert_rule()
         self.local_whitelist_ipset_handler.update_ipset(iplist=parse_comma_separated(self.settings.get('whitelist_local_ips', '')))
-        # Create blocking ipset
-        self.ipset_handler = IPSetHandler(ipset_name=self.settings['ipset'])
-        self.ipset_handler.create_ipset()
-        # Insert blocking iptables rule
-        self.iptables_handler = IPTablesHandler(table_name=self.settings['table'],
-                                                chain_name=self.settings['chain'],
-                                                ipset_name=self.settings['ipset'],
-                                                rule_pos=init_rule_pos+1)
-        self.iptables_handler.insert_rule()
+        if self.settings.get('aggregate_min_prefix') or self.settings.get('networks'):
+            self.aggregator = Aggregator(min_prefix_len=self.settings.get('aggregate_min_prefix') or 32,
+                                         density=self.settings.get('aggregate_density', 0.5),
+                                         networks=self.settings.get('networks', []))
+        self.profiles = [self.create_profile(name, profile) for name, profile in block_profiles(self.settings)]
+        if self.nft:
+            self.nft.commit()
         delay = self.settings['check_every']
         log.debug('check_every: %s', delay)
-        detect = DetectIPAddresses(fqdns=self.settings['domains'])
+        # domains of several profiles are resolved once; a follower takes the answers of its leader instead
+        fqdns = [] if self.settings.get('follow') else all_domains(self.settings)
+        self.detect = detect = DetectIPAddresses(fqdns=fqdns,
+                                   concurrency=self.settings.get('resolve_concurrency', 1),
+                                   query_timeout=self.settings.get('resolve_timeout'),
+                                   min_refresh=self.settings.get('min_check_every', delay),
+                                   max_refresh=delay,
+                                   rate=self.settings.get('resolve_rate'),
+                                   nameservers=self.settings.get('resolve_nameservers'),
+                                   max_backoff=self.settings.get('resolve_max_backoff', 3600),
+                                   grace=self.settings.get('resolve_grace', 3600),
+                                   per_domain_metrics=self.settings.get('metrics_per_domain', False))
+        if self.settings.get('resolve_smear'):
+            detect.spread(time.time(), delay)
+        if self.settings.get('state_file'):
+            self.state = StateFile(self.settings['state_file'])
+            self.warm_start()
+        if self.settings.get('dns_proxy'):
+            self.dns_proxy = DNSProxy(domains=all_domains(self.settings),
+                                      upstream=self.settings['dns_proxy_upstream'],
+                                      on_match=partial(self.block_observed, delay),
+                                      address=self.settings.get('dns_proxy_address', '127.0.0.1'),
+                                      port=self.settings['dns_proxy_port'])
+            self.dns_proxy.start()
+        if self.settings.get('metrics_port'):
+            self.metrics_server = MetricsServer(registry, address=self.settings.get('metrics_address', '127.0.0.1'),
+                                                port=self.settings['metrics_port'])
+            self.metrics_server.start()
+        if self.settings.get('control_socket'):
+            self.control_server = ControlServer(self.settings['control_socket'], self.control)
+            self.control_server.start()
+        if self.settings.get('publish'):
+            self.publisher = AnswerPublisher(self.settings['publish'])
+            self.publisher.start()
+            # the answers seeded from the state file go out with the first changes
+            detect.unpublished = set(detect.answers)
+        if self.settings.get('follow'):
+            self.follower = AnswerFollower(self.settings['follow'], self.followed)
+            self.follower.start()
+            log.info('Following the answers of %s', format_endpoint(self.settings['follow']))
         setproctitle(proc_title)
         self.log_startup_notice()
-        cnt = 1
+        self.startup_time = time.time() - self.started
+        log.info('Startup completed in %.3fs', self.startup_time)
+        startup_seconds.set(self.startup_time)
+        self.source_files_changed()
+        last_logged = time.time()
         while True:
-            iplist = detect.iplist()
-            if cnt % 10 == 0:
-                log.info('Blocked IP addresses: %s', ', '.join(map(str, iplist)))
-                cnt = 0
-            cnt += 1
-            self.ipset_handler.update_ipset(iplist)
-            time.sleep(delay)
+            if self.reload_requested or (self.settings.get('watch_config') and self.source_files_changed()):
+                self.reload_requested = False
+                self.reload()
+                delay = self.settings['check_every']
+            self.run_commands()
+            if self.follower:
+                self.apply_followed()
+            self.resolve_and_apply()
+            if self.publisher:
+                self.publish_answers()
+            if time.time() - last_logged >= 10 * delay:
+                for profile in self.profiles:
+                    iplist = profile.ipset_handler.iplist_prev
+                    log.info('Blocking %d IP addresses of %d domains (profile %s)', len(iplist),
+                             len(profile.domains), profile.name)
+                    if log.isEnabledFor(logging.DEBUG):
+                        log.debug('Blocked IP addresses (profile %s): %s', profile.name, ', '.join(iplist))
+                failing = detect.health.failing()
+                if failing:
+                    log.warn('%d domains keep failing to resolve: %s', len(failing), format_items(sorted(failing)))
+                last_logged = time.time()
+            due = detect.next_due()
+            self.next_wakeup = time.time() + delay if due is None else due
+            self.wakeup.wait(self.next_wakeup - time.time())
+
+    def rule_handler(self, **kwargs):
+        """IPTablesHandler, or NFTablesRuleHandler when nftables is the firewall."""
+        if self.nft:
+            return NFTablesRuleHandler(self.nft, **kwargs)
+        table_name = kwargs['table_name']
+        if table_name not in self.snapshots:
+            self.snapshots[table_name] = IPTablesSnapshot(table_name)
+        return IPTablesHandler(snapshot=self.snapshots[table_name], **kwargs)
+
+    def create_profile(self, name, profile):
+        """Create the ipset of a profile and insert its whitelist and blocking rules."""
+        # profiles sharing a chain share its whitelist rule, it is found by its comment
+        whitelist_handler = self.rule_handler(table_name=profile['table'],
+                                                chain_name=profile['chain'],
+                                                ipset_name=whitelist_ipset_name,
+                                                match_set_flag='dst',
+                                                rule_pos=profile['rule_pos'],
+                                                comment='Blocky Whitelist IPTables Rule',
+                                                target='ACCEPT')
+        whitelist_handler.insert_rule()
+        ipset_handler = IPSetHandler(ipset_name=profile['ipset'],
+                                     rebuild_threshold=self.settings.get('ipset_rebuild_threshold', 0.5),
+                                     backend=self.ipset_backend(),
+                                     entry_timeout=self.settings.get('ipset_entry_timeout'),
+                                     set_type='hash:net' if self.aggregator else 'hash:ip',
+                                     expected=len(profile['domains']) * expected_addresses_per_domain)
+        ipset_handler.create_ipset()
+        comment = 'Blocky IPTables Rule' if name == 'main' else 'Blocky IPTables Rule ({})'.format(name)
+        iptables_handler = self.rule_handler(table_name=profile['table'],
+                                             chain_name=profile['chain'],
+                                             ipset_name=profile['ipset'],
+                                             rule_pos=profile['rule_pos'] + 1,
+                                             comment=comment,
+                                             target=profile['target'])
+        iptables_handler.insert_rule()
+        return BlockProfile(name, profile['domains'], ipset_handler, iptables_handler, whitelist_handler)
+
+    def update_profile(self, profile):
+        profile.ipset_handler.update_ipset(self.blocked_entries(self.detect.addresses(profile.domains)))
+
+    def followed(self, answers, removed, snapshot):
+        """Receives the messages of the AnswerFollower, they are applied by the main loop."""
+        self._followed.put((answers, removed, snapshot))
+        if self.wakeup:
+            self.wakeup.set()
+
+    def apply_followed(self, now=None):
+        """Take the answers received from the leader and update the ipsets of the profiles they belong to, return
+        the changed domains."""
+        changed = set()
+        while True:
+            try:
+                answers, removed, snapshot = self._followed.get_nowait()
+            except Queue.Empty:
+                break
+            if snapshot:
+                removed = [fqdn for fqdn in self.detect.answers if fqdn not in answers]
+            changed.update(self.detect.set_answers(answers, removed, now))
+        if self.follower and self.follower.version is not None:
+            answers_version.set(self.follower.version)
+        for profile in self.profiles:
+            if profile.affected_by(changed):
+                self.update_profile(profile)
+        if changed and self.state:
+            self.save_state()
+        return changed
+
+    def publish_answers(self):
+        """Send the answers changed since the last call to the followers, return whether there were any."""
+        changed, self.detect.unpublished = self.detect.unpublished, set()
+        if not self.publisher.publish(self.detect.answers, changed):
+            return False
+        answers_version.set(self.publisher.version)
+        return True
+
+    def resolve_and_apply(self, now=None):
+        """One cycle of the main loop: resolve the due domains and update the ipsets of the profiles they belong
+        to, return the changed domains."""
+        changed = self.detect.resolve_due(now)
+        for profile in self.profiles:
+            # with the DNS proxy on, addresses it pinned may have expired even if no answer changed; with entry
+            # timeouts the addresses still observed have to be refreshed before the kernel expires them
+            if profile.affected_by(changed) or self.dns_proxy or profile.ipset_handler.entry_timeout:
+                self.update_profile(profile)
+        if changed and self.state:
+            self.save_state()
+        if self.settings.get('metrics_textfile'):
+            self.write_metrics()
+        return changed
+
+    # control requests answered right away from the control thread, they only read state; the others are run by
+    # the main loop, which has to pick them up within control_timeout seconds
+    control_queries = ['status', 'set', 'answers', 'failing', 'why']
+    control_timeout = 120
+
+    def control(self, request):
+        """Handle a control socket request, see blocky.control."""
+        command = request['command']
+        args = dict((str(k), v) for k, v in request.items() if k != 'command')
+        if command in self.control_queries:
+            return getattr(self, 'ctl_' + command)(**args)
+        if not hasattr(self, 'ctl_' + command):
+            raise ControlError('unknown command {}'.format(command))
+        reply = {'done': threading.Event()}
+        self._commands.put((command, args, reply))
+        self.wakeup.set()
+        if not reply['done'].wait(self.control_timeout):
+            raise ControlError('{} was not run within {}s'.format(command, self.control_timeout))
+        if 'error' in reply:
+            raise ControlError(reply['error'])
+        return reply['result']
+
+    def run_commands(self):
+        """Run the queued control requests that change state."""
+        while True:
+            try:
+                command, args, reply = self._commands.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                reply['result'] = getattr(self, 'ctl_' + command)(**args)
+            except Exception as e:
+                log.error('Control request %s failed: %s', command, e)
+                reply['error'] = str(e) or e.__class__.__name__
+            reply['done'].set()
+
+    def _profile(self, name):
+        for profile in self.profiles:
+            if profile.name == name:
+                return profile
+        raise ControlError('no profile {}'.format(name))
+
+    def _profile_settings(self, name):
+        return self.settings if name == 'main' else self.settings['profiles'][name]
+
+    def ctl_status(self):
+        done, total, elapsed = self.detect.progress()
+        return {'startup_time': self.startup_time,
+                'last_cycle_time': self.detect.last_cycle_time,
+                'last_sweep_time': self.detect.last_sweep_time,
+                'sweep': {'resolved': done, 'domains': total, 'elapsed': elapsed},
+                'next_wakeup': self.next_wakeup,
+                'nameservers': dict((ns.name, ns.status()) for ns in self.detect.nameservers),
+                'failing': len(self.detect.health.failing()),
+                'profiles': dict((p.name, {'ipset': p.ipset_handler.ipset_name, 'domains': len(p.domains),
+                                           'entries': len(p.ipset_handler.iplist_prev),
+                                           'maxelem': p.ipset_handler.maxelem}) for p in self.profiles),
+                'whitelist': list(self.local_whitelist_ipset_handler.iplist_prev),
+                'publish': self.publisher and {'version': self.publisher.version,
+                                               'followers': len(self.publisher.followers)},
+                'follow': self.follower and {'leader': format_endpoint(self.follower.endpoint),
+                                             'version': self.follower.version}}
+
+    def ctl_set(self, profile='main'):
+        return list(self._profile(profile).ipset_handler.iplist_prev)
+
+    def ctl_answers(self, domains=None):
+        answers = dict(self.detect.answers)
+        resolved_at = dict(self.detect.resolved_at)
+        return dict((fqdn, {'addresses': list(answers[fqdn]), 'resolved_at': resolved_at.get(fqdn)})
+                    for fqdn in domains or answers.keys() if fqdn in answers)
+
+    def ctl_failing(self):
+        return self.detect.health.failing()
+
+    def ctl_why(self, addresses):
+        """Domains each of addresses was seen for, with the time it was last seen, and the profiles blocking it."""
+        return dict((address, {'domains': self.detect.index.owners(address),
+                               'profiles': [p.name for p in self.profiles
+                                            if p.ipset_handler.iplist_prev.covers(address)]})
+                    for address in addresses)
+
+    def ctl_refresh(self, domains=None):
+        known = set(self.detect.fqdns)
+        unknown = [fqdn for fqdn in domains or [] if fqdn not in known]
+        if unknown:
+            raise ControlError('not blocked: {}'.format(', '.join(unknown)))
+        log.info('Control: resolving %s now', format_items(domains) if domains else 'all domains')
+        changed = self.detect.refresh(list(domains or self.detect.fqdns))
+        for profile in self.profiles:
+            if profile.affected_by(changed):
+                self.update_profile(profile)
+        return sorted(changed)
+
+    def ctl_add(self, domains, profile='main'):
+        """Block domains in a profile until the next reload; they are resolved right after this."""
+        target = self._profile(profile)
+        conf = self._profile_settings(profile)
+        added = [d for d in parse_comma_separated(','.join(domains)) if d not in target.domains]
+        if not added:
+            return []
+        log.info('Control: blocking %s in profile %s', format_items(added), profile)
+        conf['domains'] = list(conf['domains']) + added
+        target.set_domains(conf['domains'])
+        if not self.follower:
+            self.detect.add_fqdns(added)
+        if self.dns_proxy:
+            for domain in added:
+                self.dns_proxy.index.add(domain)
+        # domains already blocked by another profile have answers to use
+        self.update_profile(target)
+        return added
+
+    def ctl_remove(self, domains, profile='main'):
+        target = self._profile(profile)
+        conf = self._profile_settings(profile)
+        removed = [d for d in domains if d in target.domains]
+        if not removed:
+            return []
+        log.info('Control: no longer blocking %s in profile %s', format_items(removed), profile)
+        conf['domains'] = [d for d in conf['domains'] if d not in removed]
+        target.set_domains(conf['domains'])
+        still_blocked = set(all_domains(self.settings))
+        gone = [d for d in removed if d not in still_blocked]
+        released = self.detect.remove_fqdns([] if self.follower else gone)
+        if released:
+            log.info('Control: %d IP addresses no longer resolved by any blocked domain: %s', len(released),
+                     format_items(released))
+        if self.dns_proxy:
+            for domain in gone:
+                self.dns_proxy.index.discard(domain)
+        self.update_profile(target)
+        return removed
+
+    def _set_whitelist(self, addresses):
+        # the setting is only changed once the set took the addresses
+        self.local_whitelist_ipset_handler.update_ipset(iplist=list(addresses))
+        self.settings['whitelist_local_ips'] = ', '.join(addresses)
+        return list(self.local_whitelist_ipset_handler.iplist_prev)
+
+    def ctl_whitelist_add(self, addresses):
+        invalid = []
+        for address in addresses:
+            try:
+                parse_network(address)
+            except ValueError:
+                invalid.append(address)
+        if invalid:
+            raise ControlError('not an IP address: {}'.format(', '.join(invalid)))
+        current = parse_comma_separated(self.settings.get('whitelist_local_ips', ''))
+        return self._set_whitelist(current + [ip for ip in addresses if ip not in current])
+
+    def ctl_whitelist_remove(self, addresses):
+        current = parse_comma_separated(self.settings.get('whitelist_local_ips', ''))
+        return self._set_whitelist([ip for ip in current if ip not in addresses])
+
+    def warm_start(self):
+        """Fill the ipset from the state file, the domains are then resolved again as usual."""
+        answers, resolved_at, saved = self.state.load()
+        if not answers:
+            return
+        self.detect.seed(answers, resolved_at)
+        log.info('Warm start: %d IP addresses of %d domains from state file %s (saved %.0fs ago)',
+                 len(self.detect.addresses()), len([fqdn for fqdn in answers if fqdn in self.detect.answers]),
+                 self.state.path, time.time() - saved)
+        for profile in self.profiles:
+            self.update_profile(profile)
+
+    def write_metrics(self):
+        try:
+            write_textfile(registry, self.settings['metrics_textfile'])
+        except (IOError, OSError) as e:
+            log.error('Could not write metrics file %s: %s', self.settings['metrics_textfile'], e)
+
+    def save_state(self):
+        try:
+            self.state.save(self.detect.answers, self.detect.resolved_at)
+        except (IOError, OSError) as e:
+            log.error('Could not save state file %s: %s', self.state.path, e)
+
+    def source_files_changed(self):
+        """Whether the config file or one of the @files changed since the last call."""
+        mtimes = {}
+        for path in self.settings.source_files:
+            try:
+                mtimes[path] = os.stat(path).st_mtime
+            except OSError:
+                mtimes[path] = None
+        changed = mtimes != self._source_mtimes
+        self._source_mtimes = mtimes
+        return changed
+
+    def reload(self):
+        """Re-read the config file and apply what changed without touching the iptables rules or ipsets."""
+        log.info('Reloading configuration from %s', self.settings._config_file)
+        try:
+            settings = Settings(config_file=self.settings._config_file)
+            StartupChecks(settings).check_settings()
+        except SettingsError as e:
+            log.error('Configuration not reloaded, keeping the running one. %s: %s', e.__class__.__name__, e)
+            return
+        old, self.settings = self.settings, settings
+        self._keep_profiles(old, settings)
+        if not self.aggregator and (settings.get('aggregate_min_prefix') or settings.get('networks')):
+            log.warn('Aggregation and networks need a hash:net ipset, restart blocky to apply them')
+            self._keep_setting(old, settings, 'networks')
+            self._keep_setting(old, settings, 'aggregate_min_prefix')
+        for key in sorted(set(old.keys()) | set(settings.keys())):
+            if key not in self.reloadable_settings and old.get(key) != settings.get(key):
+                log.warn('Setting %s changed, restart blocky to apply it', key)
+                self._keep_setting(old, settings, key)
+        self.apply_settings(old, settings)
+        self.source_files_changed()
+
+    def _keep_profiles(self, old, new):
+        # only the domains of a profile can change without a restart
+        kept = {}
+        for name, profile in old.get('profiles', {}).items():
+            kept[name] = dict(profile)
+            if name in new.get('profiles', {}):
+                kept[name]['domains'] = new['profiles'][name]['domains']
+        if kept != new.get('profiles', {}):
+            log.warn('Profiles were added, removed or changed in more than their domains, restart blocky to apply it')
+        if kept:
+            new['profiles'] = kept
+        else:
+            new.pop('profiles', None)
+
+    def _keep_setting(self, old, new, key):
+        if key in old:
+            new[key] = old[key]
+        else:
+            new.pop(key, None)
+
+    def apply_settings(self, old, new):
+        old_domains = set(all_domains(old))
+        new_domains = set(all_domains(new))
+        added = sorted(new_domains - old_domains)
+        removed = sorted(old_domains - new_domains)
+        if added or removed:
+            log.info('%d domains added: %s, %d removed: %s', len(added), format_items(added), len(removed),
+                     format_items(removed))
+        if not self.follower:
+            self.detect.add_fqdns(added)
+            self.detect.remove_fqdns(removed)
+        if self.dns_proxy:
+            for domain in added:
+                self.dns_proxy.index.add(domain)
+            for domain in removed:
+                self.dns_proxy.index.discard(domain)
+        delay = new['check_every']
+        self.detect.max_refresh = delay
+        self.detect.min_refresh = new.get('min_check_every', delay)
+        self.detect.concurrency = new.get('resolve_concurrency', 1)
+        self.detect.health.base = max(self.detect.min_refresh, 1)
+        self.detect.health.max_backoff = new.get('resolve_max_backoff', 3600)
+        self.detect.health.grace = new.get('resolve_grace', 3600)
+        self.detect.set_query_timeout(new.get('resolve_timeout'))
+        if new.get('resolve_nameservers') != old.get('resolve_nameservers'):
+            log.info('Resolving through nameservers: %s', ', '.join(new.get('resolve_nameservers') or ['system']))
+            self.detect.set_nameservers(new.get('resolve_nameservers'))
+        if new.get('resolve_rate') != old.get('resolve_rate'):
+            self.detect.bucket = TokenBucket(new['resolve_rate']) if new.get('resolve_rate') else None
+        if self.aggregator:
+            self.aggregator = Aggregator(min_prefix_len=new.get('aggregate_min_prefix') or 32,
+                                         density=new.get('aggregate_density', 0.5),
+                                         networks=new.get('networks', []))
+        LogConfig().set_log_level(new.get('log_level', 'info'))
+        self.local_whitelist_ipset_handler.update_ipset(
+            iplist=parse_comma_separated(new.get('whitelist_local_ips', '')))
+        domains = dict(block_profiles(new))
+        for profile in self.profiles:
+            profile.set_domains(domains[profile.name]['domains'])
+            self.update_profile(profile)
+
+    def blocked_entries(self, addresses):
+        if self.aggregator:
+            return AddressSet.from_networks(self.aggregator.aggregate_ints(addresses.addresses))
+        return addresses
+
+    def block_observed(self, min_lifetime, domain, addresses, ttl):
+        for profile in self.profiles:
+            if profile.index.match(domain):
+                # the client may use the answer for its whole TTL
+                profile.ipset_handler.add_addresses(addresses, lifetime=max(ttl, min_lifetime))
+
+    def ipset_backend(self):
+        if self.nft:
+            return NFTablesSetBackend(self.nft)
+        return ipset_backends[self.settings.get('ipset_backend', 'cli')]()
 
     def log_startup_notice(self):
         log.info('blocky (Block-YouTube) startup. Settings:')
@@ -507,6 +2708,7 @@ class BlockManager(object):
 
 class Main(object):
     def __init__(self):
+        self.started = time.time()
         try:
             # Parse config file
             settings = Settings()
@@ -518,6 +2720,7 @@ class Main(object):
             sc = StartupChecks(settings)
             sc.test_prereqs()
             self.settings = settings
+            self.snapshots = sc.snapshots
             self.logconf.set_handler(log_type=settings.get('log_type', 'syslog'),
                                      log_facility=settings.get('log_facility', 'daemon'),
                                      log_path=settings.get('log_path', '/var/log/blocky.log'),
@@ -526,6 +2729,9 @@ class Main(object):
         except ConfigFileNotFound as e:
             log.error('Config file not found or [main] section is missing: %s', e)
             sys.exit(2)
+        except MissingMandatoryOption as e:
+            log.error('Following mandatory option(s) are not set in config file: %s. Abort.', e)
+            sys.exit(1)
         except TableNotFound as e:
             log.error('Table %s not found', e)
             sys.exit(3)
@@ -538,6 +2744,65 @@ class Main(object):
         except IncorrectCheckEvery as e:
             log.error('Incorrect check_every setting (%s) in config file. Abort.', e)
             sys.exit(6)
+        except IncorrectMinCheckEvery as e:
+            log.error('Incorrect min_check_every setting (%s) in config file, it has to be between 1 and check_every. '
+                      'Abort.', e)
+            sys.exit(6)
+        except IncorrectResolveConcurrency as e:
+            log.error('Incorrect resolve_concurrency setting (%s) in config file. Abort.', e)
+            sys.exit(6)
+        except IncorrectResolveTimeout as e:
+            log.error('Incorrect resolve_timeout setting (%s) in config file. Abort.', e)
+            sys.exit(6)
+        except IncorrectResolveRate as e:
+            log.error('Incorrect resolve_rate or resolve_smear setting (%s) in config file. Abort.', e)
+            sys.exit(6)
+        except IncorrectResolveNameservers as e:
+            log.error('Incorrect resolve_nameservers setting (%s) in config file. Abort.', e)
+            sys.exit(6)
+        except IncorrectResolveBackoff as e:
+            log.error('Incorrect resolve_max_backoff or resolve_grace setting (%s) in config file. Abort.', e)
+            sys.exit(6)
+        except IncorrectRebuildThreshold as e:
+            log.error('Incorrect ipset_rebuild_threshold setting (%s) in config file. Abort.', e)
+            sys.exit(6)
+        except IncorrectFirewallSetting as e:
+            log.error('Incorrect firewall setting (%s) in config file. Abort.', e)
+            sys.exit(6)
+        except IncorrectIPSetType as e:
+            log.error('Incorrect ipset type (%s). Abort.', e)
+            sys.exit(6)
+        except IncorrectIPSetBackend as e:
+            log.error('Incorrect ipset_backend setting (%s) in config file, use cli or netlink. Abort.', e)
+            sys.exit(6)
+        except IncorrectEntryTimeout as e:
+            log.error('Incorrect ipset_entry_timeout setting (%s) in config file, it has to be 0 or more than twice '
+                      'check_every. Abort.', e)
+            sys.exit(6)
+        except IncorrectAggregationSetting as e:
+            log.error('Incorrect aggregation setting (%s) in config file. Abort.', e)
+            sys.exit(6)
+        except IncorrectDNSProxySetting as e:
+            log.error('Incorrect DNS proxy setting (%s) in config file. Abort.', e)
+            sys.exit(6)
+        except IncorrectStateSetting as e:
+            log.error('Incorrect state setting (%s) in config file. Abort.', e)
+            sys.exit(6)
+        except IncorrectWatchConfig as e:
+            log.error('Incorrect watch_config setting (%s) in config file. Abort.', e)
+            sys.exit(6)
+        except IncorrectMetricsSetting as e:
+            log.error('Incorrect metrics setting (%s) in config file. Abort.', e)
+            sys.exit(6)
+        except IncorrectProfileSetting as e:
+            log.error('Incorrect profile setting (%s) in config file. Abort.', e)
+            sys.exit(6)
+        except IncorrectControlSocket as e:
+            log.error('Incorrect control_socket setting (%s) in config file. Abort.', e)
+            sys.exit(6)
+        except IncorrectPublishSetting as e:
+            log.error('Incorrect publish or follow setting (%s) in config file. Abort.', e)
+            sys.exit(6)
         except IncorrectLogType as e:
             log.error('Incorrect log_type setting (%s) in config file. Abort.', e)
             sys.exit(7)
@@ -555,9 +2820,11 @@ class Main(object):
             sys.exit(10)
 
     def run(self):
-        mgr = BlockManager(self.settings)
-        sig_map = {signal.SIGTERM: partial(sigterm_handler_partial, mgr)}
+        mgr = BlockManager(self.settings, snapshots=self.snapshots, started=self.started)
+        sig_map = {signal.SIGTERM: partial(sigterm_handler_partial, mgr),
+                   signal.SIGHUP: partial(sighup_handler_partial, mgr)}
         if run_foreground:
+            signal.signal(signal.SIGHUP, sig_map[signal.SIGHUP])
             mgr.run()
         else:
             with daemon.DaemonContext(pidfile=pidfile_ctxmgr(self.settings.get('pidfile', '/var/run/blocky.pid')),
@@ -577,9 +2844,23 @@ class Main(object):
 # DONE: add rule at a config-specified position in chain
 # DONE: whitelist local IP addresses
 # DONE: read domains to block from a file (@file notation)
+# DONE: reload config on SIGHUP without removing the rules and ipsets
+# DONE: control socket (blocky.py ctl)
 # TODO: debian packaging
 
+def ctl(argv):
+    try:
+        default_socket = Settings().get('control_socket')
+    except SettingsError:
+        default_socket = None
+    return ctl_main(argv, default_socket or '/var/run/blocky.sock')
+
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'ctl':
+        sys.exit(ctl(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'compile':
+        sys.exit(compile_main(sys.argv[2:]))
     if len(sys.argv) > 1 and sys.argv[1] == '-f':
         run_foreground = True
     m = Main()
@@ -0,0 +1,132 @@
+"""Local control socket of the daemon and the client behind 'blocky.py ctl'.
+
+The protocol is one JSON object per line in both directions over a Unix stream socket: a request
+{"command": name, ...arguments} is answered by {"ok": true, "result": ...} or {"ok": false, "error": message}.
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import SocketServer
+import stat
+import sys
+import threading
+
+log = logging.getLogger()
+
+
+class ControlError(Exception):
+    pass
+
+
+class _ControlHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict) or 'command' not in request:
+                    raise ControlError('request has to be an object with a command')
+                response = {'ok': True, 'result': self.server.dispatch(request)}
+            except Exception as e:
+                response = {'ok': False, 'error': str(e) or e.__class__.__name__}
+            self.wfile.write(json.dumps(response, sort_keys=True) + '\n')
+            self.wfile.flush()
+
+
+class _ThreadingUnixStreamServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class ControlServer(object):
+    """Serves requests on a Unix socket, dispatch(request) returns the result of one request or raises.
+
+    The socket is only accessible by the owner (root).
+    """
+
+    def __init__(self, path, dispatch):
+        self.path = path
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            # left behind by a previous run
+            os.unlink(path)
+        umask = os.umask(0o077)
+        try:
+            self._server = _ThreadingUnixStreamServer(path, _ControlHandler)
+        finally:
+            os.umask(umask)
+        self._server.dispatch = dispatch
+
+    def start(self):
+        thread = threading.Thread(target=self._server.serve_forever, name='blocky-control')
+        thread.daemon = True
+        thread.start()
+        log.info('Control socket listening on %s', self.path)
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def request(path, command, timeout=120, **args):
+    """Send one request to the control socket at path and return its result, ControlError if it failed."""
+    args['command'] = command
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(json.dumps(args) + '\n')
+        response = sock.makefile('rb').readline()
+    finally:
+        sock.close()
+    if not response:
+        raise ControlError('no response from {}'.format(path))
+    response = json.loads(response)
+    if not response.get('ok'):
+        raise ControlError(response.get('error'))
+    return response.get('result')
+
+
+def ctl_parser():
+    parser = argparse.ArgumentParser(prog='blocky.py ctl', description='Control a running blocky daemon')
+    parser.add_argument('-s', '--socket', help='control socket (default: control_socket from the config file)')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('status', help='timings, sizes of the sets and sweep progress')
+    sub = commands.add_parser('set', help='addresses in the ipset of a profile')
+    sub.add_argument('-p', '--profile', default='main')
+    sub = commands.add_parser('answers', help='last answers of the domains (all by default)')
+    sub.add_argument('domains', nargs='*')
+    commands.add_parser('failing', help='domains that keep failing to resolve, with the reason and next retry')
+    sub = commands.add_parser('why', help='domains the addresses were seen for and the profiles blocking them')
+    sub.add_argument('addresses', nargs='+')
+    sub = commands.add_parser('refresh', help='resolve the domains (all by default) now and update the sets')
+    sub.add_argument('domains', nargs='*')
+    for name, doc in (('add', 'start blocking domains'), ('remove', 'stop blocking domains')):
+        sub = commands.add_parser(name, help='{} until the next reload or restart'.format(doc))
+        sub.add_argument('domains', nargs='+')
+        sub.add_argument('-p', '--profile', default='main')
+    for name, doc in (('whitelist-add', 'whitelist addresses'), ('whitelist-remove', 'stop whitelisting addresses')):
+        sub = commands.add_parser(name, help='{} until the next reload or restart'.format(doc))
+        sub.add_argument('addresses', nargs='+')
+    return parser
+
+
+def ctl_main(argv, default_socket):
+    """Entry point of 'blocky.py ctl', returns the exit status."""
+    args = vars(ctl_parser().parse_args(argv))
+    path = args.pop('socket') or default_socket
+    command = args.pop('command').replace('-', '_')
+    try:
+        result = request(path, command, **args)
+    except (socket.error, ControlError) as e:
+        print >> sys.stderr, 'blocky ctl {}: {}'.format(command, e)
+        return 1
+    print json.dumps(result, indent=1, sort_keys=True)
+    return 0
@@ -0,0 +1,208 @@
+"""Forwarding DNS proxy that reports the addresses of blocked names before answering the client."""
+
+import logging
+import SocketServer
+import socket
+import struct
+import threading
+import time
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rdatatype
+
+log = logging.getLogger()
+
+
+def normalize_name(name):
+    return name.strip().rstrip('.').lower()
+
+
+class SuffixIndex(object):
+    """Set of domains that matches a name if it is one of the domains or a subdomain of one.
+
+    A lookup costs one hash probe per label of the name, independent of the number of domains.
+    """
+
+    def __init__(self, domains=()):
+        self._names = set()
+        for domain in domains:
+            self.add(domain)
+
+    def __len__(self):
+        return len(self._names)
+
+    def add(self, domain):
+        domain = normalize_name(domain)
+        if domain:
+            self._names.add(domain)
+
+    def discard(self, domain):
+        self._names.discard(normalize_name(domain))
+
+    def match(self, name):
+        """Return the listed domain that covers name, or None."""
+        name = normalize_name(name)
+        while name:
+            if name in self._names:
+                return name
+            dot = name.find('.')
+            if dot < 0:
+                return None
+            name = name[dot + 1:]
+        return None
+
+
+def parse_host_port(value, default_port=53):
+    value = value.strip()
+    if value.count(':') == 1:
+        host, port = value.split(':')
+        return host.strip(), int(port)
+    return value, default_port
+
+
+def answer_addresses(response):
+    """IPv4 addresses in the answer section of a response and the lowest TTL of their records."""
+    addresses = []
+    ttl = None
+    for rrset in response.answer:
+        if rrset.rdtype != dns.rdatatype.A:
+            continue
+        addresses.extend([rdata.address for rdata in rrset])
+        ttl = rrset.ttl if ttl is None else min(ttl, rrset.ttl)
+    return addresses, ttl
+
+
+def _recv_exactly(sock, size):
+    data = ''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise socket.error('connection closed')
+        data += chunk
+    return data
+
+
+class _UDPHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        data, sock = self.request
+        response = self.server.proxy.handle_query(data, self.server.proxy.forward_udp)
+        if response:
+            sock.sendto(response, self.client_address)
+
+
+class _TCPHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        try:
+            while True:
+                size, = struct.unpack('!H', _recv_exactly(self.request, 2))
+                response = self.server.proxy.handle_query(_recv_exactly(self.request, size),
+                                                          self.server.proxy.forward_tcp)
+                if not response:
+                    return
+                self.request.sendall(struct.pack('!H', len(response)) + response)
+        except socket.error:
+            return
+
+
+class _ThreadingUDPServer(SocketServer.ThreadingMixIn, SocketServer.UDPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class DNSProxy(object):
+    """Forwards DNS queries (UDP and TCP) to an upstream resolver.
+
+    When a query is for one of the domains (or a subdomain), on_match(name, addresses, ttl) is called with the
+    A records of the upstream answer and the response is sent to the client only after it returns. If on_match
+    fails the client gets SERVFAIL instead of an address that is not blocked yet.
+    """
+
+    def __init__(self, domains, upstream, on_match, address='127.0.0.1', port=53, timeout=5):
+        self.index = SuffixIndex(domains)
+        self.upstream = upstream
+        self.on_match = on_match
+        self.timeout = timeout
+        udp = _ThreadingUDPServer((address, port), _UDPHandler)
+        self.address, self.port = udp.server_address
+        self._servers = [udp, _ThreadingTCPServer((self.address, self.port), _TCPHandler)]
+        for server in self._servers:
+            server.proxy = self
+
+    def start(self):
+        for server in self._servers:
+            thread = threading.Thread(target=server.serve_forever, name='blocky-dns-proxy')
+            thread.daemon = True
+            thread.start()
+        log.info('DNS proxy listening on %s port %s, forwarding to %s port %s', self.address, self.port,
+                 self.upstream[0], self.upstream[1])
+
+    def stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+
+    def forward_udp(self, data):
+        # connected, the kernel drops datagrams from other sources; replies to another query ID are skipped
+        # until the timeout, so a spoofed answer has to guess the ID
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.connect(self.upstream)
+            sock.send(data)
+            deadline = time.time() + self.timeout
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout('timed out')
+                sock.settimeout(remaining)
+                wire = sock.recv(65535)
+                if wire[:2] == data[:2]:
+                    return wire
+                log.warn('DNS proxy: dropped a reply from %s with a wrong query ID', self.upstream[0])
+        finally:
+            sock.close()
+
+    def forward_tcp(self, data):
+        sock = socket.create_connection(self.upstream, self.timeout)
+        try:
+            sock.sendall(struct.pack('!H', len(data)) + data)
+            size, = struct.unpack('!H', _recv_exactly(sock, 2))
+            return _recv_exactly(sock, size)
+        finally:
+            sock.close()
+
+    def _servfail(self, query):
+        response = dns.message.make_response(query)
+        response.set_rcode(dns.rcode.SERVFAIL)
+        return response.to_wire()
+
+    def handle_query(self, data, forward):
+        try:
+            query = dns.message.from_wire(data)
+        except dns.exception.DNSException:
+            return None
+        matched = None
+        if query.question:
+            matched = self.index.match(query.question[0].name.to_text())
+        try:
+            wire = forward(data)
+        except (socket.error, socket.timeout) as e:
+            log.warn('DNS proxy: upstream %s failed: %s', self.upstream[0], e)
+            return self._servfail(query)
+        if not matched:
+            return wire
+        try:
+            addresses, ttl = answer_addresses(dns.message.from_wire(wire))
+            if addresses:
+                self.on_match(matched, addresses, ttl)
+        except Exception as e:
+            log.error('DNS proxy: blocking addresses of %s failed: %s', matched, e)
+            return self._servfail(query)
+        return wire
@@ -0,0 +1,210 @@
+"""Compiled domain lists: a @file of domains normalized, de-duplicated and sorted once by 'blocky.py compile' into
+a binary file that the daemon memory-maps at startup instead of parsing the text.
+
+A compiled file (the list's path with COMPILED_SUFFIX appended) holds a header with the size and mtime of the
+text file it was compiled from, so a changed list is noticed and read as text until it is compiled again; then
+the domains, joined by newlines; then the suffix section: the domains that no other listed domain covers, with
+their labels reversed (www.example.com -> com.example.www) and sorted, and the offsets of these keys, so whether a
+name is covered by the list is a few binary searches over the mapped file.
+
+The daemon reads the names out of the mapping and closes it: it resolves every listed domain, so it holds them
+in memory anyway, and the compiled file saves the parsing at startup rather than memory at runtime.
+"""
+
+import argparse
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+
+from dnsproxy import normalize_name
+
+log = logging.getLogger()
+
+COMPILED_SUFFIX = '.compiled'
+MAGIC = 'BLKYDOM1'
+# magic, source mtime, source size, domain count, domains length, suffix key count, suffix keys length
+_HEADER = struct.Struct('<8sdQIIII')
+_OFFSET = struct.Struct('<I')
+
+
+def compiled_path(source):
+    return source + COMPILED_SUFFIX
+
+
+def read_text(path):
+    """Domains of a text list, one per line, without blank lines and # comments, as they are written."""
+    with open(path, 'rb') as fo:
+        values = [x.strip() for x in fo.readlines()]
+    return [x for x in values if x and not x.startswith('#')]
+
+
+def normalize_domains(values):
+    """Sorted unique normalized names of values."""
+    return sorted(set(name for name in (normalize_name(value) for value in values) if name))
+
+
+def reverse_labels(name):
+    return '.'.join(reversed(name.split('.')))
+
+
+def suffix_keys(domains):
+    """Sorted reversed names of the domains not covered by another one of them (a subdomain of it)."""
+    keys = []
+    kept = set()
+    # sorted, a domain comes after the ones covering it
+    for key in sorted(reverse_labels(domain) for domain in domains):
+        labels = key.split('.')
+        if any('.'.join(labels[:i]) in kept for i in range(1, len(labels))):
+            continue
+        kept.add(key)
+        keys.append(key)
+    return keys
+
+
+def compile_list(source, target=None):
+    """Compile the text list source into target (compiled_path(source) by default), return (domains, lines,
+    suffix keys) counts. The file is replaced atomically."""
+    target = target or compiled_path(source)
+    st = os.stat(source)
+    lines = read_text(source)
+    domains = normalize_domains(lines)
+    keys = suffix_keys(domains)
+    names = '\n'.join(domains)
+    offsets = array('I', [0])
+    for key in keys:
+        offsets.append(offsets[-1] + len(key))
+    keys_len = offsets[-1]
+    if sys.byteorder != 'little':
+        offsets.byteswap()
+    fd, tmp_path = tempfile.mkstemp(prefix='.blocky-compile-', dir=os.path.dirname(os.path.abspath(target)))
+    try:
+        with os.fdopen(fd, 'wb') as fo:
+            fo.write(_HEADER.pack(MAGIC, st.st_mtime, st.st_size, len(domains), len(names), len(keys), keys_len))
+            fo.write(names)
+            fo.write(offsets.tostring())
+            fo.write(''.join(keys))
+        os.rename(tmp_path, target)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    return len(domains), len(lines), len(keys)
+
+
+class CompiledDomains(object):
+    """Memory-mapped compiled domain list."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fo:
+            self._map = mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < _HEADER.size:
+            raise ValueError('{} is not a compiled domain list'.format(path))
+        (magic, self.source_mtime, self.source_size, self.count, names_len, self.key_count,
+         keys_len) = _HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError('{} is not a compiled domain list'.format(path))
+        self._names = _HEADER.size
+        self._offsets = self._names + names_len
+        self._keys = self._offsets + _OFFSET.size * (self.key_count + 1)
+        if len(self._map) != self._keys + keys_len:
+            raise ValueError('{} is truncated'.format(path))
+
+    def close(self):
+        self._map.close()
+
+    def __len__(self):
+        return self.count
+
+    def is_fresh(self, source):
+        """Whether the text list source is the one this file was compiled from."""
+        try:
+            st = os.stat(source)
+        except OSError:
+            return False
+        return st.st_size == self.source_size and st.st_mtime == self.source_mtime
+
+    def names(self):
+        """The normalized domains, sorted."""
+        if not self.count:
+            return []
+        return self._map[self._names:self._offsets].split('\n')
+
+    def _key(self, i):
+        start = _OFFSET.unpack_from(self._map, self._offsets + _OFFSET.size * i)[0]
+        end = _OFFSET.unpack_from(self._map, self._offsets + _OFFSET.size * (i + 1))[0]
+        return self._map[self._keys + start:self._keys + end]
+
+    def _has_key(self, key):
+        lo, hi = 0, self.key_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo < self.key_count and self._key(lo) == key
+
+    def covers(self, name):
+        """The listed domain that name is or is a subdomain of, or None."""
+        labels = normalize_name(name).split('.')[::-1]
+        for i in range(1, len(labels) + 1):
+            key = '.'.join(labels[:i])
+            if key and self._has_key(key):
+                return reverse_labels(key)
+        return None
+
+
+def load_compiled(source):
+    """Domains of the list source from its compiled file, None if there is none or it is stale."""
+    path = compiled_path(source)
+    if not os.path.isfile(path):
+        return None
+    try:
+        compiled = CompiledDomains(path)
+    except (ValueError, EnvironmentError, mmap.error) as e:
+        log.warn('Ignoring compiled domain list %s: %s', path, e)
+        return None
+    try:
+        if not compiled.is_fresh(source):
+            log.warn('Compiled domain list %s is out of date, reading %s; run blocky.py compile %s', path, source,
+                     source)
+            return None
+        return compiled.names()
+    finally:
+        compiled.close()
+
+
+def compile_parser():
+    parser = argparse.ArgumentParser(prog='blocky.py compile',
+                                     description='Compile a domain list @file for a faster start of blocky')
+    parser.add_argument('source', help='text file with one domain per line')
+    parser.add_argument('-o', '--output', help='compiled file (default: SOURCE{})'.format(COMPILED_SUFFIX))
+    parser.add_argument('-l', '--lookup', action='append', metavar='NAME',
+                        help='print the domain of the compiled list covering NAME instead of compiling')
+    return parser
+
+
+def compile_main(argv):
+    """Entry point of 'blocky.py compile', returns the exit status."""
+    args = compile_parser().parse_args(argv)
+    target = args.output or compiled_path(args.source)
+    try:
+        if args.lookup:
+            compiled = CompiledDomains(target)
+            try:
+                for name in args.lookup:
+                    print '{} {}'.format(name, compiled.covers(name) or '-')
+            finally:
+                compiled.close()
+            return 0
+        domains, lines, keys = compile_list(args.source, target)
+    except (ValueError, EnvironmentError, mmap.error) as e:
+        print >> sys.stderr, 'blocky compile: {}'.format(e)
+        return 1
+    print '{}: {} domains ({} duplicates dropped), {} not covered by another, written to {}'.format(
+        args.source, domains, lines - domains, keys, target)
+    return 0
@@ -0,0 +1,225 @@
+"""Counters, gauges and histograms exposed in the Prometheus text format.
+
+The metrics of a Registry are served over HTTP by MetricsServer or written to a node_exporter textfile by
+write_textfile. Updating a metric takes a lock and a dict lookup (plus a bisect for histograms), so they are
+cheap enough to be always on.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import bisect
+import contextlib
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value):
+    if isinstance(value, (int, long)):
+        return str(value)
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(['{}="{}"'.format(name, _escape(value)) for name, value in pairs]) + '}'
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, doc, labelnames=()):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        # label values -> value
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{} takes labels {}, got {}'.format(self.name, self.labelnames, sorted(labels)))
+        return tuple([str(labels[name]) for name in self.labelnames])
+
+    def remove(self, **labels):
+        """Drop the series with these labels, e.g. of a domain that is no longer resolved."""
+        with self._lock:
+            self._values.pop(self._key(labels), None)
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        """(suffix, label pairs, value) of every series."""
+        with self._lock:
+            items = sorted(self._values.items())
+        return [('', zip(self.labelnames, key), value) for key, value in items]
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.doc.replace('\\', '\\\\').replace('\n', '\\n')),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for suffix, pairs, value in self.samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix, format_labels(pairs), format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Histogram(_Metric):
+    """Observations counted in fixed buckets; each series keeps one count per bucket, a sum and a total count."""
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, doc, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        # the first bucket whose upper bound is >= value, len(buckets) is the +Inf bucket
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, **labels)
+
+    def value(self, **labels):
+        """(count, sum) of the series with these labels."""
+        with self._lock:
+            series = self._values.get(self._key(labels))
+            if series is None:
+                return 0, 0.0
+            return series[2], series[1]
+
+    def samples(self):
+        with self._lock:
+            items = sorted([(key, (list(series[0]), series[1], series[2])) for key, series in self._values.items()])
+        samples = []
+        for key, (counts, total, count) in items:
+            pairs = zip(self.labelnames, key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                samples.append(('_bucket', pairs + [('le', format_value(bound))], cumulative))
+            samples.append(('_sum', pairs, total))
+            samples.append(('_count', pairs, count))
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, doc, labelnames=()):
+        return self._register(Counter(name, doc, labelnames))
+
+    def gauge(self, name, doc, labelnames=()):
+        return self._register(Gauge(name, doc, labelnames))
+
+    def histogram(self, name, doc, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, doc, labelnames, buckets))
+
+    def render(self):
+        return ''.join([metric.render() + '\n' for metric in self._metrics])
+
+
+def write_textfile(registry, path):
+    """Write the metrics for node_exporter's textfile collector, which only reads *.prom files.
+
+    The file is written under another name and renamed over the old one, so the collector never reads it half
+    written.
+    """
+    tmp_path = '{}.tmp'.format(path)
+    with open(tmp_path, 'wb') as fo:
+        fo.write(registry.render())
+    os.rename(tmp_path, path)
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        log.debug('Metrics: %s %s', self.client_address[0], fmt % args)
+
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MetricsServer(object):
+    """Serves the metrics of a registry at /metrics over HTTP."""
+
+    def __init__(self, registry, address='127.0.0.1', port=9797):
+        self._server = _ThreadingHTTPServer((address, port), _MetricsHandler)
+        self._server.registry = registry
+        self.address, self.port = self._server.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self._server.serve_forever, name='blocky-metrics')
+        thread.daemon = True
+        thread.start()
+        log.info('Serving metrics on http://%s:%s/metrics', self.address, self.port)
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,273 @@
+"""Minimal netlink client for the ipset subsystem of nfnetlink (NFNL_SUBSYS_IPSET).
+
+Builds the same messages the ipset binary sends to the kernel, so sets can be managed without forking it.
+Constants follow linux/netlink.h, linux/netfilter/nfnetlink.h and linux/netfilter/ipset/ip_set.h.
+"""
+
+import errno
+import os
+import socket
+import struct
+
+NETLINK_NETFILTER = 12
+
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_EXCL = 0x200
+
+NLMSG_ERROR = 0x2
+NLMSG_DONE = 0x3
+
+NLA_F_NESTED = 0x8000
+NLA_F_NET_BYTEORDER = 0x4000
+
+NFNL_SUBSYS_IPSET = 6
+NFNETLINK_V0 = 0
+NFPROTO_IPV4 = 2
+
+IPSET_PROTOCOL = 6
+
+# enum ipset_cmd
+IPSET_CMD_CREATE = 2
+IPSET_CMD_DESTROY = 3
+IPSET_CMD_FLUSH = 4
+IPSET_CMD_SWAP = 6
+IPSET_CMD_ADD = 9
+IPSET_CMD_DEL = 10
+IPSET_CMD_HEADER = 12
+
+# top level attributes
+IPSET_ATTR_PROTOCOL = 1
+IPSET_ATTR_SETNAME = 2
+IPSET_ATTR_TYPENAME = 3
+IPSET_ATTR_SETNAME2 = IPSET_ATTR_TYPENAME
+IPSET_ATTR_REVISION = 4
+IPSET_ATTR_FAMILY = 5
+IPSET_ATTR_DATA = 7
+
+# create and add/del/test (CADT) attributes, nested in IPSET_ATTR_DATA
+IPSET_ATTR_IP = 1
+IPSET_ATTR_CIDR = 3
+IPSET_ATTR_TIMEOUT = 6
+IPSET_ATTR_HASHSIZE = 18
+IPSET_ATTR_MAXELEM = 19
+
+# address attributes, nested in IPSET_ATTR_IP
+IPSET_ATTR_IPADDR_IPV4 = 1
+
+# enum ipset_errno, returned negated in NLMSG_ERROR
+IPSET_ERR_PROTOCOL = 4097
+IPSET_ERR_FIND_TYPE = 4098
+IPSET_ERR_MAX_SETS = 4099
+IPSET_ERR_BUSY = 4100
+IPSET_ERR_EXIST_SETNAME2 = 4101
+IPSET_ERR_TYPE_MISMATCH = 4102
+IPSET_ERR_EXIST = 4103
+IPSET_ERR_INVALID_CIDR = 4104
+IPSET_ERR_INVALID_NETMASK = 4105
+IPSET_ERR_INVALID_FAMILY = 4106
+IPSET_ERR_TIMEOUT = 4107
+IPSET_ERR_REFERENCED = 4108
+IPSET_ERR_IPADDR_IPV4 = 4109
+IPSET_ERR_HASH_FULL = 4352
+
+ERROR_MESSAGES = {
+    errno.EEXIST: 'set with the same name already exists',
+    errno.ENOENT: 'set does not exist',
+    IPSET_ERR_PROTOCOL: 'kernel does not support the ipset protocol version',
+    IPSET_ERR_FIND_TYPE: 'set type or revision not supported by the kernel',
+    IPSET_ERR_MAX_SETS: 'maximal number of sets reached',
+    IPSET_ERR_BUSY: 'set is in use by the kernel',
+    IPSET_ERR_EXIST_SETNAME2: 'second set does not exist',
+    IPSET_ERR_TYPE_MISMATCH: 'sets of different types cannot be swapped',
+    IPSET_ERR_EXIST: 'element already added or missing',
+    IPSET_ERR_INVALID_CIDR: 'invalid prefix length',
+    IPSET_ERR_INVALID_FAMILY: 'invalid address family',
+    IPSET_ERR_TIMEOUT: 'set was created without timeout support',
+    IPSET_ERR_REFERENCED: 'set is referenced by another set or a rule',
+    IPSET_ERR_IPADDR_IPV4: 'invalid IPv4 address',
+    IPSET_ERR_HASH_FULL: 'set is full',
+}
+
+_NLMSGHDR = struct.Struct('=IHHII')
+_NFGENMSG = struct.Struct('=BBH')
+_NLATTR = struct.Struct('=HH')
+_NLMSGERR = struct.Struct('=i')
+
+
+class NetlinkError(Exception):
+    def __init__(self, code, seq=None):
+        self.code = code
+        self.seq = seq
+        super(NetlinkError, self).__init__('{} (error {})'.format(error_message(code), code))
+
+
+def error_message(code):
+    if code in ERROR_MESSAGES:
+        return ERROR_MESSAGES[code]
+    return os.strerror(code) if code < 4096 else 'ipset error'
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def nla(attr_type, payload):
+    length = _NLATTR.size + len(payload)
+    return _NLATTR.pack(length, attr_type) + payload + '\0' * (_align(length) - length)
+
+
+def nla_u8(attr_type, value):
+    return nla(attr_type, struct.pack('=B', value))
+
+
+def nla_u32_net(attr_type, value):
+    return nla(attr_type | NLA_F_NET_BYTEORDER, struct.pack('!I', value))
+
+
+def nla_string(attr_type, value):
+    return nla(attr_type, value + '\0')
+
+
+def nla_nested(attr_type, *attrs):
+    return nla(attr_type | NLA_F_NESTED, ''.join(attrs))
+
+
+def message(cmd, attrs, seq, flags=0):
+    """Whole nfnetlink ipset request: netlink header, nfgenmsg header and attributes (protocol attribute first)."""
+    payload = _NFGENMSG.pack(NFPROTO_IPV4, NFNETLINK_V0, 0) + nla_u8(IPSET_ATTR_PROTOCOL, IPSET_PROTOCOL) + \
+        ''.join(attrs)
+    msg_type = (NFNL_SUBSYS_IPSET << 8) | cmd
+    return _NLMSGHDR.pack(_NLMSGHDR.size + len(payload), msg_type, NLM_F_REQUEST | NLM_F_ACK | flags, seq, 0) + \
+        payload
+
+
+def _entry_attrs(entry, timeout=None):
+    if '/' in entry:
+        address, cidr = entry.split('/', 1)
+    else:
+        address, cidr = entry, None
+    attrs = [nla_nested(IPSET_ATTR_IP, nla(IPSET_ATTR_IPADDR_IPV4 | NLA_F_NET_BYTEORDER, socket.inet_aton(address)))]
+    if cidr is not None:
+        attrs.append(nla_u8(IPSET_ATTR_CIDR, int(cidr)))
+    if timeout is not None:
+        attrs.append(nla_u32_net(IPSET_ATTR_TIMEOUT, int(timeout)))
+    return attrs
+
+
+def create(name, set_type, seq, revision=0, hashsize=None, maxelem=None, timeout=None, exist=False):
+    data = []
+    if timeout is not None:
+        data.append(nla_u32_net(IPSET_ATTR_TIMEOUT, int(timeout)))
+    if hashsize is not None:
+        data.append(nla_u32_net(IPSET_ATTR_HASHSIZE, int(hashsize)))
+    if maxelem is not None:
+        data.append(nla_u32_net(IPSET_ATTR_MAXELEM, int(maxelem)))
+    attrs = [nla_string(IPSET_ATTR_SETNAME, name), nla_string(IPSET_ATTR_TYPENAME, set_type),
+             nla_u8(IPSET_ATTR_REVISION, revision), nla_u8(IPSET_ATTR_FAMILY, NFPROTO_IPV4),
+             nla_nested(IPSET_ATTR_DATA, *data)]
+    return message(IPSET_CMD_CREATE, attrs, seq, flags=0 if exist else NLM_F_EXCL)
+
+
+def destroy(name, seq):
+    return message(IPSET_CMD_DESTROY, [nla_string(IPSET_ATTR_SETNAME, name)], seq)
+
+
+def flush(name, seq):
+    return message(IPSET_CMD_FLUSH, [nla_string(IPSET_ATTR_SETNAME, name)], seq)
+
+
+def swap(name, name2, seq):
+    return message(IPSET_CMD_SWAP, [nla_string(IPSET_ATTR_SETNAME, name), nla_string(IPSET_ATTR_SETNAME2, name2)],
+                   seq)
+
+
+def add(name, entry, seq, timeout=None, exist=True):
+    # without NLM_F_EXCL the kernel ignores already added elements, like ipset -exist
+    attrs = [nla_string(IPSET_ATTR_SETNAME, name), nla_nested(IPSET_ATTR_DATA, *_entry_attrs(entry, timeout))]
+    return message(IPSET_CMD_ADD, attrs, seq, flags=0 if exist else NLM_F_EXCL)
+
+
+def delete(name, entry, seq, exist=True):
+    attrs = [nla_string(IPSET_ATTR_SETNAME, name), nla_nested(IPSET_ATTR_DATA, *_entry_attrs(entry))]
+    return message(IPSET_CMD_DEL, attrs, seq, flags=0 if exist else NLM_F_EXCL)
+
+
+def header(name, seq):
+    """Request of the header of a set; the reply carries its type name (see parse_typename)."""
+    return message(IPSET_CMD_HEADER, [nla_string(IPSET_ATTR_SETNAME, name)], seq)
+
+
+def parse_attrs(data, offset=0):
+    """{attribute type: payload} of the attributes in data from offset on, flags masked off the types."""
+    attrs = {}
+    while offset + _NLATTR.size <= len(data):
+        length, attr_type = _NLATTR.unpack_from(data, offset)
+        if length < _NLATTR.size:
+            break
+        attrs[attr_type & ~(NLA_F_NESTED | NLA_F_NET_BYTEORDER)] = data[offset + _NLATTR.size:offset + length]
+        offset += _align(length)
+    return attrs
+
+
+def parse_typename(data, seq):
+    """Type name in the reply to the header request seq in data, None if there is none."""
+    offset = 0
+    while offset + _NLMSGHDR.size <= len(data):
+        length, msg_type, flags, msg_seq, pid = _NLMSGHDR.unpack_from(data, offset)
+        if length < _NLMSGHDR.size:
+            break
+        if msg_seq == seq and msg_type == (NFNL_SUBSYS_IPSET << 8) | IPSET_CMD_HEADER:
+            attrs = parse_attrs(data[:offset + length], offset + _NLMSGHDR.size + _NFGENMSG.size)
+            if IPSET_ATTR_TYPENAME in attrs:
+                return attrs[IPSET_ATTR_TYPENAME].rstrip('\0')
+        offset += _align(length)
+    return None
+
+
+def parse_acks(data):
+    """Return (seq, error code) for every NLMSG_ERROR message in data; error code 0 is a plain acknowledgement."""
+    acks = []
+    offset = 0
+    while offset + _NLMSGHDR.size <= len(data):
+        length, msg_type, flags, seq, pid = _NLMSGHDR.unpack_from(data, offset)
+        if length < _NLMSGHDR.size:
+            break
+        if msg_type == NLMSG_ERROR:
+            code, = _NLMSGERR.unpack_from(data, offset + _NLMSGHDR.size)
+            acks.append((seq, -code))
+        offset += _align(length)
+    return acks
+
+
+class NetlinkSocket(object):
+    def __init__(self, rcvbuf=1024 * 1024):
+        self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_NETFILTER)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self._sock.bind((0, 0))
+
+    def request(self, messages, seqs):
+        """Send messages in one datagram and wait for the acknowledgement of every sequence number in seqs."""
+        self._sock.send(''.join(messages))
+        pending = set(seqs)
+        acks = []
+        while pending:
+            for seq, code in parse_acks(self._sock.recv(65536)):
+                if seq in pending:
+                    pending.discard(seq)
+                    acks.append((seq, code))
+        return acks
+
+    def query(self, msg, seq):
+        """Send a request answered with a message of its own, return (reply data, error code of the ack)."""
+        self._sock.send(msg)
+        data = ''
+        while True:
+            chunk = self._sock.recv(65536)
+            data += chunk
+            for ack_seq, code in parse_acks(chunk):
+                if ack_seq == seq:
+                    return data, code
+
+    def close(self):
+        self._sock.close()
@@ -0,0 +1,84 @@
+"""Statements of the nft scripts that manage blocky's nftables table, its chains, sets and rules.
+
+blocky keeps everything in a table of its own in the inet family: one base chain per hook, named after the hook,
+and the sets, which take the place of the ipsets. A script is applied by 'nft -f' as one transaction.
+"""
+
+FAMILY = 'inet'
+
+# base chain hooks, by the iptables chain names used in blocky.conf
+HOOKS = {'PREROUTING': 'prerouting', 'INPUT': 'input', 'FORWARD': 'forward', 'OUTPUT': 'output',
+         'POSTROUTING': 'postrouting'}
+
+# chain priorities, by the iptables table names used in blocky.conf
+PRIORITIES = {'RAW': 'raw', 'MANGLE': 'mangle', 'FILTER': 'filter', 'SECURITY': 'security'}
+
+# elements per add/delete element statement
+ELEMENTS_PER_STATEMENT = 1000
+
+
+def _quote(text):
+    # nft strings cannot contain double quotes
+    return '"{}"'.format(text.replace('"', "'"))
+
+
+def add_table(table):
+    return 'add table {} {}'.format(FAMILY, table)
+
+
+def add_chain(table, chain, hook, priority):
+    """Base filter chain (accepting by default) named chain on hook."""
+    return 'add chain {} {} {} {{ type filter hook {} priority {}; policy accept; }}'.format(
+        FAMILY, table, chain, hook, priority)
+
+
+def flush_chain(table, chain):
+    return 'flush chain {} {} {}'.format(FAMILY, table, chain)
+
+
+def add_rule(table, chain, set_name, match_set_flag, target, comment):
+    """Rule matching TCP packets whose source (match_set_flag 'src') or destination ('dst') address is in the set,
+    the counterpart of blocky's iptables rules."""
+    address = 'saddr' if match_set_flag == 'src' else 'daddr'
+    return 'add rule {} {} {} meta l4proto tcp ip {} @{} {} comment {}'.format(
+        FAMILY, table, chain, address, set_name, target.lower(), _quote(comment))
+
+
+def add_set(table, name, set_type, options=()):
+    """Set for the entries of an ipset of set_type: hash:net becomes an interval set and a timeout option gives
+    the set a default timeout. hashsize and maxelem are left out, a set without a size grows as needed while one
+    with a size keeps it, as 'add set' leaves an existing set alone."""
+    options = dict(options)
+    flags = []
+    if set_type == 'hash:net':
+        flags.append('interval')
+    if options.get('timeout'):
+        flags.append('timeout')
+    spec = ['type ipv4_addr;']
+    if flags:
+        spec.append('flags {};'.format(', '.join(flags)))
+    if set_type == 'hash:net' and not options.get('timeout'):
+        # pinned addresses may fall inside an aggregated prefix; merging is not supported with timeouts
+        spec.append('auto-merge;')
+    if options.get('timeout'):
+        spec.append('timeout {}s;'.format(int(options['timeout'])))
+    return 'add set {} {} {} {{ {} }}'.format(FAMILY, table, name, ' '.join(spec))
+
+
+def flush_set(table, name):
+    return 'flush set {} {} {}'.format(FAMILY, table, name)
+
+
+def delete_set(table, name):
+    return 'delete set {} {} {}'.format(FAMILY, table, name)
+
+
+def elements(verb, table, name, entries, timeout=None):
+    """'add' or 'delete' element statements for entries, at most ELEMENTS_PER_STATEMENT each."""
+    suffix = ' timeout {}s'.format(int(timeout)) if timeout else ''
+    statements = []
+    for i in range(0, len(entries), ELEMENTS_PER_STATEMENT):
+        chunk = entries[i:i + ELEMENTS_PER_STATEMENT]
+        statements.append('{} element {} {} {} {{ {} }}'.format(
+            verb, FAMILY, table, name, ', '.join([entry + suffix for entry in chunk])))
+    return statements
@@ -0,0 +1,264 @@
+"""Distribution of the answers of one blocky (the leader) to others (the followers), which then do not resolve.
+
+The leader serves a TCP or Unix stream socket; the protocol is one JSON object per line, from the leader to the
+follower only. A follower first receives the current answers,
+{"type": "snapshot", "version": n, "answers": {fqdn: [address, ...]}}, then every change of them,
+{"type": "delta", "version": n + 1, "answers": {fqdn: [address, ...]}, "removed": [fqdn, ...]}. Versions go up by
+one with every delta; a follower that misses one reconnects and starts over from a snapshot.
+"""
+
+import json
+import logging
+import os
+import select
+import socket
+import SocketServer
+import stat
+import threading
+
+log = logging.getLogger()
+
+
+class FollowError(Exception):
+    pass
+
+
+def parse_endpoint(value):
+    """('unix', path) of an absolute path, ('tcp', (host, port)) of host:port; ValueError if it is neither."""
+    value = value.strip()
+    if value.startswith('/'):
+        return 'unix', value
+    host, sep, port = value.rpartition(':')
+    if not sep or not host or not port.isdigit() or not 0 < int(port) <= 65535:
+        raise ValueError(value)
+    return 'tcp', (host.strip('[]'), int(port))
+
+
+def format_endpoint(endpoint):
+    kind, address = endpoint
+    return address if kind == 'unix' else '{}:{}'.format(*address)
+
+
+def _message(kind, version, answers, removed=None):
+    message = {'type': kind, 'version': version,
+               'answers': dict((fqdn, list(addresses)) for fqdn, addresses in answers.items())}
+    if removed is not None:
+        message['removed'] = removed
+    return json.dumps(message, sort_keys=True) + '\n'
+
+
+class _PublishHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        self.server.publisher.serve(self.request)
+
+
+class _ThreadingUnixStreamServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class _ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _ThreadingTCP6Server(_ThreadingTCPServer):
+    address_family = socket.AF_INET6
+
+
+class AnswerPublisher(object):
+    """Serves the answers (fqdn -> AddressSet) passed to publish() to the followers connecting to endpoint.
+
+    A follower that does not take a message within send_timeout seconds is disconnected.
+    """
+
+    def __init__(self, endpoint, send_timeout=10):
+        self.endpoint = endpoint
+        self.send_timeout = send_timeout
+        self.version = 0
+        # fqdn -> AddressSet, as last published
+        self._answers = {}
+        # sockets of the connected followers
+        self.followers = []
+        # held while a message is sent, so a new follower gets the snapshot and then every delta after it
+        self._lock = threading.Lock()
+        kind, address = endpoint
+        if kind == 'unix':
+            if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+                # left behind by a previous run
+                os.unlink(address)
+            self._server = _ThreadingUnixStreamServer(address, _PublishHandler)
+        elif ':' in address[0]:
+            self._server = _ThreadingTCP6Server(address, _PublishHandler)
+        else:
+            self._server = _ThreadingTCPServer(address, _PublishHandler)
+        self._server.publisher = self
+
+    @property
+    def address(self):
+        """Address the socket is bound to, with the actual port of a TCP socket bound to port 0."""
+        # (host, port, flowinfo, scope id) of an IPv6 socket
+        return self._server.server_address[:2] if self.endpoint[0] == 'tcp' else self._server.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self._server.serve_forever, name='blocky-publish')
+        thread.daemon = True
+        thread.start()
+        log.info('Publishing answers on %s', format_endpoint(self.endpoint))
+
+    def stop(self):
+        self._server.shutdown()
+        with self._lock:
+            for sock in list(self.followers):
+                self._drop(sock)
+        self._server.server_close()
+        if self.endpoint[0] == 'unix':
+            try:
+                os.unlink(self.endpoint[1])
+            except OSError:
+                pass
+
+    def serve(self, sock):
+        """Send the snapshot to a new follower and keep it until it disconnects, run by its handler thread."""
+        sock.settimeout(self.send_timeout)
+        with self._lock:
+            try:
+                sock.sendall(_message('snapshot', self.version, self._answers))
+            except socket.error as e:
+                log.warn('Sending the answers to a follower failed: %s', e)
+                return
+            self.followers.append(sock)
+        log.info('Follower connected, %d followers', len(self.followers))
+        try:
+            # followers send nothing, readable means disconnected (or dropped by publish)
+            while True:
+                select.select([sock], [], [])
+                if not sock.recv(4096):
+                    break
+        except socket.error:
+            pass
+        with self._lock:
+            if sock in self.followers:
+                self.followers.remove(sock)
+        log.info('Follower disconnected, %d followers', len(self.followers))
+
+    def _drop(self, sock):
+        self.followers.remove(sock)
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def publish(self, answers, fqdns):
+        """Send the changes of the answers of fqdns since they were last published to the followers, return
+        whether there were any; fqdns not in answers any more are removed.
+
+        Answers are AddressSets, which are replaced rather than changed, so unchanged ones are found by identity.
+        """
+        changed = {}
+        removed = []
+        for fqdn in fqdns:
+            addresses = answers.get(fqdn)
+            previous = self._answers.get(fqdn)
+            if addresses is None:
+                if previous is not None:
+                    removed.append(fqdn)
+            elif previous is not addresses and previous != addresses:
+                changed[fqdn] = addresses
+        if not changed and not removed:
+            return False
+        removed.sort()
+        with self._lock:
+            self.version += 1
+            self._answers.update(changed)
+            for fqdn in removed:
+                del self._answers[fqdn]
+            message = _message('delta', self.version, changed, removed)
+            for sock in list(self.followers):
+                try:
+                    sock.sendall(message)
+                except socket.error as e:
+                    log.warn('Follower dropped, sending version %d failed: %s', self.version, e)
+                    self._drop(sock)
+        log.debug('Published version %d: %d answers changed, %d removed', self.version, len(changed), len(removed))
+        return True
+
+
+class AnswerFollower(object):
+    """Follows the leader at endpoint from a thread of its own, reconnecting every retry seconds when the
+    connection fails or a version was missed.
+
+    apply(answers, removed, snapshot) is called with the answers (fqdn -> list of addresses) of every message;
+    for a snapshot, removed is None and all other answers are gone.
+    """
+
+    def __init__(self, endpoint, apply, retry=5, timeout=10):
+        self.endpoint = endpoint
+        self.apply = apply
+        self.retry = retry
+        self.timeout = timeout
+        # version of the last message received, None while not connected
+        self.version = None
+        self._sock = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name='blocky-follow')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        sock = self._sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self._follow()
+            except (socket.error, ValueError, KeyError, FollowError) as e:
+                if not self._stopped.is_set():
+                    log.warn('Following %s failed: %s, reconnecting in %ss', format_endpoint(self.endpoint),
+                             e, self.retry)
+            self.version = None
+            self._stopped.wait(self.retry)
+
+    def _connect(self):
+        kind, address = self.endpoint
+        if kind == 'unix':
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            sock = socket.socket(socket.AF_INET6 if ':' in address[0] else socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(address)
+        except socket.error:
+            sock.close()
+            raise
+        # the leader only sends when answers change
+        sock.settimeout(None)
+        return sock
+
+    def _follow(self):
+        self._sock = sock = self._connect()
+        try:
+            stream = sock.makefile('rb')
+            while True:
+                line = stream.readline()
+                if not line:
+                    raise FollowError('connection closed by the leader')
+                message = json.loads(line)
+                snapshot = message['type'] == 'snapshot'
+                if snapshot:
+                    log.info('Following %s from version %d: %d answers', format_endpoint(self.endpoint),
+                             message['version'], len(message['answers']))
+                elif self.version is None or message['version'] != self.version + 1:
+                    raise FollowError('got version {} after {}'.format(message['version'], self.version))
+                self.version = message['version']
+                self.apply(message['answers'], None if snapshot else message['removed'], snapshot)
+        finally:
+            self._sock = None
+            sock.close()
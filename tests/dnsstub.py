@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+import SocketServer
+import struct
+import threading
+import time
+
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+
+
+def _answer(stub, data):
+    query = dns.message.from_wire(data)
+    response = dns.message.make_response(query)
+    question = query.question[0]
+    name = question.name.to_text().rstrip('.')
+    stub.queries.append(name)
+    if name in stub.latency:
+        time.sleep(stub.latency[name])
+    elif stub.default_latency:
+        time.sleep(stub.default_latency)
+    if name in stub.servfail:
+        response.set_rcode(dns.rcode.SERVFAIL)
+        return response.to_wire()
+    addresses = stub.zone.get(name)
+    if addresses is None:
+        response.set_rcode(dns.rcode.NXDOMAIN)
+    elif question.rdtype == dns.rdatatype.A and addresses:
+        ttl = stub.ttl.get(name, stub.default_ttl)
+        response.answer.append(dns.rrset.from_text(question.name, ttl, 'IN', 'A', *addresses))
+    if not response.answer and stub.soa_minimum is not None:
+        response.authority.append(dns.rrset.from_text(
+            'example.', 3600, 'IN', 'SOA', 'ns.example. admin.example. 1 3600 600 86400 {}'.format(stub.soa_minimum)))
+    return response.to_wire()
+
+
+class _StubHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        data, sock = self.request
+        sock.sendto(_answer(self.server.stub, data), self.client_address)
+
+
+class _StubTCPHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        size, = struct.unpack('!H', self.request.recv(2))
+        data = ''
+        while len(data) < size:
+            data += self.request.recv(size - len(data))
+        response = _answer(self.server.stub, data)
+        self.request.sendall(struct.pack('!H', len(response)) + response)
+
+
+class _ThreadingUDPServer(SocketServer.ThreadingMixIn, SocketServer.UDPServer):
+    daemon_threads = True
+
+
+class _ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+
+
+class StubDNSServer(object):
+    """Minimal threaded DNS server on 127.0.0.1 (UDP, and TCP on the same port) answering A queries from a dict.
+
+    zone maps FQDN -> list of addresses, latency maps FQDN -> seconds to wait before answering.
+    Names missing from the zone get NXDOMAIN, names in servfail SERVFAIL. With soa_minimum, negative answers
+    carry an SOA record with that minimum TTL.
+    """
+
+    def __init__(self, zone=None, latency=None, default_latency=0, ttl=None, default_ttl=300, soa_minimum=None):
+        self.zone = zone or {}
+        self.latency = latency or {}
+        self.default_latency = default_latency
+        self.ttl = ttl or {}
+        self.default_ttl = default_ttl
+        self.soa_minimum = soa_minimum
+        self.servfail = set()
+        self.queries = []
+        self._server = _ThreadingUDPServer(('127.0.0.1', 0), _StubHandler)
+        self.address, self.port = self._server.server_address
+        self._servers = [self._server, _ThreadingTCPServer((self.address, self.port), _StubTCPHandler)]
+        for server in self._servers:
+            server.stub = self
+
+    def start(self):
+        for server in self._servers:
+            thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+
+    def configure(self, rslv):
+        rslv.nameservers = [self.address]
+        rslv.port = self.port
+        return rslv
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+_SCRIPT = '''#!{python}
+import json
+import sys
+
+args = sys.argv[1:]
+record = {{'argv': args, 'stdin': None}}
+if {stdin_words!r} and set(args) & set({stdin_words!r}):
+    record['stdin'] = sys.stdin.read()
+with open({log!r}, 'ab') as fo:
+    fo.write(json.dumps(record) + '\\n')
+for word, stdout in {outputs!r}.items():
+    if word in args:
+        sys.stdout.write(stdout)
+for word, (status, stderr) in {failures!r}.items():
+    if word in args:
+        sys.stderr.write(stderr)
+        sys.exit(status)
+'''
+
+
+class FakeCommand(object):
+    """Executable placed in a temporary directory that records its invocations instead of doing anything.
+
+    Point the code under test's PATH at .bindir. Invocations whose arguments contain one of stdin_words also
+    have their standard input recorded. failures maps an argument to (exit status, stderr) to simulate errors,
+    outputs an argument to what is printed on standard output.
+    """
+
+    def __init__(self, name, stdin_words=(), failures=None, outputs=None):
+        self.name = name
+        self.bindir = tempfile.mkdtemp(prefix='blocky-fakebin-')
+        self.log_path = os.path.join(self.bindir, '{}.log'.format(name))
+        self.stdin_words = list(stdin_words)
+        self.failures = failures or {}
+        self.outputs = outputs or {}
+        self._write()
+
+    def _write(self):
+        path = os.path.join(self.bindir, self.name)
+        with open(path, 'wb') as fo:
+            fo.write(_SCRIPT.format(python=sys.executable, log=self.log_path, stdin_words=self.stdin_words,
+                                    failures=self.failures, outputs=self.outputs))
+        os.chmod(path, 0o755)
+
+    def fail_on(self, word, status=1, stderr=''):
+        self.failures[word] = (status, stderr)
+        self._write()
+
+    def output_on(self, word, stdout):
+        self.outputs[word] = stdout
+        self._write()
+
+    def clear_failures(self):
+        self.failures = {}
+        self._write()
+
+    def calls(self):
+        if not os.path.isfile(self.log_path):
+            return []
+        with open(self.log_path, 'rb') as fo:
+            return [json.loads(line) for line in fo if line.strip()]
+
+    def reset(self):
+        if os.path.isfile(self.log_path):
+            os.unlink(self.log_path)
+
+    def cleanup(self):
+        shutil.rmtree(self.bindir, ignore_errors=True)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+import unittest
+
+from blocky.addrset import AddressIndex, AddressSet
+from blocky.aggregate import parse_network
+
+
+class TestAddressSet(unittest.TestCase):
+
+    def test_sorted_unique_and_packed(self):
+        entries = AddressSet(['10.0.0.10', '10.0.0.9', '10.0.0.10', '9.255.255.255'])
+        self.assertEqual(list(entries), ['9.255.255.255', '10.0.0.9', '10.0.0.10'])
+        self.assertEqual(len(entries), 3)
+        self.assertEqual(entries.addresses.itemsize, 4)
+
+    def test_networks_and_other_entries(self):
+        entries = AddressSet(['10.0.1.1', '10.0.0.0/24', '10.0.0.5', '10.0.0.1-10.0.0.3'])
+        self.assertEqual(list(entries), ['10.0.0.0/24', '10.0.0.5', '10.0.1.1', '10.0.0.1-10.0.0.3'])
+        networks = AddressSet.from_networks([parse_network('10.0.1.1'), parse_network('10.0.0.0/24')])
+        self.assertEqual(list(networks), ['10.0.0.0/24', '10.0.1.1'])
+
+    def test_membership(self):
+        entries = AddressSet(['10.0.0.1', '10.0.0.3', '10.0.0.0/24', 'other'])
+        for entry in ['10.0.0.1', '10.0.0.3', '10.0.0.0/24', 'other']:
+            self.assertIn(entry, entries)
+        for entry in ['10.0.0.2', '10.0.0.4', '10.0.1.0/24', '0.0.0.1']:
+            self.assertNotIn(entry, entries)
+
+    def test_union_and_difference(self):
+        a = AddressSet(['10.0.0.1', '10.0.0.2', '10.0.0.0/30'])
+        b = AddressSet(['10.0.0.2', '10.0.0.3'])
+        self.assertEqual(list(a.union(b)), ['10.0.0.0/30', '10.0.0.1', '10.0.0.2', '10.0.0.3'])
+        self.assertEqual(list(a.difference(b)), ['10.0.0.0/30', '10.0.0.1'])
+        self.assertEqual(list(b.difference(a)), ['10.0.0.3'])
+        self.assertEqual(list(a.difference(a)), [])
+        self.assertIs(a.union(AddressSet()), a)
+
+    def test_equality(self):
+        self.assertEqual(AddressSet(['10.0.0.2', '10.0.0.1']), AddressSet.from_ints([167772161, 167772162]))
+        self.assertNotEqual(AddressSet(['10.0.0.1']), AddressSet(['10.0.0.1', '10.0.0.2']))
+        self.assertNotEqual(AddressSet(['10.0.0.1']), ['10.0.0.1'])
+
+    def test_covers(self):
+        entries = AddressSet(['10.0.0.0/24', '10.0.1.5', '192.168.0.0/16'])
+        for entry in ['10.0.0.7', '10.0.0.0/25', '10.0.1.5', '192.168.3.4', '10.0.0.0/24']:
+            self.assertTrue(entries.covers(entry), entry)
+        for entry in ['10.0.1.6', '10.0.0.0/23', '172.16.0.1', 'example']:
+            self.assertFalse(entries.covers(entry), entry)
+
+
+class TestAddressIndex(unittest.TestCase):
+
+    def test_shared_address_reference_counted(self):
+        index = AddressIndex()
+        new, released = index.update('a.example', AddressSet(['10.0.0.1', '10.0.0.2']), 100)
+        self.assertEqual(list(new), ['10.0.0.1', '10.0.0.2'])
+        new, released = index.update('b.example', AddressSet(['10.0.0.2']), 200)
+        self.assertEqual(list(new), [])
+        self.assertEqual(index.owners('10.0.0.2'), {'a.example': 100, 'b.example': 200})
+        # still owned by b.example
+        self.assertEqual(list(index.discard('a.example')), ['10.0.0.1'])
+        self.assertIn('10.0.0.2', index)
+        self.assertNotIn('10.0.0.1', index)
+        new, released = index.update('b.example', AddressSet(['10.0.0.3']), 300)
+        self.assertEqual((list(new), list(released)), (['10.0.0.3'], ['10.0.0.2']))
+        self.assertEqual(list(index.addresses()), ['10.0.0.3'])
+        self.assertEqual(index.answers, {'b.example': AddressSet(['10.0.0.3'])})
+
+    def test_last_seen_updated(self):
+        index = AddressIndex()
+        index.update('a.example', AddressSet(['10.0.0.1']), 100)
+        index.update('a.example', AddressSet(['10.0.0.1']), 160)
+        self.assertEqual(index.owners('10.0.0.1'), {'a.example': 160})
+        self.assertEqual(index.owners('10.0.0.0/24'), {})
+        self.assertEqual(index.owners('bogus'), {})
+        self.assertEqual(len(index), 1)
+        index.update('a.example', AddressSet(), 200)
+        self.assertEqual(len(index), 0)
+        self.assertEqual(list(index.discard('other.example')), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
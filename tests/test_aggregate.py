@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+import random
+import unittest
+
+from blocky.aggregate import Aggregator, int_to_ip, ip_to_int, parse_network
+
+
+class TestParseNetwork(unittest.TestCase):
+
+    def test_valid(self):
+        self.assertEqual(parse_network('10.0.0.0/8'), (ip_to_int('10.0.0.0'), 8))
+        self.assertEqual(parse_network(' 10.1.2.3 '), (ip_to_int('10.1.2.3'), 32))
+
+    def test_invalid(self):
+        for value in ['10.0.0.1/24', '10.0.0.0/33', '10.0.0.0/0', '10.1', 'example.com']:
+            self.assertRaises(ValueError, parse_network, value)
+
+
+class TestAggregator(unittest.TestCase):
+
+    def test_dense_prefix_collapsed(self):
+        agg = Aggregator(min_prefix_len=24, density=0.5)
+        addresses = ['10.0.0.{}'.format(i) for i in range(0, 256, 2)] + ['10.0.1.7', '10.0.1.9']
+        self.assertEqual(agg.aggregate(addresses), ['10.0.0.0/24', '10.0.1.7', '10.0.1.9'])
+
+    def test_not_wider_than_min_prefix(self):
+        agg = Aggregator(min_prefix_len=24, density=0.5)
+        addresses = ['10.0.{}.{}'.format(a, b) for a in range(4) for b in range(256)]
+        self.assertEqual(agg.aggregate(addresses), ['10.0.{}.0/24'.format(a) for a in range(4)])
+
+    def test_small_dense_prefixes(self):
+        agg = Aggregator(min_prefix_len=16, density=1)
+        self.assertEqual(agg.aggregate(['10.0.0.4', '10.0.0.5', '10.0.0.6', '10.0.0.7', '10.0.0.8']),
+                         ['10.0.0.4/30', '10.0.0.8'])
+
+    def test_static_networks_cover_addresses(self):
+        agg = Aggregator(min_prefix_len=32, networks=['192.168.0.0/16', '192.168.4.0/24', '10.9.0.0/24'])
+        self.assertEqual(agg.networks, [parse_network('10.9.0.0/24'), parse_network('192.168.0.0/16')])
+        self.assertEqual(agg.aggregate(['192.168.4.4', '10.9.1.1']),
+                         ['10.9.0.0/24', '10.9.1.1', '192.168.0.0/16'])
+
+    def test_every_address_covered(self):
+        rnd = random.Random(1)
+        numbers = set([ip_to_int('10.0.0.0') + rnd.randint(0, 4095) for i in range(3000)])
+        agg = Aggregator(min_prefix_len=20, density=0.6)
+        entries = [parse_network(e) for e in agg.aggregate([int_to_ip(n) for n in numbers])]
+        for n in numbers:
+            self.assertTrue([1 for net, plen in entries if net <= n < net + (1 << (32 - plen))])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+
+import argparse
+import unittest
+
+from benchmarks.cycle import Scenario, parse_range
+
+
+class TestCycleBenchmark(unittest.TestCase):
+
+    def _args(self, **kwargs):
+        args = argparse.Namespace(addresses=2, latency='0', ttl='60-600', churn=0.1, concurrency=4, seed=1)
+        for key, value in kwargs.items():
+            setattr(args, key, value)
+        return args
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range('300'), (300.0, 300.0))
+        self.assertEqual(parse_range('0.01-0.5'), (0.01, 0.5))
+
+    def test_scenario(self):
+        for backend in ('cli', 'netlink'):
+            result = Scenario(20, backend, self._args()).run()
+            self.assertEqual(result['cold']['changed'], 20)
+            self.assertEqual(result['cold']['entries'], 40)
+            self.assertEqual(result['warm']['changed'], 2)
+            self.assertEqual(result['idle']['changed'], 0)
+            self.assertEqual(result['idle']['ipset_updates'], 0)
+            if backend == 'cli':
+                self.assertEqual(result['cold']['process_spawns'], 1)
+            else:
+                self.assertEqual(result['cold']['process_spawns'], 0)
+                # fill, then the swap once the fill was acknowledged
+                self.assertEqual(result['cold']['netlink_requests'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,27 @@
 #!/usr/bin/env python
 
+import errno
+import logging
+import shutil
+import signal
+import tempfile
+import threading
+import time
 import unittest
 import sys
 import os
 
-from blocky.blocky import DetectIPAddresses
+from blocky import blocky, netlink
+from blocky.addrset import AddressSet
+from blocky.blocky import BlockManager, BlockProfile, ChainNotFound, DetectIPAddresses, TokenBucket, IPSetCLIBackend, \
+    IPSetError, IPSetHandler, IPSetNetlinkBackend, IPTablesHandler, IPTablesSnapshot, IncorrectProfileSetting, \
+    IncorrectFirewallSetting, IncorrectIPSetType, IncorrectPublishSetting, IncorrectResolveNameservers, \
+    IncorrectRulePosition, NFTables, NFTablesSetBackend, QueueLogHandler, Settings, StartupChecks, StateFile, Wakeup, \
+    all_domains, block_profiles, format_items, ipset_size, sigterm_handler_partial, whitelist_ipset_name
+from blocky.control import ControlError, ControlServer, request
+from blocky.publish import AnswerFollower, AnswerPublisher
+from tests.dnsstub import StubDNSServer
+from tests.fakebin import FakeCommand
 
 
 class TestBlocky(unittest.TestCase):
@@ -12,7 +29,1347 @@ class TestBlocky(unittest.TestCase):
     def test_detectipaddresses(self):
         det = DetectIPAddresses(fqdns=['localhost'])
         addr = det.iplist()
-        self.assertEqual(addr, ['127.0.0.1'])
+        self.assertEqual(list(addr), ['127.0.0.1'])
+
+
+class TestConcurrentResolution(unittest.TestCase):
+
+    def setUp(self):
+        zone = {'a.example': ['10.0.0.2', '10.0.0.1'], 'b.example': ['10.0.0.1', '10.0.0.3']}
+        for i in range(8):
+            zone['slow{}.example'.format(i)] = ['10.0.1.{}'.format(i)]
+        self.stub = StubDNSServer(zone=zone, default_latency=0.3).start()
+        self.fqdns = sorted(zone.keys()) + ['missing.example']
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def _detect(self, concurrency, per_domain_metrics=True):
+        det = DetectIPAddresses(fqdns=self.fqdns, concurrency=concurrency, query_timeout=2,
+                                per_domain_metrics=per_domain_metrics)
+        self.stub.configure(det._rslv)
+        return det
+
+    def test_parallel_merges_sorted_unique(self):
+        det = self._detect(concurrency=len(self.fqdns))
+        addr = det.iplist()
+        expected = sorted(['10.0.0.1', '10.0.0.2', '10.0.0.3'] + ['10.0.1.{}'.format(i) for i in range(8)])
+        self.assertEqual(list(addr), expected)
+        self.assertEqual(set(self.stub.queries), set(self.fqdns))
+
+    def test_parallel_faster_than_sequential(self):
+        det = self._detect(concurrency=len(self.fqdns))
+        det.iplist()
+        # 11 queries at 0.3s each would take 3.3s one after another
+        self.assertLess(det.last_cycle_time, 1.5)
+
+    def test_query_timeout(self):
+        self.stub.latency['slow0.example'] = 3
+        det = self._detect(concurrency=4)
+        det._rslv.lifetime = 0.5
+        timeouts = blocky.domain_resolve_errors.value(domain='slow0.example', reason='timeout')
+        addr = det.iplist()
+        self.assertNotIn('10.0.1.0', addr)
+        self.assertIn('10.0.1.1', addr)
+        self.assertEqual(blocky.domain_resolve_errors.value(domain='slow0.example', reason='timeout') - timeouts, 1)
+        self.assertGreaterEqual(blocky.domain_resolve_seconds.value(domain='slow0.example'), 0.5)
+
+    def test_metrics(self):
+        cycles = blocky.resolve_cycle_seconds.value()[0]
+        queries = blocky.resolve_seconds.value()[0]
+        nxdomain = blocky.domain_resolve_errors.value(domain='missing.example', reason='nxdomain')
+        self._detect(concurrency=len(self.fqdns)).iplist()
+        self.assertEqual(blocky.resolve_cycle_seconds.value()[0] - cycles, 1)
+        self.assertEqual(blocky.resolve_seconds.value()[0] - queries, len(self.fqdns))
+        self.assertEqual(blocky.domain_resolve_errors.value(domain='missing.example', reason='nxdomain') - nxdomain, 1)
+
+    def test_per_domain_metrics_off(self):
+        nxdomain = blocky.domain_resolve_errors.value(domain='missing.example', reason='nxdomain')
+        self._detect(concurrency=len(self.fqdns), per_domain_metrics=False).iplist()
+        self.assertEqual(blocky.domain_resolve_errors.value(domain='missing.example', reason='nxdomain'), nxdomain)
+
+
+class TestNameservers(unittest.TestCase):
+
+    def setUp(self):
+        self.stubs = [StubDNSServer(zone={'a.example': ['10.0.0.1', '10.0.0.2']}, ttl={'a.example': 300}).start(),
+                      StubDNSServer(zone={'a.example': ['10.0.0.2', '10.0.0.3']}, ttl={'a.example': 60}).start()]
+        self.names = ['{}:{}'.format(stub.address, stub.port) for stub in self.stubs]
+
+    def tearDown(self):
+        for stub in self.stubs:
+            stub.stop()
+
+    def _detect(self, **kwargs):
+        return DetectIPAddresses(fqdns=['a.example'], concurrency=2, max_refresh=600, nameservers=self.names,
+                                 **kwargs)
+
+    def test_answers_unioned(self):
+        det = self._detect()
+        self.assertEqual(det.resolve_due(now=1000), set(['a.example']))
+        self.assertEqual(list(det.addresses()), ['10.0.0.1', '10.0.0.2', '10.0.0.3'])
+        # the shortest TTL of the answers
+        self.assertEqual(det.next_due(), 1060)
+        self.assertEqual([stub.queries for stub in self.stubs], [['a.example'], ['a.example']])
+
+    def test_queried_in_parallel(self):
+        for stub in self.stubs:
+            stub.default_latency = 0.3
+        det = self._detect()
+        det.resolve_due()
+        self.assertLess(det.last_cycle_time, 0.55)
+
+    def test_failing_nameserver_benched(self):
+        self.stubs[1].default_latency = 1
+        det = self._detect(query_timeout=0.3)
+        slow = det.nameservers[1]
+        for i in range(slow.bench_after):
+            det.refresh(['a.example'])
+        self.assertTrue(slow.benched(time.time()))
+        self.assertEqual(blocky.nameserver_benched.value(nameserver=self.names[1]), 1)
+        self.assertEqual(det.active_nameservers(), [det.nameservers[0]])
+        queries = len(self.stubs[1].queries)
+        det.refresh(['a.example'])
+        self.assertEqual(len(self.stubs[1].queries), queries)
+        self.assertEqual(list(det.addresses()), ['10.0.0.1', '10.0.0.2'])
+        # tried again once the bench time is over, and forgiven when it answers
+        self.stubs[1].default_latency = 0
+        slow.benched_until = 0
+        det.refresh(['a.example'])
+        self.assertEqual(list(det.addresses()), ['10.0.0.1', '10.0.0.2', '10.0.0.3'])
+        self.assertEqual(slow.strikes, 0)
+        self.assertEqual(blocky.nameserver_benched.value(nameserver=self.names[1]), 0)
+
+    def test_bench_time_doubles(self):
+        det = self._detect()
+        ns = det.nameservers[0]
+        for i in range(ns.bench_after):
+            ns.record(0.1, True, now=1000)
+        self.assertEqual(ns.benched_until, 1000 + ns.bench_seconds)
+        ns.record(0.1, True, now=1000 + ns.bench_seconds)
+        self.assertEqual(ns.benched_until, 1000 + 3 * ns.bench_seconds)
+        # never all benched
+        det.nameservers[1].benched_until = 2000
+        self.assertEqual(det.active_nameservers(now=1001), [ns])
+
+    def test_set_nameservers_keeps_record(self):
+        det = self._detect()
+        det.nameservers[0].strikes = 2
+        det.set_nameservers([self.names[0], 'system'])
+        self.assertEqual([ns.name for ns in det.nameservers], [self.names[0], 'system'])
+        self.assertEqual(det.nameservers[0].strikes, 2)
+        self.assertIs(det.nameservers[1].rslv, det._rslv)
+
+    def _checks(self, value):
+        return StartupChecks({'table': 'FILTER', 'chain': 'INPUT', 'ipset': 'blocky_blacklist', 'domains': [],
+                              'resolve_nameservers': value})
+
+    def test_setting_checked(self):
+        sc = self._checks('system, 10.0.0.53, 10.0.0.54:5353, ::1')
+        sc.check_resolve_nameservers()
+        self.assertEqual(sc.settings['resolve_nameservers'], ['system', '10.0.0.53', '10.0.0.54:5353', '::1'])
+        for value in ['dns.example', '10.0.0.53:0', '10.0.0.53:x', '10.0.0.53, 10.0.0.53']:
+            self.assertRaises(IncorrectResolveNameservers, self._checks(value).check_resolve_nameservers)
+
+
+class TestRefreshScheduler(unittest.TestCase):
+
+    def setUp(self):
+        zone = {'short.example': ['10.0.0.1'], 'long.example': ['10.0.0.2'], 'zero.example': ['10.0.0.3']}
+        ttl = {'short.example': 60, 'long.example': 86400, 'zero.example': 0}
+        self.stub = StubDNSServer(zone=zone, ttl=ttl).start()
+        self.det = DetectIPAddresses(fqdns=sorted(zone.keys()), min_refresh=10, max_refresh=600)
+        self.stub.configure(self.det._rslv)
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def test_first_pass_resolves_everything(self):
+        changed = self.det.resolve_due(now=1000)
+        self.assertEqual(changed, set(['short.example', 'long.example', 'zero.example']))
+        self.assertEqual(list(self.det.addresses()), ['10.0.0.1', '10.0.0.2', '10.0.0.3'])
+
+    def test_ttl_clamped_by_bounds(self):
+        self.det.resolve_due(now=1000)
+        self.assertEqual(self.det._due['short.example'], 1060)
+        self.assertEqual(self.det._due['long.example'], 1600)
+        self.assertEqual(self.det._due['zero.example'], 1010)
+        self.assertEqual(self.det.next_due(), 1010)
+
+    def test_only_due_names_requeried(self):
+        self.det.resolve_due(now=1000)
+        del self.stub.queries[:]
+        self.assertEqual(self.det.resolve_due(now=1005), set())
+        self.assertEqual(self.stub.queries, [])
+        self.det.resolve_due(now=1060)
+        self.assertEqual(sorted(self.stub.queries), ['short.example', 'zero.example'])
+
+    def test_only_changed_names_reported(self):
+        self.det.resolve_due(now=1000)
+        self.stub.zone['short.example'] = ['10.0.0.9']
+        changed = self.det.resolve_due(now=1060)
+        self.assertEqual(changed, set(['short.example']))
+        self.assertEqual(list(self.det.addresses()), ['10.0.0.2', '10.0.0.3', '10.0.0.9'])
+
+    def test_iplist_forces_full_sweep(self):
+        self.det.resolve_due(now=1000)
+        del self.stub.queries[:]
+        self.det.iplist()
+        self.assertEqual(sorted(self.stub.queries), ['long.example', 'short.example', 'zero.example'])
+
+
+class TestDomainHealth(unittest.TestCase):
+
+    def setUp(self):
+        zone = {'a.example': ['10.0.0.1'], 'empty.example': [], 'bad.example': ['10.0.0.2']}
+        self.stub = StubDNSServer(zone=zone, default_ttl=60, soa_minimum=120).start()
+        self.stub.servfail.add('bad.example')
+        self.det = DetectIPAddresses(fqdns=['a.example', 'empty.example', 'missing.example', 'bad.example'],
+                                     min_refresh=10, max_refresh=600, max_backoff=100, grace=300,
+                                     per_domain_metrics=True)
+        self.det.health._random.seed(1)
+        self.stub.configure(self.det._rslv)
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def test_negative_answers_cached(self):
+        noanswer = blocky.domain_resolve_errors.value(domain='empty.example', reason='noanswer')
+        self.det.resolve_due(now=1000)
+        # the SOA minimum of a negative answer, check_every for NXDOMAIN which comes without the SOA record
+        self.assertEqual(self.det._due['empty.example'], 1120)
+        self.assertEqual(self.det._due['missing.example'], 1600)
+        self.assertEqual(blocky.domain_resolve_errors.value(domain='empty.example', reason='noanswer') - noanswer, 1)
+
+    def test_failures_back_off(self):
+        now = 1000
+        intervals = []
+        for i in range(6):
+            self.det.refresh(['bad.example'], now=now)
+            intervals.append(self.det._due['bad.example'] - now)
+            now = self.det._due['bad.example']
+        for i, interval in enumerate(intervals):
+            full = min(10 * 2 ** i, 100)
+            self.assertTrue(full * (1 - self.det.health.jitter) <= interval <= full, (i, interval))
+        self.assertEqual(self.det.health.failing()['bad.example']['attempts'], 6)
+        self.assertEqual(self.det.health.failing()['bad.example']['reason'], 'servfail')
+        self.assertEqual(blocky.failing_domains.value(), 1)
+
+    def test_last_good_answer_kept_for_grace(self):
+        self.stub.servfail.clear()
+        self.det.refresh(['bad.example'], now=1000)
+        self.stub.servfail.add('bad.example')
+        self.assertEqual(self.det.refresh(['bad.example'], now=1200), set())
+        self.assertEqual(list(self.det.addresses()), ['10.0.0.2'])
+        self.assertEqual(self.det.resolved_at['bad.example'], 1000)
+        self.assertEqual(self.det.refresh(['bad.example'], now=1301), set(['bad.example']))
+        self.assertEqual(list(self.det.addresses()), [])
+
+    def test_success_clears_failures(self):
+        for now in (1000, 1010, 1030):
+            self.det.refresh(['bad.example'], now=now)
+        self.assertIn('bad.example', self.det.health.failing())
+        self.stub.servfail.clear()
+        self.det.refresh(['bad.example'], now=1100)
+        self.assertEqual(self.det.health.failing(), {})
+        self.assertEqual(self.det._due['bad.example'], 1160)
+
+
+class TestRateLimitedSweep(unittest.TestCase):
+
+    def setUp(self):
+        self.fqdns = ['d{}.example'.format(i) for i in range(10)]
+        self.stub = StubDNSServer(zone=dict((fqdn, ['10.0.0.{}'.format(i)]) for i, fqdn in enumerate(self.fqdns)),
+                                  default_ttl=3600).start()
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def _detect(self, rate=None):
+        det = DetectIPAddresses(fqdns=self.fqdns, min_refresh=10, max_refresh=100, rate=rate)
+        self.stub.configure(det._rslv)
+        return det
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=2, capacity=4)
+        self.assertEqual(bucket.take(10, now=0), 4)
+        self.assertEqual(bucket.take(10, now=0.4), 0)
+        self.assertEqual(bucket.available_at(now=0.4), 0.5)
+        self.assertEqual(bucket.take(10, now=1.5), 3)
+
+    def test_rate_limit_leaves_rest_queued(self):
+        det = self._detect(rate=4)
+        self.assertEqual(len(det.resolve_due(now=1000)), 4)
+        self.assertEqual(len(det.resolve_due(now=1000.5)), 2)
+        self.assertEqual(len(self.stub.queries), 6)
+        self.assertEqual(det.progress(now=1000.5), (6, 10, 0.5))
+
+    def test_spread_over_interval(self):
+        det = self._detect()
+        det.spread(1000, 100)
+        self.assertEqual(len(det.resolve_due(now=1000)), 1)
+        self.assertEqual(det.next_due(), 1010)
+        self.assertEqual(len(det.resolve_due(now=1055)), 5)
+        det.resolve_due(now=1095)
+        self.assertEqual(det.last_sweep_time, 95)
+        self.assertEqual(det.progress(now=1095), (0, 10, 0))
+
+
+class TestIPSetRestore(unittest.TestCase):
+
+    def setUp(self):
+        self.ipset = FakeCommand('ipset', stdin_words=['restore'])
+
+    def tearDown(self):
+        self.ipset.cleanup()
+
+    def _handler(self, name='blocky_blacklist'):
+        return IPSetHandler(ipset_name=name, backend=IPSetCLIBackend(path=self.ipset.bindir))
+
+    def test_update_is_single_restore_with_swap(self):
+        handler = self._handler()
+        handler.update_ipset(['10.0.0.2', '10.0.0.1'])
+        calls = self.ipset.calls()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0]['argv'], ['-exist', 'restore'])
+        self.assertEqual(calls[0]['stdin'].splitlines(), [
+            'create blocky_blacklist_tmp hash:ip hashsize 4096',
+            'flush blocky_blacklist_tmp',
+            'add blocky_blacklist_tmp 10.0.0.1',
+            'add blocky_blacklist_tmp 10.0.0.2',
+            'swap blocky_blacklist_tmp blocky_blacklist',
+            'destroy blocky_blacklist_tmp',
+        ])
+
+    def test_unchanged_list_not_applied(self):
+        handler = self._handler()
+        handler.update_ipset(['10.0.0.1'])
+        handler.update_ipset(['10.0.0.1'])
+        self.assertEqual(len(self.ipset.calls()), 1)
+
+    def test_whitelist_set(self):
+        handler = self._handler(name=whitelist_ipset_name)
+        handler.update_ipset(['192.168.1.1'])
+        lines = self.ipset.calls()[0]['stdin'].splitlines()
+        self.assertIn('add blocky_local_ip_whitelist_tmp 192.168.1.1', lines)
+        self.assertIn('swap blocky_local_ip_whitelist_tmp blocky_local_ip_whitelist', lines)
+
+    def test_create_existing_set(self):
+        self.ipset.fail_on('create', stderr='ipset v6.23: Set cannot be created: set with the same name already exists')
+        handler = self._handler()
+        handler.create_ipset()
+        self.assertEqual(self.ipset.calls()[0]['argv'], ['create', 'blocky_blacklist', 'hash:ip', 'hashsize', '4096'])
+
+    def test_hash_net_entries(self):
+        handler = IPSetHandler(ipset_name='blocky_blacklist', backend=IPSetCLIBackend(path=self.ipset.bindir),
+                               set_type='hash:net')
+        handler.update_ipset(['10.0.0.0/24', '10.0.1.7'])
+        lines = self.ipset.calls()[0]['stdin'].splitlines()
+        self.assertEqual(lines[0], 'create blocky_blacklist_tmp hash:net hashsize 4096')
+        self.assertIn('add blocky_blacklist_tmp 10.0.0.0/24', lines)
+
+    def test_tmp_name_fits_ipset_limit(self):
+        handler = self._handler(name='x' * 31)
+        self.assertTrue(len(handler._tmp_ipset_name()) <= 31)
+
+    def test_restore_error_raised(self):
+        self.ipset.fail_on('restore', stderr='ipset v6.23: Error in line 3: Syntax error')
+        handler = self._handler()
+        self.assertRaises(IPSetError, handler.update_ipset, ['10.0.0.1'])
+        self.assertEqual(list(handler.iplist_prev), [])
+
+
+class TestIPSetDelta(unittest.TestCase):
+
+    def setUp(self):
+        self.ipset = FakeCommand('ipset', stdin_words=['restore'])
+        self.handler = IPSetHandler(ipset_name='blocky_blacklist', rebuild_threshold=0.5,
+                                    backend=IPSetCLIBackend(path=self.ipset.bindir))
+        self.base = ['10.0.0.{}'.format(i) for i in range(1, 11)]
+        self.handler.update_ipset(list(self.base))
+        self.ipset.reset()
+
+    def tearDown(self):
+        self.ipset.cleanup()
+
+    def test_first_update_rebuilds(self):
+        handler = IPSetHandler(ipset_name='blocky_blacklist', backend=IPSetCLIBackend(path=self.ipset.bindir))
+        handler.update_ipset(['10.0.0.1'])
+        self.assertIn('swap blocky_blacklist_tmp blocky_blacklist', self.ipset.calls()[0]['stdin'].splitlines())
+
+    def test_small_change_applied_as_delta(self):
+        iplist = self.base[2:] + ['10.0.1.1']
+        self.handler.update_ipset(iplist)
+        calls = self.ipset.calls()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0]['stdin'].splitlines(), [
+            'del blocky_blacklist 10.0.0.1',
+            'del blocky_blacklist 10.0.0.2',
+            'add blocky_blacklist 10.0.1.1',
+        ])
+        self.assertEqual(list(self.handler.iplist_prev), iplist)
+
+    def test_large_change_rebuilds(self):
+        self.handler.update_ipset(['10.0.2.{}'.format(i) for i in range(1, 11)])
+        lines = self.ipset.calls()[0]['stdin'].splitlines()
+        self.assertEqual(lines[0], 'create blocky_blacklist_tmp hash:ip hashsize 4096')
+
+    def test_failed_delta_forces_rebuild(self):
+        self.ipset.fail_on('restore', stderr='ipset v6.23: Error in line 1: Kernel error')
+        self.assertRaises(IPSetError, self.handler.update_ipset, self.base[1:])
+        self.ipset.clear_failures()
+        self.ipset.reset()
+        self.handler.update_ipset(self.base[1:])
+        self.assertIn('swap blocky_blacklist_tmp blocky_blacklist', self.ipset.calls()[0]['stdin'].splitlines())
+
+    def test_metrics(self):
+        added = blocky.ipset_added.value(set='blocky_blacklist')
+        removed = blocky.ipset_removed.value(set='blocky_blacklist')
+        commands = blocky.ipset_commands.value()
+        updates = blocky.ipset_update_seconds.value(set='blocky_blacklist')[0]
+        self.handler.update_ipset(self.base[2:] + ['10.0.1.1'])
+        self.assertEqual(blocky.ipset_added.value(set='blocky_blacklist') - added, 1)
+        self.assertEqual(blocky.ipset_removed.value(set='blocky_blacklist') - removed, 2)
+        self.assertEqual(blocky.ipset_entries.value(set='blocky_blacklist'), 9)
+        self.assertEqual(blocky.ipset_commands.value() - commands, 1)
+        self.assertEqual(blocky.ipset_update_seconds.value(set='blocky_blacklist')[0] - updates, 1)
+
+
+class TestIPSetAddAddresses(unittest.TestCase):
+
+    def setUp(self):
+        self.ipset = FakeCommand('ipset', stdin_words=['restore'])
+        self.handler = IPSetHandler(ipset_name='blocky_blacklist', backend=IPSetCLIBackend(path=self.ipset.bindir))
+        self.handler.update_ipset(['10.0.0.1', '10.0.0.2'])
+        self.ipset.reset()
+
+    def tearDown(self):
+        self.ipset.cleanup()
+
+    def test_only_new_addresses_added(self):
+        self.handler.add_addresses(['10.0.0.2', '10.0.0.3'], lifetime=60)
+        self.assertEqual(self.ipset.calls()[0]['stdin'].splitlines(), ['add blocky_blacklist 10.0.0.3'])
+        self.handler.add_addresses(['10.0.0.3'], lifetime=60)
+        self.assertEqual(len(self.ipset.calls()), 1)
+
+    def test_pinned_survive_update(self):
+        self.handler.add_addresses(['10.0.0.3'], lifetime=60)
+        self.handler.update_ipset(['10.0.0.1', '10.0.0.2'])
+        self.assertEqual(list(self.handler.iplist_prev), ['10.0.0.1', '10.0.0.2', '10.0.0.3'])
+
+    def test_expired_pins_removed(self):
+        self.handler.add_addresses(['10.0.0.3'], lifetime=0)
+        self.ipset.reset()
+        self.handler.update_ipset(['10.0.0.1', '10.0.0.2'])
+        self.assertEqual(self.ipset.calls()[0]['stdin'].splitlines(), ['del blocky_blacklist 10.0.0.3'])
+
+
+class TestIPSetResize(unittest.TestCase):
+
+    def setUp(self):
+        self.ipset = FakeCommand('ipset', stdin_words=['restore'])
+
+    def tearDown(self):
+        self.ipset.cleanup()
+
+    def _handler(self, **kwargs):
+        return IPSetHandler(ipset_name='blocky_blacklist', backend=IPSetCLIBackend(path=self.ipset.bindir), **kwargs)
+
+    def _small(self, handler):
+        # as if the set had been created for 8 entries
+        handler.maxelem = 8
+        handler.update_ipset(['10.0.0.1', '10.0.0.2'])
+        self.ipset.reset()
+
+    def test_size(self):
+        self.assertEqual(ipset_size(0), (4096, 65536))
+        self.assertEqual(ipset_size(16384), (4096, 65536))
+        self.assertEqual(ipset_size(16385), (8192, 131072))
+        self.assertEqual(ipset_size(300000), (131072, 2 ** 21))
+
+    def test_created_for_expected_entries(self):
+        self._handler(expected=20000).create_ipset()
+        self.assertEqual(self.ipset.calls()[0]['argv'],
+                         ['create', 'blocky_blacklist', 'hash:ip', 'hashsize', '8192', 'maxelem', '131072'])
+
+    def test_resized_by_swap(self):
+        handler = self._handler(rebuild_threshold=10)
+        self._small(handler)
+        resizes = blocky.ipset_resizes.value(set='blocky_blacklist')
+        handler.update_ipset(['10.0.0.{}'.format(i) for i in range(1, 8)])
+        self.assertEqual(handler.maxelem, 65536)
+        self.assertEqual(blocky.ipset_resizes.value(set='blocky_blacklist') - resizes, 1)
+        lines = self.ipset.calls()[0]['stdin'].splitlines()
+        self.assertEqual(lines[0], 'create blocky_blacklist_tmp hash:ip hashsize 4096')
+        self.assertIn('swap blocky_blacklist_tmp blocky_blacklist', lines)
+        # below the limit updates stay in place
+        self.ipset.reset()
+        handler.update_ipset(['10.0.0.{}'.format(i) for i in range(1, 9)])
+        self.assertEqual(self.ipset.calls()[0]['stdin'].splitlines(), ['add blocky_blacklist 10.0.0.8'])
+
+    def test_added_addresses_resize(self):
+        handler = self._handler()
+        self._small(handler)
+        handler.add_addresses(['10.0.0.{}'.format(i) for i in range(3, 8)], lifetime=60)
+        self.assertIn('swap blocky_blacklist_tmp blocky_blacklist', self.ipset.calls()[0]['stdin'].splitlines())
+        self.assertEqual(len(handler.iplist_prev), 7)
+
+    def test_entry_timeout_keeps_entries(self):
+        handler = self._handler(entry_timeout=300)
+        self._small(handler)
+        handler.update_ipset(['10.0.0.{}'.format(i) for i in range(3, 8)])
+        lines = self.ipset.calls()[0]['stdin'].splitlines()
+        self.assertEqual(lines[0], 'create blocky_blacklist_tmp hash:ip hashsize 4096 timeout 300')
+        self.assertIn('add blocky_blacklist_tmp 10.0.0.1 timeout 300', lines)
+        self.assertEqual(len(handler.iplist_prev), 7)
+
+
+class TestIPSetType(unittest.TestCase):
+
+    def setUp(self):
+        self.ipset = FakeCommand('ipset', stdin_words=['restore'])
+        # a hash:ip set left by a run with keep_on_shutdown
+        self.ipset.output_on('list', 'Name: blocky_blacklist\nType: hash:ip\nRevision: 4\n')
+        self.ipset.fail_on('restore', 1, 'ipset v7.10: Error in line 4: The sets cannot be swapped: their type '
+                                         'does not match\n')
+        self.backend = IPSetCLIBackend(path=self.ipset.bindir)
+
+    def tearDown(self):
+        self.ipset.cleanup()
+
+    def _checks(self, **settings):
+        settings.update({'table': 'FILTER', 'chain': 'INPUT', 'ipset': 'blocky_blacklist', 'domains': []})
+        return StartupChecks(settings)
+
+    def test_swap_rejected(self):
+        handler = IPSetHandler(ipset_name='blocky_blacklist', backend=self.backend, set_type='hash:net')
+        self.assertRaises(IPSetError, handler.update_ipset, ['10.0.0.0/24'])
+
+    def test_mismatch_refused_at_startup(self):
+        self.assertEqual(self.backend.set_type('blocky_blacklist'), 'hash:ip')
+        self.ipset.reset()
+        self.assertRaises(IncorrectIPSetType, self._checks(networks=['10.0.0.0/24']).check_ipset_types,
+                          self.backend)
+        self.assertRaises(IncorrectIPSetType, self._checks(aggregate_min_prefix=24).check_ipset_types, self.backend)
+        self.assertEqual([call['argv'] for call in self.ipset.calls()], [['list', '-t', 'blocky_blacklist']] * 2)
+        self._checks().check_ipset_types(self.backend)
+
+    def test_missing_set(self):
+        self.ipset.fail_on('list', 1, 'ipset v7.10: The set with the given name does not exist\n')
+        self.assertEqual(self.backend.set_type('blocky_blacklist'), None)
+        self._checks(networks=['10.0.0.0/24']).check_ipset_types(self.backend)
+
+
+class TestIPSetEntryTimeout(unittest.TestCase):
+
+    def setUp(self):
+        self.ipset = FakeCommand('ipset', stdin_words=['restore'])
+        self.handler = IPSetHandler(ipset_name='blocky_blacklist', backend=IPSetCLIBackend(path=self.ipset.bindir),
+                                    entry_timeout=600)
+
+    def tearDown(self):
+        self.ipset.cleanup()
+
+    def test_create_with_timeout(self):
+        self.handler.create_ipset()
+        self.assertEqual(self.ipset.calls()[0]['argv'],
+                         ['create', 'blocky_blacklist', 'hash:ip', 'hashsize', '4096', 'timeout', '600'])
+
+    def test_first_update_swaps_in_timeout_set(self):
+        self.handler.update_ipset(['10.0.0.1'])
+        self.assertEqual(self.ipset.calls()[0]['stdin'].splitlines(), [
+            'create blocky_blacklist_tmp hash:ip hashsize 4096 timeout 600',
+            'flush blocky_blacklist_tmp',
+            'add blocky_blacklist_tmp 10.0.0.1 timeout 600',
+            'swap blocky_blacklist_tmp blocky_blacklist',
+            'destroy blocky_blacklist_tmp',
+        ])
+
+    def test_addresses_accumulate(self):
+        self.handler.update_ipset(['10.0.0.1'])
+        self.ipset.reset()
+        self.handler.update_ipset(['10.0.0.2'])
+        self.assertEqual(self.ipset.calls()[0]['stdin'].splitlines(), ['add blocky_blacklist 10.0.0.2 timeout 600'])
+        self.assertEqual(list(self.handler.iplist_prev), ['10.0.0.1', '10.0.0.2'])
+
+    def test_refresh_after_half_timeout(self):
+        self.handler.update_ipset(['10.0.0.1', '10.0.0.2'])
+        self.ipset.reset()
+        self.handler.update_ipset(['10.0.0.1', '10.0.0.2'])
+        self.assertEqual(self.ipset.calls(), [])
+        self.handler._refreshed['10.0.0.1'] -= 301
+        self.handler.update_ipset(['10.0.0.1', '10.0.0.2'])
+        self.assertEqual(self.ipset.calls()[0]['stdin'].splitlines(), ['add blocky_blacklist 10.0.0.1 timeout 600'])
+
+    def test_expired_entries_forgotten(self):
+        self.handler.update_ipset(['10.0.0.1', '10.0.0.2'])
+        self.handler._refreshed['10.0.0.1'] -= 601
+        self.handler.update_ipset(['10.0.0.2'])
+        self.assertEqual(list(self.handler.iplist_prev), ['10.0.0.2'])
+
+    def test_proxy_lifetime_extends_timeout(self):
+        self.handler.update_ipset(['10.0.0.1'])
+        self.ipset.reset()
+        self.handler.add_addresses(['10.0.0.3'], lifetime=3600)
+        self.assertEqual(self.ipset.calls()[0]['stdin'].splitlines(), ['add blocky_blacklist 10.0.0.3 timeout 3600'])
+
+    def test_proxy_before_first_update_keeps_entries(self):
+        self.handler.add_addresses(['10.0.0.3'], lifetime=60)
+        # added to the set left by the previous run instead of replacing it
+        self.assertEqual(self.ipset.calls()[0]['stdin'].splitlines(), ['add blocky_blacklist 10.0.0.3'])
+        self.ipset.reset()
+        self.handler.update_ipset(['10.0.0.1'])
+        lines = self.ipset.calls()[0]['stdin'].splitlines()
+        self.assertIn('add blocky_blacklist_tmp 10.0.0.3 timeout 600', lines)
+        self.assertIn('swap blocky_blacklist_tmp blocky_blacklist', lines)
+        self.assertEqual(list(self.handler.iplist_prev), ['10.0.0.1', '10.0.0.3'])
+
+
+class FakeMatch(object):
+    def __init__(self, name, comment=None):
+        self.name = name
+        self.comment = comment
+
+
+class FakeRule(object):
+    def __init__(self, comment=None):
+        self.matches = [FakeMatch('tcp')]
+        if comment:
+            self.matches.append(FakeMatch('comment', comment))
+
+
+class FakeChain(object):
+    """Chain whose rules property counts how often the whole chain is read."""
+
+    def __init__(self, name, rules):
+        self.name = name
+        self._rules = rules
+        self.reads = 0
+
+    @property
+    def rules(self):
+        self.reads += 1
+        return list(self._rules)
+
+    def insert_rule(self, rule, position=0):
+        self._rules.insert(position, rule)
+
+    def delete_rule(self, rule):
+        self._rules.remove(rule)
+
+
+class FakeTable(object):
+    def __init__(self):
+        self.refreshes = 0
+
+    def refresh(self):
+        self.refreshes += 1
+
+
+class FakeSnapshot(IPTablesSnapshot):
+    def __init__(self, chains):
+        self.table_name = 'FILTER'
+        self.table = FakeTable()
+        self.chains = dict((chain.name, chain) for chain in chains)
+        self._chains = {}
+        self._by_comment = {}
+        self._counts = {}
+
+    def chain(self, chain_name):
+        if chain_name not in self.chains:
+            raise ChainNotFound(chain_name)
+        return self.chains[chain_name]
+
+
+class TestIPTablesSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.chain = FakeChain('INPUT', [FakeRule() for i in range(1000)] + [FakeRule('Blocky IPTables Rule')])
+        self.snapshot = FakeSnapshot([self.chain])
+
+    def _handler(self, **kwargs):
+        return IPTablesHandler(table_name='FILTER', chain_name='INPUT', snapshot=self.snapshot, **kwargs)
+
+    def test_chain_read_once_for_all_handlers(self):
+        blocking = self._handler()
+        whitelist = self._handler(comment='Blocky Whitelist IPTables Rule', target='ACCEPT')
+        self.assertIs(blocking.rule, self.chain._rules[-1])
+        self.assertIsNone(whitelist.rule)
+        whitelist.insert_rule()
+        self.assertEqual(self.snapshot.rule_count('INPUT'), 1002)
+        self.assertEqual(self.chain.reads, 1)
+
+    def test_delete_rule_by_comment(self):
+        handler = self._handler()
+        handler.delete_rule()
+        self.assertEqual(len(self.chain._rules), 1000)
+        self.assertEqual(self.snapshot.rule_count('INPUT'), 1000)
+        self.assertIsNone(self._handler().rule)
+        self.assertEqual(self.chain.reads, 1)
+
+    def test_shutdown_reads_chain_again(self):
+        handler = self._handler()
+        # rewritten by another program; the table read again has other rule objects
+        self.chain._rules = [FakeRule() for i in range(5)] + [FakeRule('Blocky IPTables Rule')]
+        ipset = FakeCommand('ipset')
+        self.addCleanup(ipset.cleanup)
+        mgr = BlockManager({'table': 'FILTER', 'chain': 'INPUT', 'ipset': 'blocky_blacklist', 'domains': []},
+                           snapshots={'FILTER': self.snapshot})
+        mgr.profiles = [BlockProfile('main', [], IPSetHandler(backend=IPSetCLIBackend(path=ipset.bindir)), handler)]
+        self.assertRaises(SystemExit, sigterm_handler_partial, mgr, signal.SIGTERM, None)
+        self.assertEqual(self.snapshot.table.refreshes, 1)
+        self.assertEqual(len(self.chain._rules), 5)
+        self.assertEqual(ipset.calls()[0]['argv'], ['restore'])
+
+    def test_missing_chain(self):
+        self.assertRaises(ChainNotFound, IPTablesHandler, table_name='FILTER', chain_name='FORWARD',
+                          snapshot=self.snapshot)
+
+    def test_rule_pos_checked_against_count(self):
+        sc = StartupChecks({'table': 'FILTER', 'chain': 'INPUT', 'ipset': 'blocky_blacklist', 'domains': []})
+        sc.snapshot = self.snapshot
+        sc.rule_pos = 1001
+        sc.check_rule_pos()
+        sc.rule_pos = 1002
+        self.assertRaises(IncorrectRulePosition, sc.check_rule_pos)
+        self.assertEqual(self.chain.reads, 1)
+
+
+class FakeNetlinkSocket(object):
+    def __init__(self, errors=None):
+        self.requests = []
+        self.errors = errors or {}
+        # reply data and error code of a query
+        self.reply = ('', 0)
+
+    def query(self, msg, seq):
+        self.requests.append([msg])
+        return self.reply
+
+    def request(self, messages, seqs):
+        self.requests.append(messages)
+        return [(seq, self.errors.get(len(self.requests), {}).get(i, 0)) for i, seq in enumerate(seqs)]
+
+
+class TestIPSetNetlinkBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.sock = FakeNetlinkSocket()
+        self.backend = IPSetNetlinkBackend(sock=self.sock)
+        self.backend._seq = 0
+        self.handler = IPSetHandler(ipset_name='blocky_blacklist', backend=self.backend)
+
+    def test_rebuild_messages(self):
+        self.handler.update_ipset(['10.0.0.1'])
+        # the swap is held back until everything before it was acknowledged
+        self.assertEqual(len(self.sock.requests), 2)
+        self.assertEqual(self.sock.requests[0], [
+            netlink.create('blocky_blacklist_tmp', 'hash:ip', 1, hashsize=4096, exist=True),
+            netlink.flush('blocky_blacklist_tmp', 2),
+            netlink.add('blocky_blacklist_tmp', '10.0.0.1', 3),
+        ])
+        self.assertEqual(self.sock.requests[1], [
+            netlink.swap('blocky_blacklist_tmp', 'blocky_blacklist', 4),
+            netlink.destroy('blocky_blacklist_tmp', 5),
+        ])
+
+    def test_failed_fill_does_not_swap(self):
+        self.sock.errors = {1: {2: netlink.IPSET_ERR_HASH_FULL}}
+        try:
+            self.handler.update_ipset(['10.0.0.1'])
+        except IPSetError as e:
+            self.assertEqual(e.code, netlink.IPSET_ERR_HASH_FULL)
+            self.assertIn('set is full', str(e))
+        else:
+            self.fail('IPSetError not raised')
+        self.assertEqual(len(self.sock.requests), 1)
+
+    def test_create_existing_by_error_code(self):
+        self.sock.errors = {1: {0: errno.EEXIST}}
+        self.handler.create_ipset()
+        self.assertEqual(self.sock.requests[0],
+                         [netlink.create('blocky_blacklist', 'hash:ip', 1, hashsize=4096, exist=False)])
+
+    def test_set_type(self):
+        self.sock.reply = (netlink.message(netlink.IPSET_CMD_HEADER, [
+            netlink.nla_string(netlink.IPSET_ATTR_SETNAME, 'blocky_blacklist'),
+            netlink.nla_string(netlink.IPSET_ATTR_TYPENAME, 'hash:ip')], 1), 0)
+        self.assertEqual(self.backend.set_type('blocky_blacklist'), 'hash:ip')
+        self.assertEqual(self.sock.requests[0], [netlink.header('blocky_blacklist', 1)])
+        self.sock.reply = ('', errno.ENOENT)
+        self.assertEqual(self.backend.set_type('blocky_blacklist'), None)
+
+    def test_batches(self):
+        self.backend.batch_size = 2
+        self.backend.run([('add', 's', '10.0.0.{}'.format(i)) for i in range(5)])
+        self.assertEqual([len(r) for r in self.sock.requests], [2, 2, 1])
+
+
+class TestNFTables(unittest.TestCase):
+
+    def setUp(self):
+        self.nft = FakeCommand('nft', stdin_words=['-f'])
+        self.settings = {'table': 'FILTER', 'chain': 'INPUT', 'ipset': 'blocky_blacklist', 'domains': ['a.example'],
+                         'rule_pos': 0, 'firewall': 'nftables',
+                         'profiles': {'proxy': {'table': 'FILTER', 'chain': 'INPUT', 'ipset': 'blocky_proxy',
+                                                'domains': ['b.example'], 'target': 'REJECT', 'rule_pos': 0}}}
+        self.mgr = BlockManager(self.settings)
+        self.mgr.nft = NFTables(path=self.nft.bindir)
+
+    def tearDown(self):
+        self.nft.cleanup()
+
+    def _scripts(self):
+        return [c['stdin'].splitlines() for c in self.nft.calls()]
+
+    def _start(self):
+        self.mgr.nft.begin()
+        whitelist = IPSetHandler(ipset_name=whitelist_ipset_name, backend=self.mgr.ipset_backend())
+        whitelist.create_ipset()
+        whitelist.update_ipset(['10.0.0.223'])
+        self.mgr.profiles = [self.mgr.create_profile(name, profile) for name, profile in block_profiles(self.settings)]
+        self.mgr.nft.commit()
+
+    def test_startup_is_one_transaction(self):
+        self._start()
+        self.assertEqual(len(self.nft.calls()), 1)
+        self.assertEqual(self.nft.calls()[0]['argv'], ['-f', '-'])
+        script = self._scripts()[0]
+        self.assertIn('add element inet blocky blocky_local_ip_whitelist { 10.0.0.223 }', script)
+        self.assertIn('add set inet blocky blocky_proxy { type ipv4_addr; }', script)
+        rules = [line for line in script if line.startswith('add rule')]
+        # the whitelist rule is shared by the profiles of the chain
+        self.assertEqual(rules, [
+            'add rule inet blocky input meta l4proto tcp ip daddr @blocky_local_ip_whitelist accept '
+            'comment "Blocky Whitelist IPTables Rule"',
+            'add rule inet blocky input meta l4proto tcp ip saddr @blocky_blacklist drop '
+            'comment "Blocky IPTables Rule"',
+            'add rule inet blocky input meta l4proto tcp ip saddr @blocky_proxy reject '
+            'comment "Blocky IPTables Rule (proxy)"',
+        ])
+        # the chain is emptied before the rules are added
+        self.assertLess(script.index('flush chain inet blocky input'), script.index(rules[0]))
+
+    def test_rebuild_flushes_and_refills(self):
+        handler = IPSetHandler(ipset_name='blocky_blacklist', backend=NFTablesSetBackend(self.mgr.nft))
+        handler.update_ipset(['10.0.0.2', '10.0.0.1'])
+        self.assertEqual(self._scripts(), [['flush set inet blocky blocky_blacklist',
+                                            'add element inet blocky blocky_blacklist { 10.0.0.1, 10.0.0.2 }']])
+        self.nft.reset()
+        handler.rebuild_threshold = 1
+        handler.update_ipset(['10.0.0.2', '10.0.0.3'])
+        self.assertEqual(self._scripts(), [['delete element inet blocky blocky_blacklist { 10.0.0.1 }',
+                                            'add element inet blocky blocky_blacklist { 10.0.0.3 }']])
+
+    def test_set_not_sized(self):
+        handler = IPSetHandler(ipset_name='blocky_blacklist', backend=NFTablesSetBackend(self.mgr.nft),
+                               expected=300000)
+        self.assertNotEqual(handler.maxelem, blocky.default_maxelem)
+        handler.create_ipset()
+        self.assertEqual(self._scripts()[0][-1], 'add set inet blocky blocky_blacklist { type ipv4_addr; }')
+
+    def test_interval_set_always_refilled(self):
+        handler = IPSetHandler(ipset_name='blocky_blacklist', backend=NFTablesSetBackend(self.mgr.nft),
+                               set_type='hash:net', rebuild_threshold=1)
+        # merged into the range 10.0.0.4-10.0.0.5 by auto-merge
+        handler.update_ipset(['10.0.0.4', '10.0.0.5', '10.0.1.0/24'])
+        self.nft.reset()
+        handler.update_ipset(['10.0.0.5', '10.0.1.0/24'])
+        self.assertEqual(self._scripts(), [['flush set inet blocky blocky_blacklist',
+                                            'add element inet blocky blocky_blacklist { 10.0.0.5, 10.0.1.0/24 }']])
+
+    def test_entry_timeout_refreshed(self):
+        handler = IPSetHandler(ipset_name='blocky_blacklist', backend=NFTablesSetBackend(self.mgr.nft),
+                               entry_timeout=300)
+        handler.update_ipset(['10.0.0.1'])
+        self.assertEqual(self._scripts()[0][-3:], [
+            'add element inet blocky blocky_blacklist { 10.0.0.1 timeout 300s }',
+            'delete element inet blocky blocky_blacklist { 10.0.0.1 }',
+            'add element inet blocky blocky_blacklist { 10.0.0.1 timeout 300s }'])
+
+    def test_delete_rule_rewrites_chain(self):
+        self._start()
+        self.nft.reset()
+        self.mgr.profiles[1].iptables_handler.delete_rule()
+        script = self._scripts()[0]
+        self.assertEqual(script[0], 'flush chain inet blocky input')
+        self.assertEqual(len(script), 3)
+        self.assertNotIn('blocky_proxy', ' '.join(script))
+
+    def test_error_raised(self):
+        self.nft.fail_on('-f', stderr='Error: No such file or directory')
+        handler = IPSetHandler(ipset_name='blocky_blacklist', backend=NFTablesSetBackend(self.mgr.nft))
+        self.assertRaises(IPSetError, handler.update_ipset, ['10.0.0.1'])
+
+    def test_setting_checked(self):
+        for key, value in [('firewall', 'pf'), ('nft_table', 'my table'), ('chain', 'blocky_chain'),
+                           ('table', 'NAT')]:
+            settings = dict(self.settings, firewall='nftables', profiles={})
+            settings[key] = value
+            self.assertRaises(IncorrectFirewallSetting, StartupChecks(settings).check_firewall)
+        for key, value in [('networks', ['10.0.0.0/24']), ('aggregate_min_prefix', 24)]:
+            settings = dict(self.settings, ipset_entry_timeout=300)
+            settings[key] = value
+            self.assertRaises(IncorrectFirewallSetting, StartupChecks(settings).check_firewall)
+        StartupChecks(dict(self.settings, ipset_entry_timeout=300)).check_firewall()
+        settings = dict(self.settings, firewall=' IPTables ', chain='blocky_chain')
+        StartupChecks(settings).check_firewall()
+        self.assertEqual(settings['firewall'], 'iptables')
+
+
+class TestReload(unittest.TestCase):
+
+    config = '''[main]
+table = FILTER
+chain = INPUT
+check_every = {check_every}
+domains = @{domains_file}
+ipset = blocky_blacklist
+whitelist_local_ips = {whitelist}
+log_level = info
+log_type = syslog
+pidfile = /var/run/blocky.pid
+'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.tmpdir, 'blocky.conf')
+        self.domains_file = os.path.join(self.tmpdir, 'domains.txt')
+        self.stub = StubDNSServer(zone={'a.example': ['10.0.0.1'], 'b.example': ['10.0.0.2'],
+                                        'c.example': ['10.0.0.3']}).start()
+        self.ipset = FakeCommand('ipset', stdin_words=['restore'])
+        self._write(['a.example', 'b.example'], check_every=60, whitelist='192.168.0.1')
+        settings = Settings(config_file=self.config_file)
+        StartupChecks(settings).check_settings()
+        self.mgr = BlockManager(settings)
+        backend = IPSetCLIBackend(path=self.ipset.bindir)
+        self.mgr.profiles = [BlockProfile('main', settings['domains'],
+                                          IPSetHandler(ipset_name='blocky_blacklist', backend=backend))]
+        self.mgr.local_whitelist_ipset_handler = IPSetHandler(ipset_name=whitelist_ipset_name, backend=backend)
+        self.mgr.local_whitelist_ipset_handler.update_ipset(['192.168.0.1'])
+        self.mgr.detect = DetectIPAddresses(fqdns=list(settings['domains']), max_refresh=60)
+        self.stub.configure(self.mgr.detect._rslv)
+        self.mgr.resolve_and_apply()
+        self.mgr.source_files_changed()
+        self.ipset.reset()
+
+    def tearDown(self):
+        self.stub.stop()
+        self.ipset.cleanup()
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, domains, check_every, whitelist):
+        with open(self.domains_file, 'wb') as fo:
+            fo.write('\n'.join(domains) + '\n')
+        with open(self.config_file, 'wb') as fo:
+            fo.write(self.config.format(check_every=check_every, domains_file=self.domains_file, whitelist=whitelist))
+
+    def test_domain_diff_applied(self):
+        self._write(['b.example', 'c.example'], check_every=60, whitelist='192.168.0.1')
+        self.mgr.reload()
+        self.assertEqual(self.mgr.detect.fqdns, ['b.example', 'c.example'])
+        # the removed domain's address leaves the set right away, the added domain is due at the next check
+        self.assertEqual([c['stdin'].splitlines() for c in self.ipset.calls()], [['del blocky_blacklist 10.0.0.1']])
+        self.assertEqual(self.mgr.detect.resolve_due(), set(['c.example']))
+
+    def test_whitelist_and_check_every(self):
+        self._write(['a.example', 'b.example'], check_every=120, whitelist='192.168.0.1, 192.168.0.2')
+        self.mgr.reload()
+        self.assertEqual(self.mgr.detect.max_refresh, 120)
+        self.assertEqual(list(self.mgr.local_whitelist_ipset_handler.iplist_prev), ['192.168.0.1', '192.168.0.2'])
+        # only the whitelist was touched
+        self.assertEqual(len(self.ipset.calls()), 1)
+
+    def test_resolve_timeout_removed(self):
+        default = self.mgr.detect._rslv.lifetime
+        with open(self.config_file, 'ab') as fo:
+            fo.write('resolve_timeout = 2\n')
+        self.mgr.reload()
+        self.assertEqual(self.mgr.detect._rslv.lifetime, 2)
+        self._write(['a.example', 'b.example'], check_every=60, whitelist='192.168.0.1')
+        self.mgr.reload()
+        self.assertIsNone(self.mgr.detect.query_timeout)
+        self.assertEqual(self.mgr.detect._rslv.lifetime, default)
+
+    def test_restart_only_setting_kept(self):
+        with open(self.config_file, 'ab') as fo:
+            fo.write('ipset_backend = netlink\n')
+        self.mgr.reload()
+        self.assertEqual(self.mgr.settings['ipset_backend'], 'cli')
+
+    def test_invalid_config_ignored(self):
+        self._write(['c.example'], check_every='soon', whitelist='')
+        self.mgr.reload()
+        self.assertEqual(self.mgr.detect.fqdns, ['a.example', 'b.example'])
+        self.assertEqual(self.ipset.calls(), [])
+
+    def test_source_files_watched(self):
+        self.assertFalse(self.mgr.source_files_changed())
+        os.utime(self.domains_file, (0, 0))
+        self.assertTrue(self.mgr.source_files_changed())
+        self.assertFalse(self.mgr.source_files_changed())
+
+
+class ProfilesSetup(object):
+
+    config = '''[main]
+table = FILTER
+chain = FORWARD
+check_every = 60
+domains = a.example, b.example
+ipset = blocky_blacklist
+rule_pos = 2
+log_level = info
+log_type = syslog
+pidfile = /var/run/blocky.pid
+
+[profile:proxy]
+chain = INPUT
+domains = {proxy_domains}
+ipset = blocky_proxy
+target = reject
+'''
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config_file = os.path.join(self.tmpdir, 'blocky.conf')
+        self.stub = StubDNSServer(zone={'a.example': ['10.0.0.1'], 'b.example': ['10.0.0.2'],
+                                        'c.example': ['10.0.0.3']}).start()
+        self.ipset = FakeCommand('ipset', stdin_words=['restore'])
+        self._write('b.example, c.example')
+        self.settings = self._settings()
+        self.mgr = BlockManager(self.settings)
+        backend = IPSetCLIBackend(path=self.ipset.bindir)
+        self.mgr.local_whitelist_ipset_handler = IPSetHandler(ipset_name=whitelist_ipset_name, backend=backend)
+        self.mgr.profiles = [BlockProfile(name, profile['domains'], IPSetHandler(ipset_name=profile['ipset'],
+                                                                                 backend=backend))
+                             for name, profile in block_profiles(self.settings)]
+        self.mgr.detect = DetectIPAddresses(fqdns=all_domains(self.settings), max_refresh=60)
+        self.stub.configure(self.mgr.detect._rslv)
+
+    def tearDown(self):
+        self.stub.stop()
+        self.ipset.cleanup()
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, proxy_domains):
+        with open(self.config_file, 'wb') as fo:
+            fo.write(self.config.format(proxy_domains=proxy_domains))
+
+    def _settings(self):
+        settings = Settings(config_file=self.config_file)
+        StartupChecks(settings).check_settings()
+        return settings
+
+    def _iplists(self):
+        return dict((p.name, list(p.ipset_handler.iplist_prev)) for p in self.mgr.profiles)
+
+
+class TestProfiles(ProfilesSetup, unittest.TestCase):
+
+    def test_profile_defaults(self):
+        self.assertEqual(block_profiles(self.settings)[1], ('proxy', {
+            'table': 'FILTER', 'chain': 'INPUT', 'ipset': 'blocky_proxy', 'target': 'REJECT', 'rule_pos': 2,
+            'domains': ['b.example', 'c.example']}))
+        self.assertEqual(all_domains(self.settings), ['a.example', 'b.example', 'c.example'])
+
+    def test_invalid_profiles(self):
+        for section in ['[profile:other]\ndomains = a.example\n',
+                        '[profile:other]\ndomains = a.example\nipset = blocky_proxy\n',
+                        '[profile:main]\ndomains = a.example\nipset = blocky_other\n',
+                        '[profile:other]\ndomains = a.example\nipset = blocky_other\ntarget = ACCEPT\n']:
+            self._write('c.example')
+            with open(self.config_file, 'ab') as fo:
+                fo.write('\n' + section)
+            self.assertRaises(IncorrectProfileSetting, self._settings)
+
+    def test_shared_resolution_fans_out(self):
+        self.mgr.resolve_and_apply()
+        self.assertEqual(sorted(self.stub.queries), ['a.example', 'b.example', 'c.example'])
+        self.assertEqual(self._iplists(), {'main': ['10.0.0.1', '10.0.0.2'], 'proxy': ['10.0.0.2', '10.0.0.3']})
+        # an answer of one profile's domain only touches that profile's set
+        self.stub.zone['c.example'] = ['10.0.0.4']
+        self.ipset.reset()
+        self.mgr.detect._schedule('c.example', 0)
+        self.assertEqual(self.mgr.resolve_and_apply(), set(['c.example']))
+        self.assertEqual([c['stdin'].split()[1] for c in self.ipset.calls()], ['blocky_proxy_tmp'])
+        self.assertEqual(self._iplists()['proxy'], ['10.0.0.2', '10.0.0.4'])
+
+    def test_dns_proxy_match_routed(self):
+        self.mgr.resolve_and_apply()
+        self.ipset.reset()
+        self.mgr.block_observed(60, 'c.example', ['10.0.0.9'], 30)
+        self.assertEqual(self._iplists()['main'], ['10.0.0.1', '10.0.0.2'])
+        self.assertIn('10.0.0.9', self._iplists()['proxy'])
+
+    def test_reload_profile_domains(self):
+        self.mgr.resolve_and_apply()
+        self._write('c.example')
+        self.mgr.reload()
+        self.assertEqual(self.mgr.profiles[1].domains, ['c.example'])
+        self.assertEqual(self._iplists()['proxy'], ['10.0.0.3'])
+        # still blocked by the main profile
+        self.assertEqual(self.mgr.detect.fqdns, ['a.example', 'b.example', 'c.example'])
+        with open(self.config_file, 'ab') as fo:
+            fo.write('\n[profile:other]\ndomains = a.example\nipset = blocky_other\n')
+        self.mgr.reload()
+        self.assertEqual(sorted(self.mgr.settings['profiles']), ['proxy'])
+
+
+class TestControl(ProfilesSetup, unittest.TestCase):
+
+    def setUp(self):
+        super(TestControl, self).setUp()
+        self.mgr.wakeup = Wakeup()
+        self.mgr.resolve_and_apply()
+        self.ipset.reset()
+        self.path = os.path.join(self.tmpdir, 'blocky.sock')
+        self.server = ControlServer(self.path, self.mgr.control)
+        self.server.start()
+        # stands in for the main loop
+        self.stopped = False
+        self.loop = threading.Thread(target=self._main_loop)
+        self.loop.start()
+
+    def tearDown(self):
+        self.stopped = True
+        self.mgr.wakeup.set()
+        self.loop.join()
+        self.server.stop()
+        super(TestControl, self).tearDown()
+
+    def _main_loop(self):
+        while not self.stopped:
+            self.mgr.wakeup.wait(5)
+            self.mgr.run_commands()
+
+    def test_queries(self):
+        self.assertEqual(request(self.path, 'set', profile='proxy'), ['10.0.0.2', '10.0.0.3'])
+        self.assertEqual(request(self.path, 'answers', domains=['a.example'])['a.example']['addresses'], ['10.0.0.1'])
+        status = request(self.path, 'status')
+        self.assertEqual(status['profiles']['main'], {'ipset': 'blocky_blacklist', 'domains': 2, 'entries': 2,
+                                                       'maxelem': 65536})
+        self.assertEqual(status['sweep']['domains'], 3)
+        self.assertEqual(status['failing'], 0)
+        self.assertEqual(request(self.path, 'failing'), {})
+        self.assertRaises(ControlError, request, self.path, 'set', profile='missing')
+
+    def test_why(self):
+        why = request(self.path, 'why', addresses=['10.0.0.2', '10.0.0.9'])
+        self.assertEqual(sorted(why['10.0.0.2']['domains']), ['b.example'])
+        self.assertEqual(why['10.0.0.2']['profiles'], ['main', 'proxy'])
+        self.assertEqual(why['10.0.0.9'], {'domains': {}, 'profiles': []})
+        # covered by an aggregated entry of the set
+        handler = self.mgr.profiles[0].ipset_handler
+        handler.iplist_prev = handler.iplist_prev.union(AddressSet(['10.0.5.0/24']))
+        self.assertEqual(request(self.path, 'why', addresses=['10.0.5.9'])['10.0.5.9']['profiles'], ['main'])
+
+    def test_refresh(self):
+        self.stub.zone['a.example'] = ['10.0.0.5']
+        self.assertEqual(request(self.path, 'refresh', domains=['a.example']), ['a.example'])
+        self.assertEqual(list(self.mgr.profiles[0].ipset_handler.iplist_prev), ['10.0.0.2', '10.0.0.5'])
+        self.assertRaises(ControlError, request, self.path, 'refresh', domains=['other.example'])
+
+    def test_add_and_remove_domains(self):
+        self.assertEqual(request(self.path, 'add', domains=['c.example']), ['c.example'])
+        # already resolved for the proxy profile
+        self.assertEqual(list(self.mgr.profiles[0].ipset_handler.iplist_prev), ['10.0.0.1', '10.0.0.2', '10.0.0.3'])
+        self.assertEqual(self.mgr.settings['domains'], ['a.example', 'b.example', 'c.example'])
+        self.assertEqual(request(self.path, 'remove', domains=['b.example', 'c.example'], profile='proxy'),
+                         ['b.example', 'c.example'])
+        self.assertEqual(list(self.mgr.profiles[1].ipset_handler.iplist_prev), [])
+        # still blocked by the main profile
+        self.assertEqual(self.mgr.detect.fqdns, ['a.example', 'b.example', 'c.example'])
+        request(self.path, 'remove', domains=['c.example'])
+        self.assertEqual(self.mgr.detect.fqdns, ['a.example', 'b.example'])
+
+    def test_whitelist(self):
+        self.assertEqual(request(self.path, 'whitelist_add', addresses=['192.168.0.1', '192.168.0.2']),
+                         ['192.168.0.1', '192.168.0.2'])
+        self.assertEqual(request(self.path, 'whitelist_remove', addresses=['192.168.0.1']), ['192.168.0.2'])
+        self.assertEqual(self.mgr.settings['whitelist_local_ips'], '192.168.0.2')
+        self.assertRaises(ControlError, request, self.path, 'whitelist_add', addresses=['192.168.0.3', 'garbage'])
+        self.assertEqual(self.mgr.settings['whitelist_local_ips'], '192.168.0.2')
+        self.assertEqual(list(self.mgr.local_whitelist_ipset_handler.iplist_prev), ['192.168.0.2'])
+        # a failed update leaves the setting as it was
+        self.ipset.fail_on('restore', stderr='ipset failed')
+        self.assertRaises(ControlError, request, self.path, 'whitelist_add', addresses=['192.168.0.3'])
+        self.assertEqual(self.mgr.settings['whitelist_local_ips'], '192.168.0.2')
+
+    def test_unknown_command(self):
+        self.assertRaises(ControlError, request, self.path, 'reboot')
+
+
+class TestLeaderFollower(ProfilesSetup, unittest.TestCase):
+
+    def setUp(self):
+        super(TestLeaderFollower, self).setUp()
+        self.mgr.publisher = AnswerPublisher(('unix', os.path.join(self.tmpdir, 'publish.sock')))
+        self.mgr.publisher.start()
+        self.mgr.detect.unpublished = set()
+        self.follower_ipset = FakeCommand('ipset', stdin_words=['restore'])
+        self.fmgr = BlockManager(self._settings())
+        self.fmgr.wakeup = Wakeup()
+        backend = IPSetCLIBackend(path=self.follower_ipset.bindir)
+        self.fmgr.profiles = [BlockProfile(name, profile['domains'], IPSetHandler(ipset_name=profile['ipset'],
+                                                                                  backend=backend))
+                              for name, profile in block_profiles(self.settings)]
+        self.fmgr.detect = DetectIPAddresses(fqdns=[])
+        self.fmgr.follower = AnswerFollower(self.mgr.publisher.endpoint, self.fmgr.followed, retry=0.05)
+        self.fmgr.follower.start()
+
+    def tearDown(self):
+        self.fmgr.follower.stop()
+        self.mgr.publisher.stop()
+        self.follower_ipset.cleanup()
+        super(TestLeaderFollower, self).tearDown()
+
+    def _follow(self, version):
+        # stands in for the follower's main loop
+        while self.fmgr.follower.version != version or not self.fmgr._followed.empty():
+            self.assertTrue(self.fmgr.wakeup.wait(5))
+            self.fmgr.apply_followed()
+
+    def _follower_iplists(self):
+        return dict((p.name, list(p.ipset_handler.iplist_prev)) for p in self.fmgr.profiles)
+
+    def test_follower_applies_leader_answers(self):
+        self._follow(0)
+        self.mgr.resolve_and_apply()
+        self.assertTrue(self.mgr.publish_answers())
+        self._follow(1)
+        self.assertEqual(self._follower_iplists(), self._iplists())
+        self.assertEqual(self.fmgr.detect.index.owners('10.0.0.2').keys(), ['b.example'])
+        # only the leader resolves
+        self.assertEqual(len(self.stub.queries), 3)
+        self.stub.zone['c.example'] = ['10.0.0.4']
+        self.mgr.detect._schedule('c.example', 0)
+        self.mgr.resolve_and_apply()
+        self.follower_ipset.reset()
+        self.mgr.publish_answers()
+        self._follow(2)
+        self.assertEqual(self._follower_iplists()['proxy'], ['10.0.0.2', '10.0.0.4'])
+        self.assertEqual([c['stdin'].split()[1] for c in self.follower_ipset.calls()], ['blocky_proxy_tmp'])
+
+    def test_snapshot_after_reconnect(self):
+        self.mgr.resolve_and_apply()
+        self.mgr.publish_answers()
+        self._follow(1)
+        self.mgr.publisher._drop(self.mgr.publisher.followers[0])
+        self.mgr.detect.remove_fqdns(['a.example'])
+        self.mgr.publish_answers()
+        self._follow(2)
+        self.assertEqual(self._follower_iplists()['main'], ['10.0.0.2'])
+        self.assertNotIn('a.example', self.fmgr.detect.answers)
+
+    def test_setting_checked(self):
+        settings = {'table': 'FILTER', 'chain': 'INPUT', 'ipset': 'blocky_blacklist', 'domains': [],
+                    'publish': '0.0.0.0:5380'}
+        StartupChecks(settings).check_publish_settings()
+        self.assertEqual(settings['publish'], ('tcp', ('0.0.0.0', 5380)))
+        for value in [{'publish': 'leader'}, {'follow': '/nonexistent/publish.sock'},
+                      {'publish': '0.0.0.0:5380', 'follow': '10.0.0.1:5380'}]:
+            wrong = dict(settings, publish=None)
+            wrong.update(value)
+            self.assertRaises(IncorrectPublishSetting, StartupChecks(wrong).check_publish_settings)
+
+
+class SlowHandler(logging.Handler):
+    """Collects formatted records, each emit waits until proceed is set."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.proceed = threading.Event()
+        self.busy = threading.Event()
+        self.messages = []
+
+    def emit(self, record):
+        self.busy.set()
+        self.proceed.wait(5)
+        self.messages.append(self.format(record))
+
+
+class TestLogging(unittest.TestCase):
+
+    def _record(self, msg, *args):
+        return logging.makeLogRecord({'msg': msg, 'args': args, 'levelno': logging.INFO, 'levelname': 'INFO'})
+
+    def test_format_items(self):
+        self.assertEqual(format_items(['a', 'b']), 'a, b')
+        self.assertEqual(format_items(range(5), limit=3), '0, 1, 2 ... (2 more)')
+
+    def test_queue_handler_does_not_block(self):
+        target = SlowHandler()
+        handler = QueueLogHandler(target, maxsize=2)
+        handler.handle(self._record('record %s', 0))
+        self.assertTrue(target.busy.wait(5))
+        started = time.time()
+        for i in range(1, 5):
+            handler.handle(self._record('record %s', i))
+        self.assertLess(time.time() - started, 1)
+        target.proceed.set()
+        handler.close()
+        # the writer is stuck on the first record, two records wait in the queue and two are dropped
+        self.assertEqual(target.messages, ['record 0', '2 log records dropped, the log writer fell behind',
+                                           'record 1', 'record 2'])
+
+    def test_queue_handler_formats_before_queueing(self):
+        target = SlowHandler()
+        target.proceed.set()
+        handler = QueueLogHandler(target)
+        args = ['before']
+        handler.handle(self._record('value: %s', args))
+        args[0] = 'after'
+        try:
+            raise ValueError('broken')
+        except ValueError:
+            record = self._record('failed')
+            record.exc_info = sys.exc_info()
+            handler.handle(record)
+        handler.close()
+        self.assertEqual(target.messages[0], "value: ['before']")
+        self.assertTrue(target.messages[1].startswith('failed\nTraceback'))
+        self.assertIn('ValueError: broken', target.messages[1])
+
+
+class TestWarmStart(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.state = StateFile(os.path.join(self.tmpdir, 'state.json'))
+        self.ipset = FakeCommand('ipset', stdin_words=['restore'])
+
+    def tearDown(self):
+        self.ipset.cleanup()
+        shutil.rmtree(self.tmpdir)
+
+    def test_roundtrip(self):
+        self.state.save({'a.example': ['10.0.0.1'], 'b.example': []}, {'a.example': 1000.0, 'b.example': 1001.0})
+        answers, resolved_at, saved = self.state.load()
+        self.assertEqual(answers, {'a.example': ['10.0.0.1'], 'b.example': []})
+        self.assertEqual(resolved_at, {'a.example': 1000.0, 'b.example': 1001.0})
+        self.assertFalse(os.path.exists(self.state.path + '.tmp'))
+
+    def test_missing_or_corrupt(self):
+        self.assertEqual(self.state.load(), ({}, {}, None))
+        with open(self.state.path, 'wb') as fo:
+            fo.write('{"version": 1, "domains": ')
+        self.assertEqual(self.state.load(), ({}, {}, None))
+
+    def test_warm_start_fills_ipset_before_resolving(self):
+        self.state.save({'a.example': ['10.0.0.1'], 'gone.example': ['10.0.0.9']}, {'a.example': 1000.0})
+        mgr = BlockManager({'domains': ['a.example', 'b.example']})
+        mgr.profiles = [BlockProfile('main', ['a.example', 'b.example'],
+                                     IPSetHandler(ipset_name='blocky_blacklist',
+                                                  backend=IPSetCLIBackend(path=self.ipset.bindir)))]
+        mgr.detect = DetectIPAddresses(fqdns=['a.example', 'b.example'])
+        mgr.state = self.state
+        mgr.warm_start()
+        self.assertEqual(list(mgr.profiles[0].ipset_handler.iplist_prev), ['10.0.0.1'])
+        self.assertIn('add blocky_blacklist_tmp 10.0.0.1', self.ipset.calls()[0]['stdin'].splitlines())
+        # still resolved again right away
+        self.assertEqual(mgr.detect.next_due(), 0)
+
 
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+import unittest
+
+from blocky.blocky import Wakeup
+from blocky.control import ControlError, ControlServer, ctl_parser, request
+
+
+class TestControlServer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'blocky.sock')
+        self.requests = []
+        self.server = ControlServer(self.path, self._dispatch)
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def _dispatch(self, req):
+        self.requests.append(req)
+        if req['command'] == 'fail':
+            raise ControlError('failed on purpose')
+        return {'echo': req}
+
+    def test_roundtrip(self):
+        self.assertEqual(request(self.path, 'status', domains=['a.example']),
+                         {'echo': {'command': 'status', 'domains': ['a.example']}})
+
+    def test_error(self):
+        try:
+            request(self.path, 'fail')
+        except ControlError as e:
+            self.assertEqual(str(e), 'failed on purpose')
+        else:
+            self.fail('ControlError not raised')
+
+    def test_owner_only(self):
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode) & 0o077, 0)
+
+    def test_stale_socket_replaced(self):
+        self.server.stop()
+        # a socket file left behind by a process that was killed
+        self.server = ControlServer(self.path, self._dispatch)
+        self.server.start()
+        server = ControlServer(self.path, self._dispatch)
+        server.start()
+        try:
+            self.assertEqual(request(self.path, 'status'), {'echo': {'command': 'status'}})
+        finally:
+            server.stop()
+
+    def test_ctl_arguments(self):
+        args = vars(ctl_parser().parse_args(['add', 'a.example', 'b.example', '-p', 'proxy']))
+        self.assertEqual(args, {'command': 'add', 'domains': ['a.example', 'b.example'], 'profile': 'proxy',
+                                'socket': None})
+
+
+class TestWakeup(unittest.TestCase):
+
+    def test_wait_times_out(self):
+        wakeup = Wakeup()
+        started = time.time()
+        self.assertFalse(wakeup.wait(0.1))
+        self.assertGreaterEqual(time.time() - started, 0.1)
+
+    def test_set_from_other_thread(self):
+        wakeup = Wakeup()
+        threading.Timer(0.05, wakeup.set).start()
+        started = time.time()
+        self.assertTrue(wakeup.wait(5))
+        self.assertLess(time.time() - started, 1)
+        # several wakeups are drained at once
+        for i in range(3):
+            wakeup.set()
+        self.assertTrue(wakeup.wait(5))
+        self.assertFalse(wakeup.wait(0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+import socket
+import threading
+import unittest
+
+import dns.message
+import dns.query
+import dns.rcode
+
+from blocky.dnsproxy import DNSProxy, SuffixIndex, parse_host_port
+from tests.dnsstub import StubDNSServer
+
+
+class TestSuffixIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = SuffixIndex(['youtube.com', 'googlevideo.com.', ' YTimg.com '])
+
+    def test_exact_and_subdomains(self):
+        self.assertEqual(self.index.match('youtube.com'), 'youtube.com')
+        self.assertEqual(self.index.match('www.youtube.com.'), 'youtube.com')
+        self.assertEqual(self.index.match('r1---sn-abc.GoogleVideo.com'), 'googlevideo.com')
+        self.assertEqual(self.index.match('i.ytimg.com'), 'ytimg.com')
+
+    def test_no_match(self):
+        self.assertIsNone(self.index.match('notyoutube.com'))
+        self.assertIsNone(self.index.match('com'))
+        self.assertIsNone(self.index.match('youtube.com.example'))
+
+    def test_parse_host_port(self):
+        self.assertEqual(parse_host_port('10.0.0.1'), ('10.0.0.1', 53))
+        self.assertEqual(parse_host_port('10.0.0.1:5353'), ('10.0.0.1', 5353))
+
+
+class TestDNSProxy(unittest.TestCase):
+
+    def setUp(self):
+        self.upstream = StubDNSServer(zone={'www.youtube.com': ['10.1.0.1', '10.1.0.2'],
+                                            'example.org': ['10.2.0.1']},
+                                      ttl={'www.youtube.com': 60}).start()
+        self.matches = []
+        self.proxy = DNSProxy(domains=['youtube.com'], upstream=(self.upstream.address, self.upstream.port),
+                              on_match=self._on_match, port=0, timeout=2)
+        self.proxy.start()
+
+    def tearDown(self):
+        self.proxy.stop()
+        self.upstream.stop()
+
+    def _on_match(self, domain, addresses, ttl):
+        self.matches.append((domain, sorted(addresses), ttl))
+
+    def _query(self, name, tcp=False):
+        query = dns.message.make_query(name, 'A')
+        if tcp:
+            return dns.query.tcp(query, self.proxy.address, timeout=2, port=self.proxy.port)
+        return dns.query.udp(query, self.proxy.address, timeout=2, port=self.proxy.port)
+
+    def test_matching_name_blocked_before_answer(self):
+        response = self._query('www.youtube.com')
+        self.assertEqual(self.matches, [('youtube.com', ['10.1.0.1', '10.1.0.2'], 60)])
+        self.assertEqual(sorted([r.address for r in response.answer[0]]), ['10.1.0.1', '10.1.0.2'])
+
+    def test_tcp(self):
+        self._query('www.youtube.com', tcp=True)
+        self.assertEqual(len(self.matches), 1)
+
+    def test_other_names_only_forwarded(self):
+        response = self._query('example.org')
+        self.assertEqual(self.matches, [])
+        self.assertEqual([r.address for r in response.answer[0]], ['10.2.0.1'])
+
+    def test_failed_block_returns_servfail(self):
+        def fail(domain, addresses, ttl):
+            raise RuntimeError('ipset failed')
+        self.proxy.on_match = fail
+        response = self._query('www.youtube.com')
+        self.assertEqual(response.rcode(), dns.rcode.SERVFAIL)
+        self.assertEqual(response.answer, [])
+
+
+def _other_id(data):
+    return chr(ord(data[0]) ^ 1) + data[1:]
+
+
+class TestForwardUDP(unittest.TestCase):
+
+    def setUp(self):
+        self.upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.upstream.bind(('127.0.0.1', 0))
+        self.proxy = DNSProxy(domains=[], upstream=self.upstream.getsockname(), on_match=None, port=0, timeout=1)
+
+    def tearDown(self):
+        # never started
+        for server in self.proxy._servers:
+            server.server_close()
+        self.upstream.close()
+
+    def _reply(self, *replies):
+        def serve():
+            data, client = self.upstream.recvfrom(65535)
+            for reply in replies:
+                self.upstream.sendto(reply(data), client)
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+
+    def test_reply_with_other_id_dropped(self):
+        query = dns.message.make_query('example.org', 'A').to_wire()
+        self._reply(_other_id, lambda data: data)
+        self.assertEqual(self.proxy.forward_udp(query), query)
+
+    def test_timeout_without_matching_reply(self):
+        query = dns.message.make_query('example.org', 'A').to_wire()
+        self._reply(_other_id)
+        self.assertRaises(socket.timeout, self.proxy.forward_udp, query)
+
+
+if __name__ == '__main__':
+    unittest.main()
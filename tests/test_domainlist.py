@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from blocky.blocky import Settings
+from blocky.domainlist import CompiledDomains, compile_list, compiled_path, load_compiled, suffix_keys
+
+
+class TestCompiledDomains(unittest.TestCase):
+
+    lines = ['# blocked', 'www.YouTube.com', 'youtube.com.', '', 'youtube.com', 'm.youtube.com', 'example-x.org',
+             'a.example.org', 'example.org', 'ytimg.com']
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir, 'domains.txt')
+        self._write(self.lines)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, lines):
+        with open(self.source, 'wb') as fo:
+            fo.write('\n'.join(lines) + '\n')
+
+    def _compiled(self):
+        compiled = CompiledDomains(compiled_path(self.source))
+        self.addCleanup(compiled.close)
+        return compiled
+
+    def test_compile(self):
+        self.assertEqual(compile_list(self.source), (7, 8, 4))
+        compiled = self._compiled()
+        self.assertEqual(compiled.names(), ['a.example.org', 'example-x.org', 'example.org', 'm.youtube.com',
+                                            'www.youtube.com', 'youtube.com', 'ytimg.com'])
+        self.assertTrue(compiled.is_fresh(self.source))
+
+    def test_suffix_keys(self):
+        self.assertEqual(suffix_keys(['example.org', 'example-x.org', 'a.example.org', 'b.a.example-x.org']),
+                         ['org.example', 'org.example-x'])
+
+    def test_covers(self):
+        compile_list(self.source)
+        compiled = self._compiled()
+        self.assertEqual(compiled.covers('r1.sn-x.googlevideo.youtube.com.'), 'youtube.com')
+        self.assertEqual(compiled.covers('A.Example.org'), 'example.org')
+        self.assertEqual(compiled.covers('b.example-x.org'), 'example-x.org')
+        for name in ['youtube.co', 'notyoutube.com', 'org', 'x.example-y.org']:
+            self.assertIsNone(compiled.covers(name))
+
+    def test_settings_read_compiled(self):
+        settings = Settings.__new__(Settings)
+        settings.source_files = []
+        # the text is normalized like the compiled list
+        text = settings.check_opt_path('@' + self.source)
+        compile_list(self.source)
+        self.assertEqual(settings.check_opt_path('@' + self.source), text)
+        self.assertEqual(text[0], 'a.example.org')
+        self.assertEqual(settings.source_files, [self.source] * 2)
+
+    def test_stale_falls_back_to_text(self):
+        compile_list(self.source)
+        self.assertEqual(len(load_compiled(self.source)), 7)
+        self._write(['other.example'])
+        os.utime(self.source, (time.time() + 10, time.time() + 10))
+        self.assertIsNone(load_compiled(self.source))
+        with open(compiled_path(self.source), 'wb') as fo:
+            fo.write('garbage')
+        self.assertIsNone(load_compiled(self.source))
+        os.unlink(compiled_path(self.source))
+        self.assertIsNone(load_compiled(self.source))
+
+
+if __name__ == '__main__':
+    unittest.main()
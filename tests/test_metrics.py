@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+import urllib2
+
+from blocky.metrics import MetricsServer, Registry, write_textfile
+
+
+class TestRender(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter_and_gauge(self):
+        counter = self.registry.counter('test_errors_total', 'Errors', ['domain'])
+        gauge = self.registry.gauge('test_entries', 'Entries')
+        counter.inc(domain='a.example')
+        counter.inc(2, domain='say "hi"\\')
+        gauge.set(1.5)
+        self.assertEqual(self.registry.render().splitlines(), [
+            '# HELP test_errors_total Errors',
+            '# TYPE test_errors_total counter',
+            'test_errors_total{domain="a.example"} 1',
+            'test_errors_total{domain="say \\"hi\\"\\\\"} 2',
+            '# HELP test_entries Entries',
+            '# TYPE test_entries gauge',
+            'test_entries 1.5',
+        ])
+
+    def test_histogram_buckets_are_cumulative(self):
+        hist = self.registry.histogram('test_seconds', 'Time', buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            hist.observe(value)
+        self.assertEqual(self.registry.render().splitlines()[2:], [
+            'test_seconds_bucket{le="0.1"} 2',
+            'test_seconds_bucket{le="1"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            'test_seconds_sum 3.65',
+            'test_seconds_count 4',
+        ])
+        self.assertEqual(hist.value(), (4, 3.65))
+
+    def test_labels_checked_and_removed(self):
+        counter = self.registry.counter('test_total', 'Test', ['domain'])
+        self.assertRaises(ValueError, counter.inc)
+        counter.inc(domain='a.example')
+        counter.remove(domain='a.example')
+        self.assertEqual(counter.value(domain='a.example'), 0)
+        self.assertNotIn('a.example', self.registry.render())
+
+
+class TestExposition(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+        self.registry.gauge('test_entries', 'Entries').set(3)
+
+    def test_textfile(self):
+        tmpdir = tempfile.mkdtemp(prefix='blocky-test-')
+        try:
+            path = os.path.join(tmpdir, 'blocky.prom')
+            write_textfile(self.registry, path)
+            self.assertEqual(os.listdir(tmpdir), ['blocky.prom'])
+            with open(path, 'rb') as fo:
+                self.assertEqual(fo.read(), self.registry.render())
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_http(self):
+        server = MetricsServer(self.registry, port=0)
+        server.start()
+        try:
+            response = urllib2.urlopen('http://127.0.0.1:{}/metrics'.format(server.port), timeout=5)
+            self.assertTrue(response.info()['Content-Type'].startswith('text/plain; version=0.0.4'))
+            self.assertIn('test_entries 3\n', response.read())
+            self.assertRaises(urllib2.HTTPError, urllib2.urlopen,
+                              'http://127.0.0.1:{}/other'.format(server.port), timeout=5)
+        finally:
+            server.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+import binascii
+import errno
+import struct
+import unittest
+
+from blocky import netlink
+
+
+def unhex(s):
+    return binascii.unhexlify(''.join(s.split()))
+
+
+class TestNetlinkEncoding(unittest.TestCase):
+
+    def test_destroy(self):
+        self.assertEqual(netlink.destroy('blocky', 1), unhex('''
+            28000000 0306 0500 01000000 00000000
+            02000000
+            05000100 06000000
+            0b000200 626c6f63 6b790000
+        '''))
+
+    def test_add_address(self):
+        self.assertEqual(netlink.add('s', '10.0.0.1', 7), unhex('''
+            34000000 0906 0500 07000000 00000000
+            02000000
+            05000100 06000000
+            06000200 73000000
+            10000780 0c000180 08000140 0a000001
+        '''))
+
+    def test_add_network_with_timeout_exclusive(self):
+        msg = netlink.add('s', '10.0.0.0/24', 2, timeout=600, exist=False)
+        length, msg_type, flags, seq, pid = struct.unpack_from('=IHHII', msg)
+        self.assertEqual(length, len(msg))
+        self.assertEqual(flags, netlink.NLM_F_REQUEST | netlink.NLM_F_ACK | netlink.NLM_F_EXCL)
+        self.assertTrue(msg.endswith(unhex('05000300 18000000 08000640 00000258')))
+
+    def test_create(self):
+        msg = netlink.create('s', 'hash:ip', 3, hashsize=4096, exist=True)
+        length, msg_type, flags, seq, pid = struct.unpack_from('=IHHII', msg)
+        self.assertEqual(msg_type, (netlink.NFNL_SUBSYS_IPSET << 8) | netlink.IPSET_CMD_CREATE)
+        self.assertEqual(flags, netlink.NLM_F_REQUEST | netlink.NLM_F_ACK)
+        self.assertIn(netlink.nla_string(netlink.IPSET_ATTR_TYPENAME, 'hash:ip'), msg)
+        self.assertTrue(msg.endswith(unhex('0c000780 08001240 00001000')))
+
+    def test_parse_acks(self):
+        data = struct.pack('=IHHIIi', 36, netlink.NLMSG_ERROR, 0, 5, 0, 0) + '\0' * 16 + \
+            struct.pack('=IHHIIi', 36, netlink.NLMSG_ERROR, 0, 6, 0, -netlink.IPSET_ERR_EXIST) + '\0' * 16
+        self.assertEqual(netlink.parse_acks(data), [(5, 0), (6, netlink.IPSET_ERR_EXIST)])
+
+    def test_error_message(self):
+        self.assertEqual(netlink.error_message(errno.EEXIST), 'set with the same name already exists')
+        self.assertEqual(netlink.error_message(netlink.IPSET_ERR_HASH_FULL), 'set is full')
+
+
+if __name__ == '__main__':
+    unittest.main()
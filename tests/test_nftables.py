@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+import unittest
+
+from blocky import nftables
+
+
+class TestStatements(unittest.TestCase):
+
+    def test_chain_and_rule(self):
+        self.assertEqual(nftables.add_chain('blocky', 'input', 'input', 'filter'),
+                         'add chain inet blocky input { type filter hook input priority filter; policy accept; }')
+        self.assertEqual(nftables.add_rule('blocky', 'input', 'blocky_blacklist', 'src', 'DROP', 'Blocky "main"'),
+                         'add rule inet blocky input meta l4proto tcp ip saddr @blocky_blacklist drop '
+                         'comment "Blocky \'main\'"')
+        self.assertIn('ip daddr @blocky_whitelist accept',
+                      nftables.add_rule('blocky', 'input', 'blocky_whitelist', 'dst', 'ACCEPT', 'Whitelist'))
+
+    def test_sets(self):
+        self.assertEqual(nftables.add_set('blocky', 'b', 'hash:ip', [('hashsize', 4096)]),
+                         'add set inet blocky b { type ipv4_addr; }')
+        # sized by the kernel, ipset's maxelem would be a fixed size
+        self.assertEqual(nftables.add_set('blocky', 'b', 'hash:net', [('hashsize', 8192), ('maxelem', 131072)]),
+                         'add set inet blocky b { type ipv4_addr; flags interval; auto-merge; }')
+        self.assertEqual(nftables.add_set('blocky', 'b', 'hash:net', [('timeout', 300)]),
+                         'add set inet blocky b { type ipv4_addr; flags interval, timeout; timeout 300s; }')
+
+    def test_elements_chunked(self):
+        entries = ['10.0.{}.{}'.format(i // 256, i % 256) for i in range(nftables.ELEMENTS_PER_STATEMENT + 1)]
+        statements = nftables.elements('add', 'blocky', 'b', entries)
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(statements[1], 'add element inet blocky b { 10.0.3.232 }')
+        self.assertEqual(nftables.elements('add', 'blocky', 'b', ['10.0.0.1', '10.0.0.0/24'], timeout=60),
+                         ['add element inet blocky b { 10.0.0.1 timeout 60s, 10.0.0.0/24 timeout 60s }'])
+        self.assertEqual(nftables.elements('add', 'blocky', 'b', []), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+import os
+import Queue
+import shutil
+import socket
+import tempfile
+import unittest
+
+from blocky.addrset import AddressSet
+from blocky.publish import AnswerFollower, AnswerPublisher, parse_endpoint
+
+
+class TestEndpoint(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse_endpoint('/var/run/blocky-publish.sock'), ('unix', '/var/run/blocky-publish.sock'))
+        self.assertEqual(parse_endpoint(' 10.0.0.1:5380 '), ('tcp', ('10.0.0.1', 5380)))
+        self.assertEqual(parse_endpoint('[::1]:5380'), ('tcp', ('::1', 5380)))
+        for value in ['10.0.0.1', 'leader:0', 'leader:x', ':5380', 'relative/path']:
+            self.assertRaises(ValueError, parse_endpoint, value)
+
+
+class TestPublishFollow(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.publisher = AnswerPublisher(('unix', os.path.join(self.tmpdir, 'publish.sock')))
+        self.publisher.start()
+        self.messages = Queue.Queue()
+        self.followers = []
+
+    def tearDown(self):
+        for follower in self.followers:
+            follower.stop()
+        self.publisher.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def _follow(self, endpoint=None):
+        follower = AnswerFollower(endpoint or self.publisher.endpoint,
+                                  lambda *message: self.messages.put(message), retry=0.05)
+        self.followers.append(follower)
+        follower.start()
+        return follower
+
+    def _next(self):
+        return self.messages.get(timeout=5)
+
+    def test_snapshot_then_deltas(self):
+        a = AddressSet(['10.0.0.1'])
+        self.assertTrue(self.publisher.publish({'a.example': a, 'b.example': AddressSet(['10.0.0.2'])},
+                                               ['a.example', 'b.example']))
+        follower = self._follow()
+        self.assertEqual(self._next(), ({'a.example': ['10.0.0.1'], 'b.example': ['10.0.0.2']}, None, True))
+        # unchanged answers are not sent again
+        self.assertFalse(self.publisher.publish({'a.example': a, 'b.example': AddressSet(['10.0.0.2'])},
+                                                ['a.example', 'b.example']))
+        # only the answers of the fqdns named are looked at
+        self.assertFalse(self.publisher.publish({'a.example': AddressSet(['10.0.0.3'])}, []))
+        self.publisher.publish({'a.example': AddressSet(['10.0.0.3'])}, ['a.example', 'b.example'])
+        self.assertEqual(self._next(), ({'a.example': ['10.0.0.3']}, ['b.example'], False))
+        self.assertEqual(self.publisher.version, 2)
+        self.assertEqual(follower.version, 2)
+
+    def test_tcp(self):
+        publisher = AnswerPublisher(('tcp', ('127.0.0.1', 0)))
+        publisher.start()
+        try:
+            self._follow(('tcp', publisher.address))
+            self.assertEqual(self._next(), ({}, None, True))
+            publisher.publish({'a.example': AddressSet(['10.0.0.1'])}, ['a.example'])
+            self.assertEqual(self._next(), ({'a.example': ['10.0.0.1']}, [], False))
+        finally:
+            publisher.stop()
+
+    @unittest.skipUnless(socket.has_ipv6, 'no IPv6 support')
+    def test_tcp_ipv6(self):
+        try:
+            publisher = AnswerPublisher(('tcp', ('::1', 0)))
+        except socket.error as e:
+            self.skipTest('cannot bind ::1: {}'.format(e))
+        publisher.start()
+        try:
+            self.assertEqual(publisher.address[0], '::1')
+            self._follow(('tcp', publisher.address))
+            self.assertEqual(self._next(), ({}, None, True))
+        finally:
+            publisher.stop()
+
+    def test_catch_up_after_reconnect(self):
+        self._follow()
+        self._next()
+        # the follower is cut off and misses a version
+        self.publisher._drop(self.publisher.followers[0])
+        self.publisher.publish({'a.example': AddressSet(['10.0.0.1'])}, ['a.example'])
+        self.assertEqual(self._next(), ({'a.example': ['10.0.0.1']}, None, True))
+
+    def test_missed_version_restarts(self):
+        follower = self._follow()
+        self._next()
+        follower.version = 5
+        self.publisher.publish({'a.example': AddressSet(['10.0.0.1'])}, ['a.example'])
+        # the delta is rejected and the follower reconnects for a snapshot
+        self.assertEqual(self._next(), ({'a.example': ['10.0.0.1']}, None, True))
+        self.assertTrue(self.messages.empty())
+
+
+if __name__ == '__main__':
+    unittest.main()